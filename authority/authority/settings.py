@@ -50,6 +50,7 @@ MIDDLEWARE_CLASSES = [
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'intuity_common.auth.TokenMiddleware',
 ]
 
 ROOT_URLCONF = 'authority.urls'
@@ -121,3 +122,11 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.9/howto/static-files/
 
 STATIC_URL = '/static/'
+
+# Token verification, documented in intuity_common.auth.
+AUTH_AUDIENCE = 'authority'
+AUTH_ISSUER = 'authority'
+AUTH_CACHE_SIZE = 10000
+AUTH_CACHE_TTL = 300
+AUTH_INTERNAL_KEY = SECRET_KEY
+AUTH_INTERNAL_MAX_AGE = 60
@@ -6,24 +6,7 @@ import jsonschema
 from rest_framework import parsers
 from rest_framework.response import Response
 from rest_framework.views import APIView
-
-
-def validate_token(func):
-    def _decorated(view, request, *args, **kwargs):
-        token = request.GET.get('token', '')
-        if not token:
-            return Response({'error': 'Missing authentication token'}, status=401)
-        try:
-            payload = jwt.decode(
-                token,
-                key=settings.SECRET_KEY,
-                audience='authority',
-                issuer='authority'
-            )
-        except (jwt.DecodeError, AttributeError, jwt.InvalidAudience, jwt.InvalidIssuer) as e:
-            return Response({'error': e.message}, status=401)
-        return func(view, request, payload, *args, **kwargs)
-    return _decorated
+from intuity_common.auth import validate_token
 
 
 class Key(APIView):
@@ -0,0 +1,259 @@
+"""
+Token verification shared by authority, curiosity and intuity.
+
+TokenMiddleware verifies the `token` query parameter once per request and
+keeps verified payloads in a bounded TTL cache keyed by the token's hash.
+Calls between services may carry the payload the caller already verified
+in a signed header, which the callee checks with a single HMAC instead of
+decoding the token again. Background work that outlives the request keeps
+the payload rather than the token, and sends a context signed for it alone.
+
+Settings:
+    AUTH_AUDIENCE, AUTH_ISSUER: expected claims.
+    AUTH_CACHE_SIZE, AUTH_CACHE_TTL: verified tokens kept, and for how long.
+    AUTH_INTERNAL_KEY: shared secret signing internal contexts (defaults to
+        SECRET_KEY); internal contexts are ignored when it is empty.
+    AUTH_INTERNAL_MAX_AGE: seconds an internal context stays valid.
+"""
+import base64
+import collections
+import hashlib
+import hmac
+import json
+import threading
+import time
+
+import jwt
+from django.conf import settings
+from rest_framework.response import Response
+
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:
+    MiddlewareMixin = object
+
+import logging
+
+log = logging.getLogger('intuity_common.auth')
+
+CONTEXT_HEADER = 'X-Intuity-Context'
+CONTEXT_META = 'HTTP_X_INTUITY_CONTEXT'
+
+JOB_TYPES = ('classification', 'clustering', 'regression')
+
+
+def token_key(token):
+    if not isinstance(token, bytes):
+        token = token.encode('utf-8')
+    return hashlib.sha256(token).hexdigest()
+
+
+def job_type(payload):
+    """
+    The job type authority put in the token, or None if it has none.
+    """
+    data = payload.get('data')
+    value = data.get('job_type') if isinstance(data, dict) else None
+    return value if value in JOB_TYPES else None
+
+
+class TTLCache(object):
+    """
+    Thread safe mapping whose entries expire after their TTL and that drops
+    its oldest entries beyond `size`.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires <= time.time():
+                del self.items[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (value, time.time() + ttl)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class TokenVerifier(object):
+
+    def __init__(self, key, audience, issuer, cache_size, ttl, internal_key=None, internal_max_age=60):
+        self.key = key
+        self.audience = audience
+        self.issuer = issuer
+        self.cache = TTLCache(cache_size, ttl)
+        self.internal_key = internal_key.encode('utf-8') if internal_key else None
+        self.internal_max_age = internal_max_age
+
+    def verify(self, token):
+        """
+        Returns the token payload, or raises jwt.InvalidTokenError.
+        """
+        key = token_key(token)
+        payload = self.cache.get(key)
+        if payload is not None:
+            return payload
+        payload = jwt.decode(token, key=self.key, algorithms=['HS256'], audience=self.audience, issuer=self.issuer)
+        ttl = payload['exp'] - time.time() if 'exp' in payload else None
+        self.cache.set(key, payload, ttl)
+        return payload
+
+    def sign(self, message):
+        return hmac.new(self.internal_key, message, hashlib.sha256).hexdigest()
+
+    def context(self, token):
+        """
+        Signed header value vouching for `token`, or None when this process
+        has not verified it recently.
+        """
+        if not self.internal_key:
+            return None
+        key = token_key(token)
+        payload = self.cache.get(key)
+        if payload is None:
+            return None
+        return self.signed_context(key, payload)
+
+    def payload_context(self, payload):
+        """
+        Signed header value standing in for a token this process verified
+        earlier, for calls made later without keeping the token itself.
+        """
+        if not self.internal_key:
+            return None
+        return self.signed_context(None, payload)
+
+    def signed_context(self, key, payload):
+        message = base64.urlsafe_b64encode(
+            json.dumps({'token': key, 'aud': self.audience, 'payload': payload, 'time': time.time()}).encode('utf-8')
+        )
+        return '{}.{}'.format(message.decode('ascii'), self.sign(message))
+
+    def verify_context(self, token, context):
+        """
+        Returns the payload carried by a valid internal context for `token`,
+        or None so the caller falls back to verifying the token itself. With
+        no token, only contexts made by payload_context() are valid.
+        """
+        if not self.internal_key:
+            return None
+        message, _, signature = context.encode('ascii', 'ignore').rpartition(b'.')
+        if not message or not hmac.compare_digest(self.sign(message).encode('ascii'), signature):
+            log.warning("Rejected internal context with a bad signature")
+            return None
+        try:
+            context = json.loads(base64.urlsafe_b64decode(message).decode('utf-8'))
+        except (TypeError, ValueError):
+            return None
+        key = token_key(token) if token else None
+        if context.get('token') != key or context.get('aud') != self.audience:
+            return None
+        if time.time() - context.get('time', 0) > self.internal_max_age:
+            return None
+        payload = context['payload']
+        # Cached no longer than the token itself is valid, as in verify().
+        ttl = payload['exp'] - time.time() if 'exp' in payload else None
+        if ttl is not None and ttl <= 0:
+            return None
+        if key is not None:
+            self.cache.set(key, payload, ttl)
+        return payload
+
+
+_verifier = None
+_verifier_lock = threading.Lock()
+
+
+def get_verifier():
+    global _verifier
+    if _verifier is None:
+        with _verifier_lock:
+            if _verifier is None:
+                _verifier = TokenVerifier(
+                    settings.SECRET_KEY,
+                    audience=settings.AUTH_AUDIENCE,
+                    issuer=getattr(settings, 'AUTH_ISSUER', 'authority'),
+                    cache_size=getattr(settings, 'AUTH_CACHE_SIZE', 10000),
+                    ttl=getattr(settings, 'AUTH_CACHE_TTL', 300),
+                    internal_key=getattr(settings, 'AUTH_INTERNAL_KEY', settings.SECRET_KEY),
+                    internal_max_age=getattr(settings, 'AUTH_INTERNAL_MAX_AGE', 60),
+                )
+    return _verifier
+
+
+def internal_headers(token, payload=None):
+    """
+    Headers to add to a call to another service made on behalf of `token`,
+    or without a token on behalf of its verified `payload`.
+    """
+    verifier = get_verifier()
+    context = verifier.context(token) if token else verifier.payload_context(payload)
+    return {CONTEXT_HEADER: context} if context else {}
+
+
+def authenticate(request):
+    """
+    Sets request.auth_payload to the verified payload of the `token` query
+    parameter, or of the internal context sent instead of one, or to None
+    with the reason in request.auth_error.
+    """
+    request.auth_payload = None
+    request.auth_error = None
+    token = request.GET.get('token', '')
+    context = request.META.get(CONTEXT_META)
+    if not token and not context:
+        request.auth_error = 'Missing authentication token'
+        return
+    verifier = get_verifier()
+    if context:
+        request.auth_payload = verifier.verify_context(token, context)
+        if request.auth_payload is not None:
+            return
+    if not token:
+        request.auth_error = 'Invalid internal context'
+        return
+    try:
+        request.auth_payload = verifier.verify(token)
+    except jwt.InvalidTokenError as e:
+        request.auth_error = str(e) or type(e).__name__
+
+
+class TokenMiddleware(MiddlewareMixin):
+
+    def process_request(self, request):
+        authenticate(request)
+
+
+def validate_token(func):
+    """
+    Passes the payload set by TokenMiddleware to DRF view methods, or
+    answers 401.
+    """
+    def _decorated(view, request, *args, **kwargs):
+        if not hasattr(request, 'auth_payload'):
+            # The middleware is not installed.
+            authenticate(request)
+        if request.auth_payload is None:
+            return Response({'error': request.auth_error}, status=401)
+        return func(view, request, request.auth_payload, *args, **kwargs)
+
+    return _decorated
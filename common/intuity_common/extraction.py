@@ -0,0 +1,338 @@
+"""
+Declarative feature extraction applied to batches of observation dicts
+before they are vectorized.
+
+A schema maps field names to transforms:
+
+    {
+        "created_at": {"type": "datetime", "parts": ["hour", "weekday"]},
+        "price": {"type": "bucket", "bounds": [10, 100]},
+        "domain_id": "number",
+        "city": "passthrough"
+    }
+
+Transforms run column-wise over a whole batch and only look at each
+distinct value once.
+"""
+import numbers
+import re
+
+import numpy as np
+
+import logging
+
+log = logging.getLogger('intuity_common.extraction')
+
+try:
+    string_types = (str, unicode)
+except NameError:
+    string_types = (str,)
+
+numbers_types = numbers.Number
+
+# ISO 8601 timestamps as written by ElasticSearch and most JSON encoders.
+DATETIME_RE = re.compile(
+    r'^(\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d{1,9})?)?)?)(Z|[+-]\d{2}:?\d{2})?$'
+)
+
+NUMBER_RE = re.compile(r'^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$')
+
+DATETIME_PARTS = ('year', 'month', 'day', 'hour', 'minute', 'weekday')
+
+# Bound on the per-transform memo of parsed values.
+CACHE_SIZE = 100000
+
+
+class SchemaError(Exception):
+    pass
+
+
+def parse_datetimes(values):
+    """
+    Parses a sequence of distinct strings into a datetime64[s] array in UTC.
+    Strings that are not ISO timestamps become NaT; they are filtered with
+    a regex so no exception is raised per value. Only when a batch holds an
+    impossible date such as 2016-02-30 is it parsed again value by value.
+    """
+    parsed = np.empty(len(values), dtype='datetime64[s]')
+    parsed[:] = np.datetime64('NaT')
+    positions, naive, offsets = [], [], []
+    for i, value in enumerate(values):
+        match = DATETIME_RE.match(value)
+        if match is None:
+            continue
+        positions.append(i)
+        naive.append(match.group(1).replace(' ', 'T'))
+        zone = match.group(2)
+        if not zone or zone == 'Z':
+            offsets.append(0)
+        else:
+            zone = zone.replace(':', '')
+            minutes = int(zone[1:3]) * 60 + int(zone[3:5])
+            offsets.append(-minutes if zone[0] == '-' else minutes)
+    if positions:
+        try:
+            naive = np.array(naive, dtype='datetime64[us]')
+        except ValueError:
+            naive = np.array([parse_datetime(value) for value in naive], dtype='datetime64[us]')
+        times = naive - np.array(offsets, dtype='timedelta64[m]')
+        parsed[positions] = times.astype('datetime64[s]')
+    return parsed
+
+
+def parse_datetime(value):
+    try:
+        return np.datetime64(value, 'us')
+    except ValueError:
+        return np.datetime64('NaT')
+
+
+def datetime_part(times, part):
+    if part == 'year':
+        return times.astype('datetime64[Y]').astype(np.int64) + 1970
+    if part == 'month':
+        return times.astype('datetime64[M]').astype(np.int64) % 12 + 1
+    if part == 'day':
+        return (times.astype('datetime64[D]') - times.astype('datetime64[M]')).astype(np.int64) + 1
+    if part == 'hour':
+        return (times.astype('datetime64[h]') - times.astype('datetime64[D]')).astype(np.int64)
+    if part == 'minute':
+        return (times.astype('datetime64[m]') - times.astype('datetime64[h]')).astype(np.int64)
+    if part == 'weekday':
+        # 1970-01-01 was a Thursday; Monday is 0.
+        return (times.astype('datetime64[D]').astype(np.int64) + 3) % 7
+    raise SchemaError('Unknown datetime part {}'.format(part))
+
+
+def memo_key(value):
+    if isinstance(value, (list, dict)):
+        return None
+    return type(value), value
+
+
+def distinct(column):
+    """
+    Returns (values, inverse) where column[i] == values[inverse[i]], keeping
+    None out of the distinct values (its inverse is -1). Works on mixed type
+    columns, unlike np.unique.
+    """
+    index = {}
+    values = []
+    inverse = np.empty(len(column), dtype=np.int64)
+    for i, value in enumerate(column):
+        if value is None:
+            inverse[i] = -1
+            continue
+        key = memo_key(value)
+        j = index.get(key) if key is not None else None
+        if j is None:
+            j = len(values)
+            values.append(value)
+            if key is not None:
+                index[key] = j
+        inverse[i] = j
+    return values, inverse
+
+
+def to_numbers(values):
+    result = []
+    for value in values:
+        if isinstance(value, string_types):
+            result.append(float(value) if NUMBER_RE.match(value) else None)
+        elif isinstance(value, numbers_types):
+            result.append(float(value))
+        else:
+            result.append(None)
+    return result
+
+
+class Transform(object):
+    """
+    Maps one input column to one or more output columns. Subclasses
+    implement transform_values(), which gets each distinct value once and
+    returns one list per output column.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.cache = {}
+
+    def outputs(self):
+        return [self.field]
+
+    def transform_values(self, values):
+        raise NotImplementedError
+
+    def apply(self, column):
+        values, inverse = distinct(column)
+        results = [None] * len(values)
+        missing = []
+        for j, value in enumerate(values):
+            key = memo_key(value)
+            if key is not None and key in self.cache:
+                results[j] = self.cache[key]
+            else:
+                missing.append(j)
+        if missing:
+            if len(self.cache) > CACHE_SIZE:
+                self.cache.clear()
+            computed = zip(*self.transform_values([values[j] for j in missing]))
+            for j, result in zip(missing, computed):
+                results[j] = result
+                key = memo_key(values[j])
+                if key is not None:
+                    self.cache[key] = result
+        columns = []
+        for k, name in enumerate(self.outputs()):
+            distinct_results = [r[k] for r in results]
+            columns.append((name, [None if j < 0 else distinct_results[j] for j in inverse]))
+        return columns
+
+
+class Passthrough(Transform):
+
+    def transform_values(self, values):
+        return [values]
+
+
+class Number(Transform):
+
+    def transform_values(self, values):
+        return [to_numbers(values)]
+
+
+class Bucket(Transform):
+    """
+    Replaces a number by the label of the interval it falls in, so it is
+    one-hot encoded. `bounds` must be increasing.
+    """
+
+    def __init__(self, field, bounds, labels=None):
+        super(Bucket, self).__init__(field)
+        self.bounds = np.asarray(bounds, dtype=np.float64)
+        if not len(self.bounds) or np.any(np.diff(self.bounds) <= 0):
+            raise SchemaError('{}: bounds must be increasing'.format(field))
+        if labels is None:
+            edges = ['{:g}'.format(b) for b in self.bounds]
+            labels = ['<' + edges[0]] + ['{}-{}'.format(a, b) for a, b in zip(edges, edges[1:])] + ['>=' + edges[-1]]
+        if len(labels) != len(self.bounds) + 1:
+            raise SchemaError('{}: expected {} labels'.format(field, len(self.bounds) + 1))
+        self.labels = list(labels)
+
+    def transform_values(self, values):
+        values = to_numbers(values)
+        known = np.array([n is not None for n in values])
+        array = np.array([n if n is not None else 0.0 for n in values], dtype=np.float64)
+        buckets = np.digitize(array, self.bounds)
+        return [[self.labels[b] if k else None for b, k in zip(buckets, known)]]
+
+
+class Datetime(Transform):
+    """
+    Extracts calendar parts from ISO timestamps, each into its own column
+    named "<field>_<part>".
+    """
+
+    def __init__(self, field, parts=('hour',)):
+        super(Datetime, self).__init__(field)
+        if isinstance(parts, string_types):
+            parts = [parts]
+        for part in parts:
+            if part not in DATETIME_PARTS:
+                raise SchemaError('{}: unknown datetime part {}'.format(field, part))
+        self.parts = list(parts)
+
+    def outputs(self):
+        return ['{}_{}'.format(self.field, part) for part in self.parts]
+
+    def transform_values(self, values):
+        strings = [v if isinstance(v, string_types) else '' for v in values]
+        times = parse_datetimes(strings)
+        valid = ~np.isnat(times)
+        safe = np.where(valid, times, np.datetime64(0, 's'))
+        columns = []
+        for part in self.parts:
+            column = datetime_part(safe, part)
+            columns.append([int(x) if v else None for x, v in zip(column, valid)])
+        return columns
+
+
+class Auto(Datetime):
+    """
+    Keeps values as they are, except strings that are timestamps, which
+    are replaced by their hour under the same field name.
+    """
+
+    def __init__(self, field):
+        super(Auto, self).__init__(field, ('hour',))
+
+    def outputs(self):
+        return [self.field]
+
+    def transform_values(self, values):
+        hours = super(Auto, self).transform_values(values)[0]
+        return [[v if h is None else h for v, h in zip(values, hours)]]
+
+
+TRANSFORMS = {
+    'passthrough': Passthrough,
+    'number': Number,
+    'bucket': Bucket,
+    'datetime': Datetime,
+    'auto': Auto,
+}
+
+
+class Schema(object):
+    """
+    Ordered set of field transforms. Fields that are not in the schema are
+    dropped unless `passthrough` is set.
+    """
+
+    def __init__(self, transforms, passthrough=False):
+        self.transforms = list(transforms)
+        self.passthrough = passthrough
+        self.fields = set(t.field for t in self.transforms)
+
+    @classmethod
+    def from_dict(cls, config, passthrough=False):
+        if not isinstance(config, dict):
+            raise SchemaError('schema must be an object')
+        transforms = []
+        for field in sorted(config):
+            spec = config[field]
+            if isinstance(spec, string_types):
+                spec = {'type': spec}
+            if not isinstance(spec, dict):
+                raise SchemaError('{}: transform must be a name or an object'.format(field))
+            options = dict(spec)
+            kind = options.pop('type', 'passthrough')
+            if kind not in TRANSFORMS:
+                raise SchemaError('{}: unknown transform {}'.format(field, kind))
+            try:
+                transforms.append(TRANSFORMS[kind](field, **options))
+            except TypeError as e:
+                raise SchemaError('{}: {}'.format(field, e))
+        return cls(transforms, passthrough=passthrough)
+
+    @classmethod
+    def auto(cls, fields):
+        return cls([Auto(field) for field in fields])
+
+    def extract(self, rows):
+        """
+        Returns new dicts for `rows`. Missing and unparseable values are left
+        out of the result rather than set to None.
+        """
+        rows = list(rows)
+        if self.passthrough:
+            extracted = [dict((k, v) for k, v in row.items() if k not in self.fields) for row in rows]
+        else:
+            extracted = [{} for _ in rows]
+        for transform in self.transforms:
+            column = [row.get(transform.field) for row in rows]
+            for name, values in transform.apply(column):
+                for row, value in zip(extracted, values):
+                    if value is not None:
+                        row[name] = value
+        return extracted
@@ -0,0 +1,216 @@
+"""
+Polling worker shared by intuity's training jobs and curiosity's question
+chunks.
+
+Tasks are rows of a model with `state`, `worker`, `heartbeat` and
+`attempts` columns. The worker claims queued tasks and runs each in a pool
+process, where a thread renews the task's lease by touching `heartbeat`
+while it runs. A task whose lease has expired belonged to a worker or pool
+process that died: whichever worker notices first requeues it, or fails it
+once it has used up its attempts or cannot safely run twice. A starting
+worker also takes back at once the tasks of dead workers on its own host.
+"""
+import errno
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from datetime import timedelta
+
+from django import db
+from django.db.models import F, Q
+from django.utils import timezone
+
+import logging
+
+log = logging.getLogger('intuity_common.jobs')
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FAILED = 'failed'
+
+# Leases are renewed this many times before they expire.
+RENEWALS = 4
+
+
+def close_connections():
+    # Forked workers must not share the parent's database connection.
+    db.connections.close_all()
+
+
+def worker_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def is_dead(name):
+    """
+    Whether `name` is a worker of this host whose process has exited.
+    """
+    host, _, pid = name.rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit() or int(pid) == os.getpid():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+    return False
+
+
+class Heartbeat(object):
+    """
+    Renews the lease on a running task from a background thread until the
+    block exits.
+    """
+
+    def __init__(self, model, pk, interval):
+        self.model = model
+        self.pk = pk
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.interval):
+                try:
+                    self.model.objects.filter(pk=self.pk, state=RUNNING).update(heartbeat=timezone.now())
+                except Exception:
+                    log.exception("Could not renew the lease on %s", self.pk)
+        finally:
+            db.connection.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+
+class Queue(object):
+    """
+    Subclasses set `model` and implement `execute`, which runs a claimed
+    task in a pool process and records its outcome. `lease` is in seconds.
+    """
+    model = None
+
+    def __init__(self, lease, attempts, name=None):
+        self.lease = lease
+        self.attempts = attempts
+        self.name = name or worker_name()
+
+    def queued(self):
+        return self.model.objects.filter(state=QUEUED)
+
+    def next(self, limit):
+        """
+        Claims up to `limit` queued tasks and returns their keys.
+        """
+        claimed = []
+        for task in self.queued()[:limit * 4]:
+            if len(claimed) >= limit:
+                break
+            if self.claim(task):
+                claimed.append(task.pk)
+        return claimed
+
+    def claim(self, task, **fields):
+        claimed = self.model.objects.filter(pk=task.pk, state=QUEUED).update(
+            state=RUNNING, worker=self.name, heartbeat=timezone.now(), attempts=F('attempts') + 1, **fields
+        )
+        return bool(claimed)
+
+    def run(self, pk):
+        with Heartbeat(self.model, pk, float(self.lease) / RENEWALS):
+            return self.execute(pk)
+
+    def execute(self, pk):
+        raise NotImplementedError
+
+    def retryable(self, task):
+        return task.attempts < self.attempts
+
+    def failed(self, task, error):
+        """
+        Called once a task is failed by the worker rather than by itself.
+        """
+
+    def fail(self, pk, error):
+        failed = self.model.objects.filter(pk=pk, state=RUNNING).update(state=FAILED, heartbeat=None)
+        if failed:
+            self.failed(self.model.objects.get(pk=pk), error)
+        return bool(failed)
+
+    def reclaim(self, starting=False):
+        """
+        Requeues or fails the running tasks whose lease has expired, and on
+        start those of dead workers on this host.
+        """
+        expired = Q(heartbeat=None) | Q(heartbeat__lt=timezone.now() - timedelta(seconds=self.lease))
+        tasks = list(self.model.objects.filter(expired, state=RUNNING))
+        if starting:
+            tasks.extend(
+                task for task in self.model.objects.filter(state=RUNNING).exclude(expired).exclude(worker=self.name)
+                if is_dead(task.worker)
+            )
+        for task in tasks:
+            # Compare and set, so a task renewed or reclaimed meanwhile is left alone.
+            current = self.model.objects.filter(pk=task.pk, state=RUNNING, worker=task.worker, heartbeat=task.heartbeat)
+            if self.retryable(task):
+                if current.update(state=QUEUED, worker='', heartbeat=None):
+                    log.warning("Requeued %s abandoned by %s", task.pk, task.worker)
+            elif current.update(state=FAILED, heartbeat=None):
+                log.warning("Failed %s abandoned by %s", task.pk, task.worker)
+                self.failed(task, 'Worker lost')
+
+    def leased(self, pks):
+        """
+        Keys among `pks` this worker still holds the lease of.
+        """
+        return set(self.model.objects.filter(pk__in=list(pks), state=RUNNING, worker=self.name)
+                   .values_list('pk', flat=True))
+
+
+def run_task(queue, pk):
+    return queue.run(pk)
+
+
+def work(queue, processes, interval):
+    close_connections()
+    queue.reclaim(starting=True)
+    pool = multiprocessing.Pool(processes, initializer=close_connections)
+    running = {}
+    checked = time.time()
+    log.info("Worker %s started with %s processes", queue.name, processes)
+    try:
+        while True:
+            for pk, result in list(running.items()):
+                if result.ready():
+                    del running[pk]
+                    if not result.successful():
+                        log.error("Task %s crashed", pk)
+                        queue.fail(pk, 'Worker crashed')
+
+            if time.time() - checked >= float(queue.lease) / RENEWALS:
+                checked = time.time()
+                queue.reclaim()
+                # A pool process that dies never completes its result: its
+                # task stops renewing its lease and is taken back above.
+                leased = queue.leased(running)
+                for pk, result in list(running.items()):
+                    if pk not in leased and not result.ready():
+                        log.error("Lost task %s", pk)
+                        del running[pk]
+
+            free = processes - len(running)
+            if free > 0:
+                for pk in queue.next(free):
+                    running[pk] = pool.apply_async(run_task, (queue, pk))
+
+            time.sleep(interval)
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,14 @@
+from rest_framework import parsers
+from rest_framework.exceptions import ParseError
+
+from intuity_common.wire import CONTENT_TYPES, unpack
+
+
+class MsgPackParser(parsers.BaseParser):
+    media_type = CONTENT_TYPES['msgpack']
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return unpack(stream.read(), self.media_type)
+        except Exception as e:
+            raise ParseError('MsgPack parse error - {}'.format(e))
@@ -0,0 +1,28 @@
+from rest_framework import renderers
+from rest_framework.utils import encoders
+
+from intuity_common.wire import CONTENT_TYPES, NumpyEncoderMixin, pack
+
+
+class NumpyEncoder(NumpyEncoderMixin, encoders.JSONEncoder):
+    pass
+
+
+class NumpyJSONRenderer(renderers.JSONRenderer):
+    """
+    JSON renderer that also understands NumPy arrays, scalars and sparse
+    matrices.
+    """
+    encoder_class = NumpyEncoder
+
+
+class MsgPackRenderer(renderers.BaseRenderer):
+    media_type = CONTENT_TYPES['msgpack']
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return pack(data, 'msgpack')
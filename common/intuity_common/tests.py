@@ -0,0 +1,146 @@
+"""
+Run from either service with `python manage.py test intuity_common`.
+"""
+import json
+import time
+
+import jwt
+import numpy as np
+import scipy.sparse as sp
+from django.test import SimpleTestCase
+
+from intuity_common import wire
+from intuity_common.auth import TokenVerifier, TTLCache, token_key
+from intuity_common.extraction import Schema, SchemaError, parse_datetimes
+from intuity_common.renderers import NumpyJSONRenderer
+
+
+class WireTest(SimpleTestCase):
+
+    def test_msgpack_round_trips_arrays(self):
+        array = np.arange(6, dtype='>f8').reshape(2, 3)
+        unpacked = wire.unpack(wire.pack({'data': array, 'n': np.int64(2)}))
+        self.assertEqual(unpacked['data'].dtype, np.dtype('<f8'))
+        np.testing.assert_array_equal(unpacked['data'], array)
+        self.assertEqual(unpacked['n'], 2)
+
+    def test_round_trips_sparse_matrices(self):
+        matrix = sp.csr_matrix(np.array([[0., 1.], [2., 0.], [0., 0.]]))
+        for format in ('msgpack', 'json'):
+            body = wire.pack({'data': matrix}, format)
+            decoded = wire.decode_matrix(wire.unpack(body, wire.CONTENT_TYPES[format])['data'])
+            self.assertTrue(sp.issparse(decoded))
+            np.testing.assert_array_equal(decoded.toarray(), matrix.toarray())
+
+    def test_decodes_dense_rows(self):
+        decoded = wire.decode_matrix([[1, 2], [3, 4]], dtype=np.float32)
+        self.assertEqual((decoded.dtype, decoded.shape), (np.float32, (2, 2)))
+        with self.assertRaises(ValueError):
+            wire.decode_matrix({'format': 'coo'})
+
+    def test_renders_numpy_as_json(self):
+        body = NumpyJSONRenderer().render({'a': np.arange(3), 'b': np.float32(0.5), 'c': sp.eye(2, format='csr')})
+        rendered = json.loads(body.decode('utf-8'))
+        self.assertEqual(rendered['a'], [0, 1, 2])
+        self.assertEqual(rendered['b'], 0.5)
+        self.assertEqual(rendered['c']['indptr'], [0, 1, 2])
+
+
+class ExtractionTest(SimpleTestCase):
+
+    def test_parses_timestamps_in_utc(self):
+        times = parse_datetimes(['2016-02-29T10:30:00+02:00', '2016-02-29 10:30', '2016-02-29', 'soon'])
+        self.assertEqual([str(t) for t in times], [
+            '2016-02-29T08:30:00', '2016-02-29T10:30:00', '2016-02-29T00:00:00', 'NaT'
+        ])
+
+    def test_impossible_dates_become_nat(self):
+        times = parse_datetimes(['2016-02-30', '2016-13-45T00:00:00Z', '2016-01-01T25:00', '2016-02-28T05:00Z'])
+        self.assertEqual([str(t) for t in times], ['NaT', 'NaT', 'NaT', '2016-02-28T05:00:00'])
+        rows = Schema.auto(['t']).extract([{'t': '2016-02-30'}, {'t': '2016-02-28T05:00:00Z'}])
+        self.assertEqual(rows, [{'t': '2016-02-30'}, {'t': 5}])
+
+    def test_applies_a_schema_column_wise(self):
+        schema = Schema.from_dict({
+            'at': {'type': 'datetime', 'parts': ['hour', 'weekday']},
+            'price': {'type': 'bucket', 'bounds': [10, 100]},
+            'id': 'number',
+            'city': 'passthrough',
+        })
+        rows = schema.extract([
+            {'at': '2016-02-29T13:00:00Z', 'price': '50', 'id': '7', 'city': 'Berlin', 'extra': 1},
+            {'at': '2016-02-30', 'price': 500, 'id': 'n/a'},
+        ])
+        self.assertEqual(rows, [
+            {'at_hour': 13, 'at_weekday': 0, 'price': '10-100', 'id': 7.0, 'city': 'Berlin'},
+            {'price': '>=100'},
+        ])
+
+    def test_rejects_invalid_schemas(self):
+        for config in ([], {'a': 'unknown'}, {'a': {'type': 'bucket', 'bounds': [2, 1]}},
+                       {'a': {'type': 'datetime', 'parts': ['century']}}, {'a': {'type': 'number', 'base': 2}}):
+            with self.assertRaises(SchemaError):
+                Schema.from_dict(config)
+
+
+def make_token(key='secret', **claims):
+    token = jwt.encode(dict({'uuid': 'u', 'iss': 'authority', 'aud': ['curiosity']}, **claims), key=key)
+    return token.decode('ascii') if isinstance(token, bytes) else token
+
+
+class AuthTest(SimpleTestCase):
+
+    def make_verifier(self, internal_key='internal'):
+        return TokenVerifier('secret', audience='curiosity', issuer='authority', cache_size=2, ttl=300,
+                             internal_key=internal_key)
+
+    def test_cache_expires_and_drops_oldest_entries(self):
+        cache = TTLCache(2, ttl=300)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('c', 3)
+        cache.set('d', 4, ttl=-1)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c'), cache.get('d')), (None, 2, 3, None))
+
+    def test_verifies_and_caches_tokens(self):
+        verifier = self.make_verifier()
+        token = make_token(exp=int(time.time()) + 60)
+        self.assertEqual(verifier.verify(token)['uuid'], 'u')
+        self.assertLessEqual(verifier.cache.items.popitem()[1][1], time.time() + 60)
+        with self.assertRaises(jwt.InvalidTokenError):
+            verifier.verify(make_token(key='other'))
+        with self.assertRaises(jwt.InvalidTokenError):
+            verifier.verify(make_token(exp=int(time.time()) - 1))
+
+    def test_accepts_contexts_signed_by_another_service(self):
+        token = make_token()
+        caller = self.make_verifier()
+        self.assertIsNone(caller.context(token))
+        caller.verify(token)
+        context = caller.context(token)
+        callee = self.make_verifier()
+        self.assertEqual(callee.verify_context(token, context)['uuid'], 'u')
+        self.assertIsNone(callee.verify_context(make_token(data={}), context))
+        self.assertIsNone(self.make_verifier('forged').verify_context(token, context))
+        self.assertIsNone(self.make_verifier(None).verify_context(token, context))
+
+    def test_rejects_contexts_of_expired_tokens(self):
+        token = make_token()
+        caller, callee = self.make_verifier(), self.make_verifier()
+        caller.cache.set(token_key(token), {'uuid': 'u', 'exp': time.time() + 30})
+        self.assertIsNotNone(callee.verify_context(token, caller.context(token)))
+        self.assertLessEqual(callee.cache.items[token_key(token)][1], time.time() + 30)
+        callee.cache.items.clear()
+        caller.cache.set(token_key(token), {'uuid': 'u', 'exp': time.time() - 1})
+        self.assertIsNone(callee.verify_context(token, caller.context(token)))
+        self.assertEqual(len(callee.cache), 0)
+
+    def test_accepts_payload_contexts_only_without_a_token(self):
+        token = make_token()
+        caller, callee = self.make_verifier(), self.make_verifier()
+        caller.verify(token)
+        context = caller.payload_context({'uuid': 'u'})
+        self.assertEqual(callee.verify_context(None, context), {'uuid': 'u'})
+        self.assertIsNone(callee.verify_context(token, context))
+        self.assertIsNone(callee.verify_context(None, caller.context(token)))
+        self.assertEqual(len(callee.cache), 0)
@@ -0,0 +1,107 @@
+"""
+Wire format shared by curiosity and intuity.
+
+Matrices travel as dense arrays or, when sparse, as their CSR components:
+{"format": "csr", "shape": [rows, cols], "data": [...], "indices": [...],
+"indptr": [...]}. In msgpack, arrays are raw little endian buffers tagged
+with their dtype and shape, which the object hook turns back into arrays
+without parsing each number; in JSON they are nested lists.
+"""
+import json
+
+import msgpack
+import numpy as np
+import scipy.sparse as sp
+
+CONTENT_TYPES = {
+    'msgpack': 'application/msgpack',
+    'json': 'application/json',
+}
+
+
+def encode_matrix(matrix):
+    if sp.issparse(matrix):
+        matrix = matrix.tocsr()
+        return {
+            'format': 'csr',
+            'shape': list(matrix.shape),
+            'data': matrix.data,
+            'indices': matrix.indices,
+            'indptr': matrix.indptr,
+        }
+    return np.asarray(matrix)
+
+
+def decode_matrix(value, dtype=None):
+    """
+    Turns a received matrix into an array, or a CSR matrix when it was sent
+    as one.
+    """
+    if isinstance(value, dict):
+        if value.get('format') != 'csr':
+            raise ValueError('Unsupported matrix format {}'.format(value.get('format')))
+        return sp.csr_matrix(
+            (np.asarray(value['data'], dtype=dtype), np.asarray(value['indices']), np.asarray(value['indptr'])),
+            shape=tuple(value['shape'])
+        )
+    if sp.issparse(value):
+        return value.tocsr() if dtype is None else value.tocsr().astype(dtype)
+    return np.asarray(value, dtype=dtype)
+
+
+def default(obj):
+    if isinstance(obj, np.ndarray):
+        dtype = obj.dtype.newbyteorder('<')
+        return {
+            '__ndarray__': True,
+            'dtype': dtype.str,
+            'shape': list(obj.shape),
+            'data': np.ascontiguousarray(obj, dtype=dtype).tobytes(),
+        }
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if sp.issparse(obj):
+        return encode_matrix(obj)
+    raise TypeError('Cannot serialize {!r}'.format(type(obj)))
+
+
+def object_hook(obj):
+    if obj.get('__ndarray__'):
+        return np.frombuffer(obj['data'], dtype=np.dtype(obj['dtype'])).reshape(obj['shape'])
+    return obj
+
+
+class NumpyEncoderMixin(object):
+    """
+    Lets a JSON encoder write NumPy arrays, scalars and sparse matrices.
+    """
+
+    def default(self, obj):
+        if sp.issparse(obj):
+            return encode_matrix(obj)
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        if isinstance(obj, np.generic):
+            return obj.item()
+        return super(NumpyEncoderMixin, self).default(obj)
+
+
+class NumpyJSONEncoder(NumpyEncoderMixin, json.JSONEncoder):
+    pass
+
+
+def pack(obj, format='msgpack'):
+    if format == 'msgpack':
+        return msgpack.packb(obj, default=default, use_bin_type=True)
+    return json.dumps(obj, cls=NumpyJSONEncoder).encode('utf-8')
+
+
+def unpack(data, content_type=CONTENT_TYPES['msgpack']):
+    if content_type.startswith(CONTENT_TYPES['msgpack']):
+        return msgpack.unpackb(data, object_hook=object_hook, raw=False)
+    return json.loads(data.decode('utf-8'))
+
+
+def headers(format='msgpack'):
+    content_type = CONTENT_TYPES[format]
+    return {'Content-Type': content_type, 'Accept': content_type}
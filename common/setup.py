@@ -0,0 +1,8 @@
+from setuptools import setup
+
+setup(
+    name='intuity-common',
+    version='0.1.0',
+    packages=['intuity_common'],
+    install_requires=['numpy', 'scipy', 'msgpack'],
+)
@@ -51,6 +51,7 @@ MIDDLEWARE_CLASSES = [
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'intuity_common.auth.TokenMiddleware',
 ]
 
 ROOT_URLCONF = 'curiosity.urls'
@@ -123,6 +124,74 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# Send feature matrices to intuity in CSR form instead of dense lists.
+SPARSE_FEATURES = True
+
+# Rows committed per transaction by the streaming upload endpoint.
+INGEST_BATCH_SIZE = 1000
+
+# Duplicate records are found through a unique index on their content hash,
+# fronted by a per-process Bloom filter per observation sized for
+# DEDUP_BLOOM_CAPACITY hashes at DEDUP_BLOOM_ERROR_RATE false positives.
+# A process keeps the filters of at most DEDUP_BLOOM_FILTERS observations
+# and DEDUP_BLOOM_MAX_BYTES bytes, dropping the least recently used.
+DEDUP_BLOOM = True
+DEDUP_BLOOM_CAPACITY = 100000
+DEDUP_BLOOM_ERROR_RATE = 0.01
+DEDUP_BLOOM_FILTERS = 256
+DEDUP_BLOOM_MAX_BYTES = 64 * 1024 * 1024
+
+# Seconds an Idempotency-Key and its response are kept.
+IDEMPOTENCY_KEY_MAX_AGE = 24 * 60 * 60
+# Seconds after which a request still holding its key is taken to be dead
+# and a repeat may run; longer than any request, INTUITY_TIMEOUT included.
+IDEMPOTENCY_IN_FLIGHT_TIMEOUT = 5 * 60
+
+# Default and maximum page sizes of observation exports.
+EXPORT_PAGE_SIZE = 1000
+EXPORT_MAX_PAGE_SIZE = 10000
+
+# Wire format used for requests to intuity: 'msgpack' or 'json'.
+INTUITY_FORMAT = 'msgpack'
+
+# intuity endpoints, used round robin over pooled keep-alive connections.
+INTUITY_ENDPOINTS = ['http://localhost:8084']
+INTUITY_POOL_SIZE = 10
+# (connect, read) timeouts in seconds.
+INTUITY_TIMEOUT = (3.05, 60)
+INTUITY_RETRIES = 2
+INTUITY_BACKOFF = 0.1
+# Consecutive failures before failing fast, and seconds before trying again.
+INTUITY_BREAKER_THRESHOLD = 5
+INTUITY_BREAKER_RESET = 30
+
+# Async questions are split in chunks of QUESTION_CHUNK_SIZE rows, answered
+# by `manage.py questionworker` with QUESTION_WORKERS processes polling
+# every QUESTION_POLL_INTERVAL seconds. Streamed results are checked for
+# new chunks every QUESTION_STREAM_INTERVAL seconds, and a stream ends after
+# QUESTION_STREAM_TIMEOUT seconds with the cursor to resume from.
+QUESTION_CHUNK_SIZE = 1000
+QUESTION_WORKERS = 2
+QUESTION_POLL_INTERVAL = 0.5
+QUESTION_STREAM_INTERVAL = 0.5
+QUESTION_STREAM_TIMEOUT = 300
+# Seconds a running chunk may go without a heartbeat before another worker
+# requeues it, and how many times a chunk is tried, counting the retries of
+# chunks intuity could not answer for the time being.
+QUESTION_CHUNK_LEASE = 60
+QUESTION_CHUNK_ATTEMPTS = 3
+# Chunks of answers returned per poll of a question job.
+QUESTION_PAGE_CHUNKS = 10
+
+# Token verification, documented in intuity_common.auth.
+AUTH_AUDIENCE = 'curiosity'
+AUTH_ISSUER = 'authority'
+AUTH_CACHE_SIZE = 10000
+AUTH_CACHE_TTL = 300
+AUTH_INTERNAL_KEY = SECRET_KEY
+AUTH_INTERNAL_MAX_AGE = 60
+
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
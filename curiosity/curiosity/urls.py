@@ -15,10 +15,17 @@ Including another URLconf
 """
 from django.conf.urls import url
 from django.contrib import admin
-from observation.views import ObservationApi, QuestionApi
+from observation.views import (
+    ObservationApi, ObservationUploadApi, SchemaApi, QuestionApi, QuestionJobApi, TrainingJobApi, ServiceStatsApi
+)
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
     url(r'^v1/observation/$', ObservationApi.as_view()),
+    url(r'^v1/observation/upload/$', ObservationUploadApi.as_view()),
+    url(r'^v1/observation/schema/$', SchemaApi.as_view()),
+    url(r'^v1/observation/jobs/(?P<job_id>[0-9a-f]+)/$', TrainingJobApi.as_view()),
     url(r'^v1/question/$', QuestionApi.as_view()),
+    url(r'^v1/question/jobs/(?P<job_id>[0-9a-f]+)/$', QuestionJobApi.as_view()),
+    url(r'^v1/service/intuity/$', ServiceStatsApi.as_view()),
 ]
@@ -0,0 +1,194 @@
+import itertools
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from intuity_common import wire
+from intuity_common.auth import internal_headers
+
+import logging
+
+log = logging.getLogger('curiosity.observation.client')
+
+
+class ServiceUnavailable(Exception):
+    pass
+
+
+class CircuitOpen(ServiceUnavailable):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Opens after `threshold` consecutive failures and rejects calls until
+    `reset_timeout` seconds have passed, then lets a single trial call
+    through to decide whether to close again.
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.time() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    log.warning("Circuit opened after %s failures", self.failures)
+                self.opened_at = time.time()
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'errors': 0, 'retries': 0, 'rejected': 0}
+        self.latency_count = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def incr(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def observe(self, latency):
+        with self.lock:
+            self.latency_count += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    def as_dict(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['latency_avg'] = self.latency_total / self.latency_count if self.latency_count else None
+            stats['latency_max'] = self.latency_max
+            return stats
+
+
+class ServiceClient(object):
+    """
+    Keep-alive HTTP client for another service: pooled connections, per call
+    timeouts, bounded retries with exponential backoff and a circuit breaker.
+    """
+
+    RETRY_STATUSES = (502, 503, 504)
+
+    def __init__(self, endpoints, timeout, retries, backoff, pool_size, breaker):
+        self.endpoints = itertools.cycle(endpoints)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker
+        self.stats = Stats()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(endpoints), pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, path, token, payload=None, idempotent=True, auth_payload=None):
+        """
+        Returns (status_code, decoded body). Calls that are not idempotent
+        are only retried when the connection could not be established.
+        Background calls pass no token but its verified `auth_payload`.
+        """
+        if not self.breaker.allow():
+            self.stats.incr('rejected')
+            raise CircuitOpen('Circuit open for {}'.format(path))
+        try:
+            status, body = self.send(method, path, token, payload, idempotent, auth_payload)
+        except Exception:
+            # Every failure is recorded, so a half-open breaker never keeps its trial.
+            self.breaker.failure()
+            raise
+        self.breaker.success()
+        return status, body
+
+    def send(self, method, path, token, payload, idempotent, auth_payload):
+        data = wire.pack(payload, settings.INTUITY_FORMAT) if payload is not None else None
+        headers = dict(wire.headers(settings.INTUITY_FORMAT), **internal_headers(token, auth_payload))
+        params = {'token': token} if token else {}
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.stats.incr('retries')
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            url = '{}{}'.format(next(self.endpoints), path)
+            self.stats.incr('requests')
+            start = time.time()
+            try:
+                response = self.session.request(
+                    method, url, params=params, data=data, timeout=self.timeout, headers=headers
+                )
+            except requests.exceptions.ConnectTimeout as e:
+                error = e
+            except requests.exceptions.RequestException as e:
+                error = e
+                if not idempotent:
+                    break
+            else:
+                latency = time.time() - start
+                self.stats.observe(latency)
+                log.debug("%s %s: %s in %.3fs", method, url, response.status_code, latency)
+                if response.status_code in self.RETRY_STATUSES:
+                    self.stats.incr('errors')
+                    error = ServiceUnavailable('{} returned {}'.format(url, response.status_code))
+                    if idempotent:
+                        continue
+                    break
+                try:
+                    body = wire.unpack(response.content, response.headers.get('Content-Type', ''))
+                except ValueError:
+                    body = None
+                return response.status_code, body
+            self.stats.incr('errors')
+            log.warning("%s %s failed: %s", method, url, error)
+
+        raise ServiceUnavailable(str(error))
+
+    def get(self, path, token, auth_payload=None):
+        return self.request('GET', path, token, auth_payload=auth_payload)
+
+    def post(self, path, token, payload, idempotent=True, auth_payload=None):
+        return self.request('POST', path, token, payload, idempotent=idempotent, auth_payload=auth_payload)
+
+
+intuity = ServiceClient(
+    settings.INTUITY_ENDPOINTS,
+    timeout=settings.INTUITY_TIMEOUT,
+    retries=settings.INTUITY_RETRIES,
+    backoff=settings.INTUITY_BACKOFF,
+    pool_size=settings.INTUITY_POOL_SIZE,
+    breaker=CircuitBreaker(settings.INTUITY_BREAKER_THRESHOLD, settings.INTUITY_BREAKER_RESET)
+)
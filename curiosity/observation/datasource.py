@@ -0,0 +1,173 @@
+import csv
+import json
+
+from django.utils import six
+
+import logging
+
+log = logging.getLogger('curiosity.observation.datasource')
+
+FORMATS = {
+    'ndjson': 'ndjson',
+    'csv': 'csv',
+    'tsv': 'tsv',
+    'application/x-ndjson': 'ndjson',
+    'application/json-seq': 'ndjson',
+    'text/csv': 'csv',
+    'text/tab-separated-values': 'tsv',
+}
+
+BOOLEANS = {'true': True, 'false': False}
+
+
+class BadRow(Exception):
+
+    def __init__(self, line, message):
+        super(BadRow, self).__init__('line {}: {}'.format(line, message))
+        self.line = line
+
+
+def iter_lines(stream, chunk_size=64 * 1024):
+    """
+    Splits a byte stream into newline terminated lines while reading it in
+    fixed size chunks.
+    """
+    pending = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if pending:
+        yield pending
+
+
+def iter_ndjson(lines):
+    for n, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line.decode('utf-8'))
+        except ValueError as e:
+            raise BadRow(n, 'invalid JSON ({})'.format(e))
+        if not isinstance(row, dict):
+            raise BadRow(n, 'object expected')
+        yield n, row
+
+
+def iter_delimited(lines, delimiter):
+    if six.PY2:
+        reader = csv.reader(lines, delimiter=delimiter.encode('ascii'))
+        rows = ([cell.decode('utf-8') for cell in row] for row in reader)
+    else:
+        rows = csv.reader((line.decode('utf-8') for line in lines), delimiter=delimiter)
+    header = None
+    for n, row in enumerate(rows, 1):
+        if not row:
+            continue
+        if header is None:
+            header = [name.strip() for name in row]
+            continue
+        if len(row) != len(header):
+            raise BadRow(n, 'expected {} columns, got {}'.format(len(header), len(row)))
+        yield n, dict(zip(header, row))
+
+
+def infer_type(value):
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, six.integer_types):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    if not isinstance(value, six.string_types):
+        return None
+    if value.lower() in BOOLEANS:
+        return 'bool'
+    for kind, cast in (('int', int), ('float', float)):
+        try:
+            cast(value)
+            return kind
+        except ValueError:
+            pass
+    return 'str'
+
+
+# Types a column may widen to when a later value does not fit.
+WIDENING = {
+    ('int', 'float'): 'float',
+    ('float', 'int'): 'float',
+}
+
+
+class Schema(object):
+    """
+    Column types are inferred from the first value seen for each column and
+    every later value is checked (and cast) against them. Integers may widen
+    to floats, anything else is a type error.
+    """
+
+    def __init__(self):
+        self.columns = {}
+
+    def cast(self, column, value, line):
+        if value == '' or value is None:
+            return None
+        kind = infer_type(value)
+        if kind is None:
+            raise BadRow(line, 'column {} has a non scalar value'.format(column))
+        known = self.columns.get(column)
+        if known is None:
+            self.columns[column] = known = kind
+        elif known != kind:
+            widened = WIDENING.get((known, kind))
+            if widened is None and known == 'str':
+                # Text columns accept anything, kept as its text form.
+                return value if isinstance(value, six.string_types) else six.text_type(value)
+            if widened is None:
+                raise BadRow(line, 'column {} expected {}, got {!r}'.format(column, known, value))
+            self.columns[column] = known = widened
+        if not isinstance(value, six.string_types):
+            return float(value) if known == 'float' else value
+        if known == 'bool':
+            return BOOLEANS[value.lower()]
+        if known == 'int':
+            return int(value)
+        if known == 'float':
+            return float(value)
+        return value
+
+
+def iter_batches(stream, format, target, batch_size):
+    """
+    Yields lists of {"data": ..., "target": ...} observations of at most
+    `batch_size` rows, parsed incrementally from `stream`.
+    """
+    lines = iter_lines(stream)
+    if format == 'ndjson':
+        rows = iter_ndjson(lines)
+    else:
+        rows = iter_delimited(lines, '\t' if format == 'tsv' else ',')
+
+    schema = Schema()
+    batch = []
+    for line, row in rows:
+        if target not in row:
+            raise BadRow(line, 'missing target column {}'.format(target))
+        data = {}
+        for column, value in row.items():
+            value = schema.cast(column, value, line)
+            if column == target:
+                target_value = value
+            elif value is not None:
+                data[column] = value
+        batch.append({'data': data, 'target': target_value})
+        if len(batch) >= batch_size:
+            yield batch, schema
+            batch = []
+    if batch:
+        yield batch, schema
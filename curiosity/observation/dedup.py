@@ -0,0 +1,124 @@
+"""
+Content hashes used to make observation ingest idempotent.
+
+Every record is hashed from its canonical JSON; Record keeps the hash under
+a unique (observation, digest) index, which is the authority on what has
+been stored. A per-process Bloom filter of those hashes sits in front of
+it so batches of new rows rarely need to look the index up at all.
+"""
+import hashlib
+import json
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+
+import logging
+
+log = logging.getLogger('curiosity.observation.dedup')
+
+
+def record_digest(data, target):
+    content = json.dumps({'data': data, 'target': target}, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def batch_digest(body):
+    content = json.dumps(body, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class BloomFilter(object):
+    """
+    Bit array sized for `capacity` items at `error_rate` false positives,
+    probed with double hashing over the bits of a hex digest.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        self.count = 0
+
+    def positions(self, digest):
+        h1 = int(digest[:16], 16)
+        h2 = int(digest[16:32], 16) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, digest):
+        for position in self.positions(digest):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, digest):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(digest))
+
+    @property
+    def full(self):
+        return self.count > self.capacity
+
+
+class BloomFilters(object):
+    """
+    One filter per observation, built from the stored digests on first use
+    with room for as many again, and rebuilt when it fills up. A filter may
+    miss digests stored by other processes; the unique index still rejects
+    those. At most `size` filters and `max_bytes` of bits are kept, the
+    least recently used dropped first.
+    """
+
+    def __init__(self, size, max_bytes=None):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.filters = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, observation):
+        with self.lock:
+            bloom = self.filters.pop(observation.pk, None)
+            if bloom is not None:
+                self.filters[observation.pk] = bloom
+        if bloom is not None and not bloom.full:
+            return bloom
+        digests = observation.records.exclude(digest=None).values_list('digest', flat=True)
+        capacity = max(settings.DEDUP_BLOOM_CAPACITY, 2 * digests.count())
+        bloom = BloomFilter(capacity, settings.DEDUP_BLOOM_ERROR_RATE)
+        for digest in digests.iterator():
+            bloom.add(digest)
+        log.debug("Built Bloom filter of %s bits over %s digests for %s", bloom.size, bloom.count, observation.pk)
+        with self.lock:
+            self.pop(observation.pk)
+            self.filters[observation.pk] = bloom
+            self.nbytes += bloom.bits.nbytes
+            while len(self.filters) > 1 and (
+                    len(self.filters) > self.size or (self.max_bytes and self.nbytes > self.max_bytes)):
+                evicted = next(iter(self.filters))
+                self.pop(evicted)
+                log.debug("Dropped Bloom filter of %s", evicted)
+        return bloom
+
+    def add(self, observation, digests):
+        with self.lock:
+            bloom = self.filters.get(observation.pk)
+            if bloom is not None:
+                for digest in digests:
+                    bloom.add(digest)
+
+    def pop(self, pk):
+        bloom = self.filters.pop(pk, None)
+        if bloom is not None:
+            self.nbytes -= bloom.bits.nbytes
+
+    def discard(self, observation):
+        with self.lock:
+            self.pop(observation.pk)
+
+    def __len__(self):
+        return len(self.filters)
+
+
+filters = BloomFilters(getattr(settings, 'DEDUP_BLOOM_FILTERS', 256), getattr(settings, 'DEDUP_BLOOM_MAX_BYTES', None))
@@ -0,0 +1,88 @@
+import numpy as np
+import scipy.sparse as sp
+from django.utils import six
+
+import logging
+
+log = logging.getLogger('curiosity.observation.encoding')
+
+
+def feature_name(key, value):
+    """
+    Column name used for a key/value pair, following DictVectorizer: strings
+    are one-hot encoded as "key=value", everything else is a numeric column.
+    """
+    if isinstance(value, six.string_types):
+        return '{}={}'.format(key, value)
+    return key
+
+
+def feature_value(value):
+    if isinstance(value, six.string_types):
+        return 1.0
+    return float(value)
+
+
+def feature_names(rows):
+    names = []
+    seen = set()
+    for row in rows:
+        for key, value in row.items():
+            if value is None:
+                continue
+            name = feature_name(key, value)
+            if name not in seen:
+                seen.add(name)
+                names.append(name)
+    return names
+
+
+class FeatureIndex(object):
+    """
+    Maps feature names to column indexes and encodes batches of dicts in a
+    single pass. Features unknown to the index are ignored.
+    """
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def encode(self, rows, sparse=False):
+        if sparse:
+            return self.encode_sparse(rows)
+        array = np.zeros((len(rows), len(self.names)))
+        index = self.index
+        for i, row in enumerate(rows):
+            for key, value in row.items():
+                if value is None:
+                    continue
+                j = index.get(feature_name(key, value))
+                if j is not None:
+                    array[i, j] = feature_value(value)
+        return array
+
+    def encode_sparse(self, rows):
+        """
+        Same as encode() but builds a CSR matrix directly, so memory scales
+        with the number of non-zero values rather than rows x features.
+        """
+        data, indices, indptr = [], [], [0]
+        index = self.index
+        for row in rows:
+            for key, value in row.items():
+                if value is None:
+                    continue
+                j = index.get(feature_name(key, value))
+                if j is not None:
+                    value = feature_value(value)
+                    if value:
+                        indices.append(j)
+                        data.append(value)
+            indptr.append(len(indices))
+        return sp.csr_matrix(
+            (np.array(data, dtype=np.float64), np.array(indices, dtype=np.int64), np.array(indptr, dtype=np.int64)),
+            shape=(len(indptr) - 1, len(self.names))
+        )
@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.utils import timezone
+from intuity_common import jobs
+
+from observation.models import QuestionChunk, QuestionJob
+
+import logging
+
+log = logging.getLogger('curiosity.observation.jobs')
+
+
+class ChunkQueue(jobs.Queue):
+    model = QuestionChunk
+
+    def queued(self):
+        # Oldest job first and in order within a job, so answers become
+        # readable from the start.
+        return QuestionChunk.objects.filter(state=QuestionChunk.QUEUED).order_by('job__date_created', 'index')
+
+    def claim(self, chunk, **fields):
+        claimed = super(ChunkQueue, self).claim(chunk, **fields)
+        if claimed:
+            QuestionJob.objects.filter(pk=chunk.job_id, state=QuestionJob.QUEUED).update(
+                state=QuestionJob.RUNNING, date_started=timezone.now()
+            )
+        return claimed
+
+    def execute(self, chunk_id):
+        chunk = QuestionChunk.objects.select_related('job', 'job__observation').get(pk=chunk_id)
+        log.info("Answering chunk %s of question job %s", chunk.index, chunk.job_id)
+        # Transient intuity errors requeue the chunk while it has attempts left.
+        return chunk.execute(retry=self.retryable(chunk))
+
+    def failed(self, chunk, error):
+        chunk.job.chunk_finished(error=error)
+
+
+def work(processes=None, interval=None):
+    queue = ChunkQueue(settings.QUESTION_CHUNK_LEASE, settings.QUESTION_CHUNK_ATTEMPTS)
+    jobs.work(queue, processes or settings.QUESTION_WORKERS, interval or settings.QUESTION_POLL_INTERVAL)
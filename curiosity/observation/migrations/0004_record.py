@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def split_records(apps, schema_editor):
+    Observation = apps.get_model('observation', 'Observation')
+    Record = apps.get_model('observation', 'Record')
+    for observation in Observation.objects.all():
+        try:
+            data = json.loads(observation.data)
+            target = json.loads(observation.target)
+        except ValueError:
+            continue
+        Record.objects.bulk_create([
+            Record(
+                observation=observation,
+                data=json.dumps(d),
+                target=json.dumps(t),
+                date_created=observation.date_created
+            ) for d, t in zip(data, target)
+        ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observation', '0003_observation_features'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Record',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.TextField()),
+                ('target', models.TextField()),
+                ('date_created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('observation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='records', to='observation.Observation')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='record',
+            index_together=set([('observation', 'date_created')]),
+        ),
+        migrations.RunPython(split_records, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='observation',
+            name='data',
+        ),
+        migrations.RemoveField(
+            model_name='observation',
+            name='target',
+        ),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_features(apps, schema_editor):
+    Observation = apps.get_model('observation', 'Observation')
+    Feature = apps.get_model('observation', 'Feature')
+    for observation in Observation.objects.all():
+        try:
+            names = json.loads(observation.features)
+        except ValueError:
+            continue
+        Feature.objects.bulk_create([Feature(observation=observation, name=name) for name in names])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observation', '0004_record'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Feature',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('observation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='feature_set', to='observation.Observation')),
+            ],
+        ),
+        migrations.RunPython(copy_features, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='observation',
+            name='features',
+        ),
+        migrations.AlterField(
+            model_name='feature',
+            name='observation',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='features', to='observation.Observation'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='feature',
+            unique_together=set([('observation', 'name')]),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_labels(apps, schema_editor):
+    Observation = apps.get_model('observation', 'Observation')
+    Label = apps.get_model('observation', 'Label')
+    Record = apps.get_model('observation', 'Record')
+    for observation in Observation.objects.all():
+        records = Record.objects.filter(observation=observation)
+        values = set(records.values_list('target', flat=True))
+        # Keep the codes LabelEncoder used to assign, so already trained
+        # models keep decoding to the same labels.
+        try:
+            values = sorted(values, key=json.loads)
+        except TypeError:
+            values = sorted(values)
+        for value in values:
+            label = Label.objects.create(observation=observation, value=value)
+            records.filter(target=value).update(label=label)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observation', '0005_feature'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Label',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.CharField(max_length=255)),
+                ('observation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='labels', to='observation.Observation')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='label',
+            unique_together=set([('observation', 'value')]),
+        ),
+        migrations.AddField(
+            model_name='record',
+            name='label',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='records', to='observation.Label'),
+        ),
+        migrations.RunPython(create_labels, migrations.RunPython.noop),
+    ]
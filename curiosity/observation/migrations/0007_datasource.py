@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observation', '0006_label'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataSource',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('format', models.CharField(max_length=16)),
+                ('columns', models.TextField(default='{}')),
+                ('rows', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('date_created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('observation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sources', to='observation.Observation')),
+            ],
+        ),
+    ]
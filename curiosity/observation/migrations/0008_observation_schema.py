@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observation', '0007_datasource'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='observation',
+            name='schema',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
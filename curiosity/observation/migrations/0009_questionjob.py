@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import observation.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observation', '0008_observation_schema'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuestionJob',
+            fields=[
+                ('id', models.CharField(default=observation.models.question_job_id, max_length=64, primary_key=True, serialize=False)),
+                ('token', models.TextField()),
+                ('state', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='queued', max_length=16)),
+                ('rows', models.IntegerField(default=0)),
+                ('chunks', models.IntegerField(default=0)),
+                ('finished_chunks', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('date_created', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('date_started', models.DateTimeField(blank=True, null=True)),
+                ('date_finished', models.DateTimeField(blank=True, null=True)),
+                ('observation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='question_jobs', to='observation.Observation')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='QuestionChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.IntegerField()),
+                ('state', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='queued', max_length=16)),
+                ('data', models.TextField()),
+                ('answers', models.TextField(null=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunk_set', to='observation.QuestionJob')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='questionchunk',
+            unique_together=set([('job', 'index')]),
+        ),
+    ]
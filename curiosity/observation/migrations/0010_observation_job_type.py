@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observation', '0009_questionjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='observation',
+            name='job_type',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+    ]
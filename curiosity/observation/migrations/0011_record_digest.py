@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+import json
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def set_digests(apps, schema_editor):
+    # Duplicates already stored keep a null digest, so they never collide.
+    Record = apps.get_model('observation', 'Record')
+    seen = set()
+    rows = Record.objects.order_by('observation', 'id').values_list('id', 'observation', 'data', 'target')
+    for pk, observation, data, target in rows.iterator():
+        content = json.dumps({'data': json.loads(data), 'target': json.loads(target)},
+                             sort_keys=True, separators=(',', ':'))
+        digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        if (observation, digest) in seen:
+            continue
+        seen.add((observation, digest))
+        Record.objects.filter(pk=pk).update(digest=digest)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observation', '0010_observation_job_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='record',
+            name='digest',
+            field=models.CharField(max_length=40, null=True),
+        ),
+        migrations.RunPython(set_digests, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='record',
+            unique_together=set([('observation', 'digest')]),
+        ),
+        migrations.CreateModel(
+            name='IngestBatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255)),
+                ('digest', models.CharField(max_length=40)),
+                ('status', models.IntegerField(blank=True, null=True)),
+                ('response', models.TextField(default='null')),
+                ('date_created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('observation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='batches', to='observation.Observation')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='ingestbatch',
+            unique_together=set([('observation', 'key')]),
+        ),
+    ]
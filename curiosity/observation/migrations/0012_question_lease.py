@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import base64
+import json
+
+from django.db import migrations, models
+
+
+def set_auth_payloads(apps, schema_editor):
+    # The tokens were verified when the jobs were queued: keep their payload.
+    QuestionJob = apps.get_model('observation', 'QuestionJob')
+    for job in QuestionJob.objects.all().iterator():
+        segment = job.token.split('.')[1] if job.token.count('.') == 2 else ''
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(str(segment + '=' * (-len(segment) % 4))).decode('utf-8'))
+        except (TypeError, ValueError):
+            payload = {}
+        QuestionJob.objects.filter(pk=job.pk).update(auth_payload=json.dumps(payload))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observation', '0011_record_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='questionjob',
+            name='auth_payload',
+            field=models.TextField(default='{}'),
+            preserve_default=False,
+        ),
+        migrations.RunPython(set_auth_payloads, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='questionjob',
+            name='token',
+        ),
+        migrations.AddField(
+            model_name='questionchunk',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='questionchunk',
+            name='heartbeat',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='questionchunk',
+            name='worker',
+            field=models.CharField(blank=True, default='', max_length=128),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observation', '0012_question_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='observation',
+            name='untrained',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='ingestbatch',
+            name='untrained',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='ingestbatch',
+            name='date_started',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -1,11 +1,22 @@
 from __future__ import unicode_literals
 
+import collections
+import datetime
 import json
+import uuid
 
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction, IntegrityError
+from django.db.models import F
 from django.utils import timezone
-from sklearn import preprocessing
-from sklearn.feature_extraction import DictVectorizer
+import numpy as np
+from intuity_common.auth import job_type
+from intuity_common.extraction import Schema
+from intuity_common.wire import encode_matrix
+
+from observation.client import ServiceUnavailable, intuity
+from observation.dedup import filters, record_digest
+from observation.encoding import FeatureIndex, feature_names
 
 import logging
 
@@ -16,96 +27,377 @@ class BadFormat(Exception):
     pass
 
 
+class QuestionError(Exception):
+
+    def __init__(self, status, body):
+        super(QuestionError, self).__init__('intuity returned {}: {}'.format(status, body))
+        self.status = status
+        self.body = body
+
+
 class Observation(models.Model):
     uuid = models.CharField(max_length=64, null=False, blank=False, primary_key=True)
-    data = models.TextField(default='[]')
-    features = models.TextField(default='[]')
-    target = models.TextField(default='[]')
     data_type = models.CharField(max_length=32)
     date_created = models.DateTimeField(default=timezone.now)
+    schema = models.TextField(blank=True, default='')
+    job_type = models.CharField(max_length=32, blank=True, default='')
+    # Rows were stored but their training request failed.
+    untrained = models.BooleanField(default=False)
+
+    @classmethod
+    def for_payload(cls, payload):
+        """
+        Gets or creates the observation of a token, taking its job type from
+        the token.
+        """
+        kind = job_type(payload) or ''
+        observation, created = cls.objects.get_or_create(pk=payload['uuid'], defaults={'job_type': kind})
+        if kind and observation.job_type != kind:
+            observation.job_type = kind
+            observation.save(update_fields=['job_type'])
+        return observation, created
+
+    @property
+    def regression(self):
+        return self.job_type == 'regression'
 
     def process(self, data):
+        """
+        Stores the records of a batch that are not stored yet, identified by
+        the hash of their data and target. Returns the new records and the
+        number of duplicates skipped. Every row is checked before anything
+        is written, and the records, their labels and their features are
+        stored in one transaction.
+        """
         log.debug("Start processing observation.")
-        try:
-            current_data = json.loads(self.data)
-            log.debug("Found valid current data.")
-        except ValueError:
-            log.debug("Empty or invalid current data.")
-            current_data = []
 
-        try:
-            current_target = json.loads(self.target)
-            log.debug("Found valid current target.")
-        except ValueError:
-            log.debug("Empty or invalid current target.")
-            current_target = []
+        date_created = timezone.now()
+        records = collections.OrderedDict()
+
+        for row in data:
+            if not isinstance(row, dict) or 'target' not in row:
+                raise BadFormat('missing target')
+            if not isinstance(row.get('data'), dict):
+                raise BadFormat('data must be an object, got {!r}'.format(row.get('data')))
+            if self.regression:
+                try:
+                    float(row['target'])
+                except (TypeError, ValueError):
+                    raise BadFormat('target must be a number, got {!r}'.format(row['target']))
+            digest = record_digest(row['data'], row['target'])
+            records.setdefault(digest, Record(
+                observation=self,
+                data=json.dumps(row['data']),
+                target=json.dumps(row['target'], sort_keys=True),
+                digest=digest,
+                date_created=date_created
+            ))
+
+        existing = self.stored_digests(list(records))
+        records = [record for digest, record in records.items() if digest not in existing]
+        skipped = len(data) - len(records)
+        if not records:
+            log.debug("No new records, %s skipped", skipped)
+            return records, skipped
+
+        names = feature_names(self.extract([json.loads(r.data) for r in records]))
+        with transaction.atomic():
+            if not self.regression:
+                # Regression targets are sent as they are, not label encoded.
+                labels = self.add_labels(set(r.target for r in records))
+                for record in records:
+                    record.label_id = labels[record.target]
 
-        new_data = []
-        new_target = []
-
-        for l in data:
             try:
-                new_target.append(l['target'])
-                new_data.append(l['data'])
-            except KeyError:
-                raise BadFormat
+                with transaction.atomic():
+                    Record.objects.bulk_create(records, batch_size=500)
+            except IntegrityError:
+                # A concurrent batch stored some of them first.
+                inserted = []
+                for record in records:
+                    try:
+                        with transaction.atomic():
+                            record.save()
+                        inserted.append(record)
+                    except IntegrityError:
+                        pass
+                skipped += len(records) - len(inserted)
+                records = inserted
+
+            self.add_features(names)
+        filters.add(self, [r.digest for r in records])
+
+        log.debug("New records: %s, skipped: %s", len(records), skipped)
+        return records, skipped
+
+    def stored_digests(self, digests):
+        """
+        The subset of `digests` already stored. Digests the Bloom filter has
+        never seen are new for certain and are not looked up.
+        """
+        if settings.DEDUP_BLOOM:
+            bloom = filters.get(self)
+            digests = [digest for digest in digests if digest in bloom]
+        stored = set()
+        for start in range(0, len(digests), 500):
+            stored.update(self.records.filter(digest__in=digests[start:start + 500]).values_list('digest', flat=True))
+        return stored
 
-        if new_data:
-            log.debug("New data shape: %s x %s", len(new_data), len(new_data[0]))
-            log.debug("New target shape: %s", len(new_target))
+    @property
+    def extraction(self):
+        if not hasattr(self, '_extraction'):
+            self._extraction = Schema.from_dict(json.loads(self.schema), passthrough=True) if self.schema else None
+        return self._extraction
+
+    def extract(self, rows):
+        """
+        Runs the feature extraction schema, if any, over a batch of raw data
+        dicts. Fields the schema does not mention are kept as they are.
+        """
+        if self.extraction is None:
+            return rows
+        return self.extraction.extract(rows)
+
+    def add_labels(self, values):
+        """
+        Records unseen target values and returns a {value: label id} mapping
+        for `values`. Like features, codes follow insertion order.
+        """
+        labels = dict(self.labels.filter(value__in=values).values_list('value', 'id'))
+        new = [v for v in values if v not in labels]
+        for value in new:
+            try:
+                with transaction.atomic():
+                    labels[value] = Label.objects.create(observation=self, value=value).pk
+            except IntegrityError:
+                # Added by a concurrent batch.
+                labels[value] = self.labels.get(value=value).pk
+        if new:
+            self.__dict__.pop('_label_ids', None)
+            self.__dict__.pop('_target_map', None)
+            log.debug("Added %s labels", len(new))
+        return labels
+
+    def add_features(self, names):
+        """
+        Grows the feature vocabulary. Columns are ordered by insertion, so the
+        index of a known feature never changes.
+        """
+        known = set(self.features.values_list('name', flat=True))
+        new = [Feature(observation=self, name=name) for name in names if name not in known]
+        if not new:
+            return 0
+        try:
+            with transaction.atomic():
+                Feature.objects.bulk_create(new)
+        except IntegrityError:
+            # A concurrent batch added some of them first.
+            for feature in new:
+                try:
+                    with transaction.atomic():
+                        feature.save()
+                except IntegrityError:
+                    pass
+        self.__dict__.pop('_vocabulary', None)
+        log.debug("Added %s features", len(new))
+        return len(new)
 
-        if current_data:
-            log.debug("Current data shape: %s x %s", len(current_data), len(current_data[0]))
-            log.debug("Current target shape: %s", len(current_target))
+    @property
+    def vocabulary(self):
+        if not hasattr(self, '_vocabulary'):
+            self._vocabulary = FeatureIndex(self.features.order_by('id').values_list('name', flat=True))
+        return self._vocabulary
+
+    def iter_records(self):
+        """
+        Yields (data, target) tuples in insertion order without loading the
+        whole dataset in memory.
+        """
+        rows = self.records.order_by('date_created', 'id').values_list('data', 'target')
+        for data, target in rows.iterator():
+            yield json.loads(data), json.loads(target)
+
+    def iter_export(self, cursor=None, limit=None):
+        """
+        Yields (id, data, target) with data and target still JSON encoded,
+        in id order starting after `cursor`.
+        """
+        rows = self.records.order_by('id').values_list('id', 'data', 'target')
+        if cursor is not None:
+            rows = rows.filter(id__gt=cursor)
+        if limit is not None:
+            rows = rows[:limit]
+        return rows.iterator()
 
-        current_data.extend(new_data)
-        current_target.extend(new_target)
+    @property
+    def records_count(self):
+        return self.records.count()
 
-        self.data = json.dumps(current_data)
-        self.target = json.dumps(current_target)
-        self.save()
+    @property
+    def label_ids(self):
+        if not hasattr(self, '_label_ids'):
+            self._label_ids = np.array(self.labels.order_by('id').values_list('id', flat=True), dtype=np.int64)
+        return self._label_ids
+
+    def encode_labels(self, label_ids):
+        """
+        Label codes are the rank of the label id, so a batch of ids is
+        encoded with a single searchsorted.
+        """
+        return np.searchsorted(self.label_ids, np.asarray(label_ids, dtype=np.int64))
 
     @property
     def target_normalized(self):
-        le = preprocessing.LabelEncoder()
-        le.fit(self.target_object)
-        normalized = list(le.transform(self.target_object))
-        if normalized:
-            log.debug("Normalized target shape %s", len(normalized))
+        if self.regression:
+            targets = self.records.order_by('date_created', 'id').values_list('target', flat=True)
+            normalized = np.fromiter((float(json.loads(t)) for t in targets.iterator()), dtype=np.float64)
+            log.debug("Numeric target shape %s", normalized.shape)
+            return normalized
+        label_ids = self.records.order_by('date_created', 'id').values_list('label_id', flat=True)
+        normalized = self.encode_labels(np.fromiter(label_ids.iterator(), dtype=np.int64))
+        log.debug("Normalized target shape %s", normalized.shape)
         return normalized
 
     @property
     def data_normalized(self):
         log.debug("Started observation normalization.")
-        v = DictVectorizer(sparse=False)
-        array = v.fit_transform(self.data_object)
-        self.features = json.dumps(v.get_feature_names())
-        self.save()
-        log.debug("Found features %s", v.get_feature_names())
-        log.debug("DATA %s", self.data_object)
-        log.debug("ARRAY %s", array)
-        log.debug("Normalized data array shape %s x %s", len(array), len(array[0]))
-        normalized = map(list, map(list, array))
-        if normalized:
-            log.debug("Normalized data shape %s x %s", len(normalized), len(normalized[0]))
-
-        return normalized
+        array = self.vocabulary.encode(self.extract(self.data_object), sparse=settings.SPARSE_FEATURES)
+        log.debug("Normalized data shape %s", array.shape)
+        return encode_matrix(array)
 
     @property
     def features_object(self):
-        return json.loads(self.features)
+        return self.vocabulary.names
 
     @property
     def data_object(self):
-        return json.loads(self.data)
+        return [data for data, target in self.iter_records()]
 
     @property
     def target_object(self):
-        return json.loads(self.target)
+        return [target for data, target in self.iter_records()]
 
     @property
     def target_map(self):
-        return dict(zip(self.target_normalized, self.target_object))
+        if not hasattr(self, '_target_map'):
+            values = self.labels.order_by('id').values_list('value', flat=True)
+            self._target_map = dict((code, json.loads(value)) for code, value in enumerate(values))
+        return self._target_map
+
+    def normalize_records(self, records):
+        """
+        Encodes freshly processed records the same way data_normalized and
+        target_normalized encode the whole dataset.
+        """
+        rows = self.extract([json.loads(r.data) for r in records])
+        array = self.vocabulary.encode(rows, sparse=settings.SPARSE_FEATURES)
+        if self.regression:
+            return encode_matrix(array), [float(json.loads(r.target)) for r in records]
+        return encode_matrix(array), self.encode_labels([r.label_id for r in records])
+
+
+class Label(models.Model):
+    observation = models.ForeignKey(Observation, related_name='labels', on_delete=models.CASCADE)
+    value = models.CharField(max_length=255)
+
+    class Meta:
+        unique_together = ('observation', 'value')
+
+
+class Record(models.Model):
+    observation = models.ForeignKey(Observation, related_name='records', on_delete=models.CASCADE)
+    data = models.TextField()
+    target = models.TextField()
+    label = models.ForeignKey(Label, null=True, related_name='records', on_delete=models.CASCADE)
+    digest = models.CharField(max_length=40, null=True)
+    date_created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        index_together = [('observation', 'date_created')]
+        unique_together = ('observation', 'digest')
+
+
+class Feature(models.Model):
+    observation = models.ForeignKey(Observation, related_name='features', on_delete=models.CASCADE)
+    name = models.CharField(max_length=255)
+
+    class Meta:
+        unique_together = ('observation', 'name')
+
+
+class DataSource(models.Model):
+    observation = models.ForeignKey(Observation, related_name='sources', on_delete=models.CASCADE)
+    format = models.CharField(max_length=16)
+    columns = models.TextField(default='{}')
+    rows = models.IntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    date_created = models.DateTimeField(default=timezone.now)
+
+
+class IngestBatch(models.Model):
+    """
+    An observation request sent with an Idempotency-Key header. Repeating
+    the key with the same body replays the stored response instead of
+    ingesting and training again, unless the rows were stored but not
+    trained: then the repeat trains them.
+    """
+    observation = models.ForeignKey(Observation, related_name='batches', on_delete=models.CASCADE)
+    key = models.CharField(max_length=255)
+    digest = models.CharField(max_length=40)
+    status = models.IntegerField(null=True, blank=True)
+    response = models.TextField(default='null')
+    untrained = models.BooleanField(default=False)
+    date_created = models.DateTimeField(default=timezone.now)
+    date_started = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = ('observation', 'key')
+
+    @classmethod
+    def start(cls, observation, key, digest):
+        """
+        Claims `key` for a request and returns (batch, created). When the key
+        was claimed before, that batch is returned; its status is None while
+        the first request is still running. Keys expire after
+        IDEMPOTENCY_KEY_MAX_AGE seconds.
+        """
+        expired = timezone.now() - datetime.timedelta(seconds=settings.IDEMPOTENCY_KEY_MAX_AGE)
+        cls.objects.filter(observation=observation, date_created__lt=expired).delete()
+        try:
+            with transaction.atomic():
+                return cls.objects.create(observation=observation, key=key, digest=digest), True
+        except IntegrityError:
+            return cls.objects.get(observation=observation, key=key), False
+
+    def resume(self):
+        """
+        Claims the batch again for a repeated request when its rows were
+        stored but not trained, or when the request that claimed it has run
+        for IDEMPOTENCY_IN_FLIGHT_TIMEOUT seconds and is taken to be dead.
+        Returns whether it was claimed.
+        """
+        stale = timezone.now() - datetime.timedelta(seconds=settings.IDEMPOTENCY_IN_FLIGHT_TIMEOUT)
+        if not self.untrained and not (self.status is None and self.date_started < stale):
+            return False
+        # Compare and set, so only one of concurrent repeats resumes it.
+        resumed = IngestBatch.objects.filter(
+            pk=self.pk, status=self.status, untrained=self.untrained, date_started=self.date_started
+        ).update(status=None, untrained=False, date_started=timezone.now())
+        if resumed:
+            log.info("Resuming batch %s of %s", self.key, self.observation_id)
+        return bool(resumed)
+
+    def finish(self, status, data):
+        # A server error comes from training: the rows are stored, and the
+        # next request with this key trains them.
+        self.status = status
+        self.response = json.dumps(data)
+        self.untrained = status >= 500
+        self.save(update_fields=['status', 'response', 'untrained'])
+
+    @property
+    def response_object(self):
+        return json.loads(self.response)
 
 
 class Question(object):
@@ -116,27 +408,171 @@ class Question(object):
 
     @property
     def data_normalized(self):
+        vocabulary = self.observation.vocabulary
+        rows = self.observation.extract([self.data_object] if type(self.data_object) is dict else self.data_object)
+        if settings.SPARSE_FEATURES:
+            return encode_matrix(vocabulary.encode(rows, sparse=True))
         if type(self.data_object) is dict:
-            return self.normalize(self.data_object)
+            return vocabulary.encode(rows)[0]
         else:
-            return map(self.normalize, self.data_object)
-
-    def normalize(self, data):
-        v = DictVectorizer(sparse=False)
-        array = v.fit_transform(data)
-        log.debug("Found features in question %s", v.get_feature_names())
-        log.debug("Features in training %s", self.observation.features_object)
-        log.debug("Normalized question value %s", array)
-
-        normalized_list = []
-        prediction_features = dict(zip(v.get_feature_names(), array[0]))
-        for trained_feature in self.observation.features_object:
-            if trained_feature in prediction_features:
-                normalized_list.append(prediction_features[trained_feature])
-            else:
-                normalized_list.append(0)
-        log.debug("Processed normalized question %s", normalized_list)
-        return normalized_list
-
-
+            return vocabulary.encode(rows)
+
+    def answer(self, token, auth_payload=None):
+        """
+        Asks intuity for predictions and maps them back to target values.
+        Raises ServiceUnavailable or QuestionError.
+        """
+        status, answer_object = intuity.post('/v1/prediction/', token, {
+            'data': self.data_normalized,
+        }, auth_payload=auth_payload)
+        if status >= 400:
+            raise QuestionError(status, answer_object)
+        if self.observation.regression:
+            return answer_object['prediction']
+        target_map = self.observation.target_map
+        if any(prediction not in target_map for prediction in answer_object['prediction']):
+            # Labels added by another process since the map was cached.
+            self.observation.__dict__.pop('_target_map', None)
+            target_map = self.observation.target_map
+        return [target_map[prediction] for prediction in answer_object['prediction']]
+
+
+def question_job_id():
+    return uuid.uuid4().hex
+
+
+class QuestionJob(models.Model):
+    """
+    A bulk scoring request. Questions are split into chunks which the
+    question worker answers independently, so answers of the first chunks
+    can be read while later ones are still queued. The worker asks intuity
+    on behalf of the verified token payload, the token itself is not kept.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    id = models.CharField(max_length=64, primary_key=True, default=question_job_id)
+    observation = models.ForeignKey(Observation, related_name='question_jobs', on_delete=models.CASCADE)
+    auth_payload = models.TextField()
+    state = models.CharField(max_length=16, choices=STATES, default=QUEUED, db_index=True)
+    rows = models.IntegerField(default=0)
+    chunks = models.IntegerField(default=0)
+    finished_chunks = models.IntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    date_created = models.DateTimeField(default=timezone.now, db_index=True)
+    date_started = models.DateTimeField(null=True, blank=True)
+    date_finished = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def enqueue(cls, observation, auth_payload, rows, chunk_size=None):
+        chunk_size = chunk_size or settings.QUESTION_CHUNK_SIZE
+        with transaction.atomic():
+            job = cls.objects.create(
+                observation=observation,
+                auth_payload=json.dumps(auth_payload),
+                rows=len(rows),
+                chunks=(len(rows) + chunk_size - 1) // chunk_size
+            )
+            QuestionChunk.objects.bulk_create([
+                QuestionChunk(job=job, index=i // chunk_size, data=json.dumps(rows[i:i + chunk_size]))
+                for i in range(0, len(rows), chunk_size)
+            ], batch_size=100)
+        log.debug("Queued question job %s with %s rows in %s chunks", job.pk, job.rows, job.chunks)
+        return job
+
+    def answers(self, cursor=0, limit=None):
+        """
+        Returns the answers of the finished chunks from `cursor` on, stopping
+        at the first unfinished one, and the cursor to continue from.
+        """
+        answers = []
+        chunks = self.chunk_set.filter(index__gte=cursor).order_by('index').values_list('index', 'state', 'answers')
+        if limit is not None:
+            chunks = chunks[:limit]
+        for index, state, chunk_answers in chunks.iterator():
+            if index != cursor or state != QuestionChunk.DONE:
+                break
+            answers.extend(json.loads(chunk_answers))
+            cursor += 1
+        return answers, cursor
+
+    def chunk_finished(self, error=None):
+        QuestionJob.objects.filter(pk=self.pk).update(finished_chunks=F('finished_chunks') + 1)
+        if error is not None:
+            QuestionJob.objects.filter(pk=self.pk).update(state=QuestionJob.FAILED, error=error)
+            self.chunk_set.filter(state=QuestionChunk.QUEUED).update(state=QuestionChunk.FAILED)
+        self.refresh_from_db(fields=['state', 'finished_chunks'])
+        if self.finished_chunks >= self.chunks:
+            QuestionJob.objects.filter(pk=self.pk, state=QuestionJob.RUNNING).update(state=QuestionJob.DONE)
+        if self.finished_chunks >= self.chunks or self.state == QuestionJob.FAILED:
+            QuestionJob.objects.filter(pk=self.pk, date_finished=None).update(date_finished=timezone.now())
 
+    @property
+    def timings(self):
+        timings = {}
+        if self.date_started:
+            timings['queued'] = (self.date_started - self.date_created).total_seconds()
+            if self.date_finished:
+                timings['running'] = (self.date_finished - self.date_started).total_seconds()
+        return timings
+
+
+class QuestionChunk(models.Model):
+    QUEUED = QuestionJob.QUEUED
+    RUNNING = QuestionJob.RUNNING
+    DONE = QuestionJob.DONE
+    FAILED = QuestionJob.FAILED
+
+    job = models.ForeignKey(QuestionJob, related_name='chunk_set', on_delete=models.CASCADE)
+    index = models.IntegerField()
+    state = models.CharField(max_length=16, choices=QuestionJob.STATES, default=QUEUED, db_index=True)
+    data = models.TextField()
+    answers = models.TextField(null=True)
+    # Lease held by the question worker while running, see intuity_common.jobs.
+    worker = models.CharField(max_length=128, blank=True, default='')
+    heartbeat = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('job', 'index')
+
+    def execute(self, retry=False):
+        """
+        Answers the chunk. With `retry`, a chunk intuity could not answer for
+        the time being is queued again instead of failing the job.
+        """
+        job = self.job
+        try:
+            answers = Question(json.loads(self.data), job.observation).answer(
+                None, auth_payload=json.loads(job.auth_payload)
+            )
+        except Exception as e:
+            transient = isinstance(e, ServiceUnavailable) or (isinstance(e, QuestionError) and e.status >= 500)
+            if transient and retry:
+                log.warning("Chunk %s of question job %s requeued: %s", self.index, job.pk, e)
+                QuestionChunk.objects.filter(pk=self.pk, state=QuestionChunk.RUNNING).update(
+                    state=QuestionChunk.QUEUED, worker='', heartbeat=None
+                )
+                self.state = QuestionChunk.QUEUED
+                return self.state
+            log.exception("Chunk %s of question job %s failed", self.index, job.pk)
+            self.state = QuestionChunk.FAILED
+            self.heartbeat = None
+            self.save(update_fields=['state', 'heartbeat'])
+            job.chunk_finished(error=str(e))
+        else:
+            self.state = QuestionChunk.DONE
+            self.answers = json.dumps(answers)
+            self.heartbeat = None
+            self.save(update_fields=['state', 'answers', 'heartbeat'])
+            job.chunk_finished()
+        return self.state
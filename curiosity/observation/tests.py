@@ -1,3 +1,300 @@
-from django.test import TestCase
+import json
+from datetime import timedelta
 
-# Create your tests here.
+import jwt
+import requests
+from django.conf import settings
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from observation import client, views
+from observation.dedup import BloomFilter, BloomFilters, batch_digest, record_digest
+from observation.jobs import ChunkQueue
+from observation.models import BadFormat, IngestBatch, Label, Observation, Question, QuestionChunk, QuestionJob
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, content=b'{}'):
+        self.status_code = status_code
+        self.content = content
+        self.headers = {'Content-Type': 'application/json'}
+
+
+class FakeSession(object):
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class ServiceClientTest(SimpleTestCase):
+
+    def make_client(self, *outcomes):
+        service = client.ServiceClient(['http://intuity'], timeout=1, retries=2, backoff=0,
+                                       pool_size=1, breaker=client.CircuitBreaker(10, 30))
+        service.session = FakeSession(*outcomes)
+        return service
+
+    def test_retries_idempotent_calls(self):
+        service = self.make_client(FakeResponse(503), requests.exceptions.ReadTimeout(), FakeResponse(200))
+        self.assertEqual(service.get('/v1/training/', 'token'), (200, {}))
+        self.assertEqual(service.session.calls, 3)
+
+    def test_sends_other_calls_once(self):
+        for outcome in (FakeResponse(503), requests.exceptions.ReadTimeout()):
+            service = self.make_client(outcome, FakeResponse(200))
+            with self.assertRaises(client.ServiceUnavailable):
+                service.post('/v1/training/', 'token', {}, idempotent=False)
+            self.assertEqual(service.session.calls, 1)
+
+    def test_retries_calls_never_sent(self):
+        service = self.make_client(requests.exceptions.ConnectTimeout(), FakeResponse(200))
+        self.assertEqual(service.post('/v1/training/', 'token', {}, idempotent=False), (200, {}))
+
+    def test_half_open_trial_ends_whatever_the_error(self):
+        for outcome in (requests.exceptions.ChunkedEncodingError(), FakeResponse(200, content=None)):
+            service = self.make_client(outcome, FakeResponse(200))
+            service.breaker = client.CircuitBreaker(1, 0)
+            service.breaker.failure()
+            self.assertEqual(service.breaker.state, 'half-open')
+            with self.assertRaises(Exception):
+                service.post('/v1/training/', 'token', {}, idempotent=False)
+            self.assertFalse(service.breaker.trial)
+            self.assertEqual(service.post('/v1/training/', 'token', {}), (200, {}))
+            self.assertEqual(service.breaker.state, 'closed')
+
+
+class TrainTest(TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.post = client.intuity.post
+        client.intuity.post = self.fake_post
+
+    def tearDown(self):
+        client.intuity.post = self.post
+
+    def fake_post(self, path, token, payload, idempotent=True, auth_payload=None):
+        self.calls.append((path, payload, idempotent))
+        return 202, {'job': 'job', 'state': 'queued'}
+
+    def test_training_requests_are_not_retried(self):
+        observation = Observation.objects.create(uuid='o')
+        records, skipped = observation.process([{'data': {'a': 1}, 'target': 'x'}])
+        views.train(observation, 'token')
+        views.train(observation, 'token', records=records)
+        self.assertEqual([call[2] for call in self.calls], [False, False])
+        self.assertEqual(self.calls[1][1]['mode'], 'incremental')
+
+
+class LabelsTest(TestCase):
+
+    def setUp(self):
+        self.post = client.intuity.post
+        client.intuity.post = lambda path, token, payload, **kwargs: (200, {'prediction': [0, 1, 2]})
+        self.observation = Observation.objects.create(uuid='o', job_type='classification')
+
+    def tearDown(self):
+        client.intuity.post = self.post
+
+    def test_answers_with_labels_added_after_the_map_was_cached(self):
+        self.observation.process([{'data': {'a': 1}, 'target': 'x'}])
+        self.assertEqual(self.observation.target_map, {0: 'x'})
+        self.observation.process([{'data': {'a': 2}, 'target': 'y'}])
+        Label.objects.create(observation=self.observation, value='"z"')
+        answers = Question([{'a': 1}, {'a': 2}, {'a': 3}], self.observation).answer('token')
+        self.assertEqual(answers, ['x', 'y', 'z'])
+
+
+class QuestionJobTest(TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.post = client.intuity.post
+        client.intuity.post = self.fake_post
+        self.observation = Observation.objects.create(uuid='o', job_type='regression')
+        self.observation.process([{'data': {'a': 1}, 'target': 1}])
+        self.job = QuestionJob.enqueue(self.observation, {'uuid': 'o'}, [{'a': 1}, {'a': 2}, {'a': 3}], chunk_size=2)
+        self.queue = ChunkQueue(lease=60, attempts=2)
+
+    def tearDown(self):
+        client.intuity.post = self.post
+
+    def fake_post(self, path, token, payload, idempotent=True, auth_payload=None):
+        self.calls.append((token, auth_payload))
+        return 200, {'prediction': [0.5] * payload['data']['shape'][0]}
+
+    def test_answers_on_behalf_of_the_stored_payload(self):
+        self.assertNotIn('token', [field.name for field in QuestionJob._meta.get_fields()])
+        for chunk_id in self.queue.next(2):
+            self.assertEqual(self.queue.run(chunk_id), QuestionChunk.DONE)
+        self.assertEqual(self.calls, [(None, {'uuid': 'o'})] * 2)
+        job = QuestionJob.objects.get(pk=self.job.pk)
+        self.assertEqual((job.state, job.answers()[0]), (QuestionJob.DONE, [0.5] * 3))
+
+    def test_claims_chunks_in_order_and_starts_the_job(self):
+        chunks = list(self.job.chunk_set.order_by('index').values_list('pk', flat=True))
+        self.assertEqual(self.queue.next(1), chunks[:1])
+        job = QuestionJob.objects.get(pk=self.job.pk)
+        self.assertEqual(job.state, QuestionJob.RUNNING)
+        self.assertIsNotNone(job.date_started)
+
+    def test_fails_the_job_when_a_chunk_is_lost_too_often(self):
+        for attempt in range(2):
+            chunk_id = self.queue.next(1)[0]
+            QuestionChunk.objects.filter(pk=chunk_id).update(heartbeat=timezone.now() - timedelta(seconds=120))
+            self.queue.reclaim()
+        job = QuestionJob.objects.get(pk=self.job.pk)
+        self.assertEqual((job.state, job.error), (QuestionJob.FAILED, 'Worker lost'))
+        self.assertEqual(set(job.chunk_set.values_list('state', flat=True)), {QuestionChunk.FAILED})
+
+    def test_requeues_chunks_on_transient_errors_until_attempts_run_out(self):
+        def unavailable(path, token, payload, idempotent=True, auth_payload=None):
+            raise client.ServiceUnavailable('intuity is down')
+        client.intuity.post = unavailable
+        chunk_id = self.queue.next(1)[0]
+        self.assertEqual(self.queue.run(chunk_id), QuestionChunk.QUEUED)
+        chunk = QuestionChunk.objects.get(pk=chunk_id)
+        self.assertEqual((chunk.state, chunk.worker, chunk.heartbeat), (QuestionChunk.QUEUED, '', None))
+        self.assertEqual(QuestionJob.objects.get(pk=self.job.pk).state, QuestionJob.RUNNING)
+        self.assertEqual(self.queue.next(1), [chunk_id])
+        self.assertEqual(self.queue.run(chunk_id), QuestionChunk.FAILED)
+        job = QuestionJob.objects.get(pk=self.job.pk)
+        self.assertEqual((job.state, job.error), (QuestionJob.FAILED, 'intuity is down'))
+
+    def test_fails_chunks_on_rejected_questions(self):
+        client.intuity.post = lambda *args, **kwargs: (400, {'detail': 'bad'})
+        self.assertEqual(self.queue.run(self.queue.next(1)[0]), QuestionChunk.FAILED)
+        self.assertEqual(QuestionJob.objects.get(pk=self.job.pk).state, QuestionJob.FAILED)
+
+    @override_settings(QUESTION_STREAM_TIMEOUT=0)
+    def test_stream_ends_after_the_timeout(self):
+        self.queue.run(self.queue.next(1)[0])
+        lines = [json.loads(line) for line in ''.join(views.stream_answers(self.job, 0)).splitlines()]
+        self.assertEqual(lines, [{'answer': 0.5}, {'answer': 0.5},
+                                 {'job': self.job.pk, 'state': QuestionJob.RUNNING, 'error': '', 'next': 1}])
+
+
+class BloomFilterTest(TestCase):
+
+    def test_has_no_false_negatives_and_few_false_positives(self):
+        bloom = BloomFilter(1000, 0.01)
+        digests = [record_digest({'a': i}, 'x') for i in range(2000)]
+        for digest in digests[:1000]:
+            bloom.add(digest)
+        self.assertTrue(all(digest in bloom for digest in digests[:1000]))
+        self.assertLess(sum(digest in bloom for digest in digests[1000:]), 30)
+        self.assertFalse(bloom.full)
+        bloom.add(digests[1000])
+        self.assertTrue(bloom.full)
+
+    @override_settings(DEDUP_BLOOM_CAPACITY=2)
+    def test_filters_are_built_from_stored_digests_and_grow(self):
+        observation = Observation.objects.create(uuid='o')
+        observation.process([{'data': {'a': i}, 'target': 'x'} for i in range(3)])
+        filters = BloomFilters(10)
+        bloom = filters.get(observation)
+        self.assertEqual((bloom.count, bloom.capacity), (3, 6))
+        self.assertIn(record_digest({'a': 0}, 'x'), bloom)
+        filters.add(observation, [record_digest({'a': 9}, 'x')])
+        self.assertIn(record_digest({'a': 9}, 'x'), filters.get(observation))
+
+    def test_keeps_the_least_recently_used_filters(self):
+        observations = [Observation.objects.create(uuid=uuid) for uuid in 'abc']
+        filters = BloomFilters(2)
+        first = filters.get(observations[0])
+        filters.get(observations[1])
+        filters.get(observations[0])
+        filters.get(observations[2])
+        self.assertEqual(list(filters.filters), ['a', 'c'])
+        self.assertIs(filters.get(observations[0]), first)
+        self.assertEqual(filters.nbytes, 2 * first.bits.nbytes)
+
+    def test_keeps_filters_within_bytes(self):
+        observations = [Observation.objects.create(uuid=uuid) for uuid in 'abc']
+        filters = BloomFilters(10, max_bytes=1)
+        for observation in observations:
+            filters.get(observation)
+        self.assertEqual(list(filters.filters), ['c'])
+        filters.discard(observations[2])
+        self.assertEqual((len(filters), filters.nbytes), (0, 0))
+
+
+class IngestRetryTest(TestCase):
+
+    def setUp(self):
+        self.statuses = []
+        self.calls = []
+        self.post = client.intuity.post
+        client.intuity.post = self.fake_post
+        token = jwt.encode({'uuid': 'o', 'iss': 'authority', 'aud': ['curiosity']}, key=settings.SECRET_KEY)
+        self.token = token.decode('ascii') if isinstance(token, bytes) else token
+        self.client = Client()
+
+    def tearDown(self):
+        client.intuity.post = self.post
+
+    def fake_post(self, path, token, payload, idempotent=True, auth_payload=None):
+        self.calls.append(payload.get('mode'))
+        status = self.statuses.pop(0)
+        if status == 503:
+            raise client.ServiceUnavailable('down')
+        return status, {'job': 'job', 'state': 'queued'}
+
+    def send(self, rows, **headers):
+        response = self.client.post('/v1/observation/?token={}&incremental=1'.format(self.token), json.dumps(rows),
+                                    content_type='application/json', **headers)
+        return response.status_code, json.loads(response.content.decode('utf-8'))
+
+    def test_repeating_a_key_trains_rows_stored_but_not_trained(self):
+        rows = [{'data': {'a': 1}, 'target': 'x'}]
+        self.statuses = [503, 202]
+        self.assertEqual(self.send(rows, HTTP_IDEMPOTENCY_KEY='k')[0], 503)
+        self.assertTrue(IngestBatch.objects.get(key='k').untrained)
+        status, body = self.send(rows, HTTP_IDEMPOTENCY_KEY='k')
+        self.assertEqual((status, body['new'], body['job']), (202, 0, 'job'))
+        self.assertEqual(self.calls, ['incremental', None])
+        self.assertFalse(Observation.objects.get(pk='o').untrained)
+        self.assertEqual(self.send(rows, HTTP_IDEMPOTENCY_KEY='k')[0], 202)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_rows_already_stored_are_trained_after_a_failure(self):
+        rows = [{'data': {'a': 1}, 'target': 'x'}]
+        self.statuses = [503, 202]
+        self.assertEqual(self.send(rows)[0], 503)
+        self.assertEqual(self.send(rows)[0], 202)
+        self.assertEqual(self.send(rows), (200, {'records': 1, 'new': 0, 'skipped': 1}))
+        self.assertEqual(len(self.calls), 2)
+
+    def test_takes_over_keys_of_dead_requests(self):
+        rows = [{'data': {'a': 1}, 'target': 'x'}]
+        observation = Observation.objects.create(uuid='o')
+        batch, started = IngestBatch.start(observation, 'k', batch_digest(rows))
+        self.assertEqual(self.send(rows, HTTP_IDEMPOTENCY_KEY='k')[0], 409)
+        stale = timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_IN_FLIGHT_TIMEOUT + 1)
+        IngestBatch.objects.filter(pk=batch.pk).update(date_started=stale)
+        self.statuses = [202]
+        self.assertEqual(self.send(rows, HTTP_IDEMPOTENCY_KEY='k')[0], 202)
+        self.assertEqual(IngestBatch.objects.get(pk=batch.pk).status, 202)
+
+
+class ProcessTest(TestCase):
+
+    def test_rejects_malformed_rows_before_storing_any(self):
+        observation = Observation.objects.create(uuid='o')
+        good = {'data': {'a': 1}, 'target': 'x'}
+        for row in ('row', {'data': 'a', 'target': 'x'}, {'data': [1], 'target': 'x'}, {'data': {'b': 1}}):
+            with self.assertRaises(BadFormat):
+                observation.process([good, row])
+        self.assertEqual((observation.records.count(), observation.labels.count(), len(observation.vocabulary)),
+                         (0, 0, 0))
+        records, skipped = observation.process([good])
+        self.assertEqual((len(records), skipped, list(observation.vocabulary.names)), (1, 0, ['a']))
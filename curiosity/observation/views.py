@@ -1,49 +1,111 @@
 import json
+import time
 
-import jwt
 from django.conf import settings
+from django.http import StreamingHttpResponse
 from django.shortcuts import Http404
 from rest_framework import parsers
-from rest_framework import renderers
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from observation.models import Observation, BadFormat, Question
+from intuity_common.auth import validate_token
+from intuity_common.extraction import Schema, SchemaError
+from intuity_common.parsers import MsgPackParser
+from intuity_common.renderers import MsgPackRenderer, NumpyJSONRenderer
 
-import requests
+from observation.client import intuity, ServiceUnavailable
+from observation.datasource import FORMATS, BadRow, iter_batches
+from observation.dedup import batch_digest, filters
+from observation.models import (
+    Observation, BadFormat, Question, QuestionError, QuestionJob, DataSource, IngestBatch
+)
 
 import logging
 
 log = logging.getLogger('curiosity.observation.views')
 
 
-def validate_token(func):
-    def _decorated(view, request, *args, **kwargs):
-        token = request.GET.get('token', '')
-        if not token:
-            return Response({'error': 'Missing authentication token'}, status=401)
-        try:
-            payload = jwt.decode(token, key=settings.SECRET_KEY, audience='curiosity', issuer='authority')
-        except (jwt.DecodeError, AttributeError, jwt.InvalidAudience, jwt.InvalidIssuer) as e:
-            return Response({'error': e.message}, status=401)
-        return func(view, request, payload, *args, **kwargs)
-
-    return _decorated
+def train(observation, token, sync=False, records=None):
+    """
+    Sends the observation to intuity for training. When `records` is given
+    only those rows are sent, to intuity's incremental training mode. A
+    failed request marks the observation untrained, so the next request
+    trains it even when it brings no new rows.
+    """
+    if observation.untrained:
+        # Rows sent by the failed request would be missed by an increment.
+        records = None
+    if records is not None:
+        data, target = observation.normalize_records(records)
+        training_request = {'data': data, 'target': target, 'mode': 'incremental'}
+    else:
+        training_request = {'data': observation.data_normalized, 'target': observation.target_normalized}
+    training_request['async'] = not sync
+
+    # Never retried once sent: a slow training would run again, and every
+    # async retry would queue another job.
+    try:
+        status, training_object = intuity.post('/v1/training/', token, training_request, idempotent=False)
+    except ServiceUnavailable as e:
+        log.warning("Training request failed: %s", e)
+        status, training_object = 503, 'Training unavailable'
+    untrained = status >= 500
+    if observation.untrained != untrained:
+        Observation.objects.filter(pk=observation.pk).update(untrained=untrained)
+        observation.untrained = untrained
+    if status >= 400:
+        return Response({"records": observation.records_count, 'error': training_object}, status=status)
+
+    if sync:
+        return Response({"records": observation.records_count, 'accuracy': training_object['accuracy']})
+    return Response({"records": observation.records_count, 'job': training_object['job']}, status=202)
+
+
+def export_params(request):
+    cursor = request.GET.get('cursor')
+    cursor = int(cursor) if cursor else None
+    limit = min(int(request.GET.get('limit', settings.EXPORT_PAGE_SIZE)), settings.EXPORT_MAX_PAGE_SIZE)
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    fields = set(request.GET.get('fields', 'data,target').split(','))
+    if not fields or not fields <= {'data', 'target'}:
+        raise ValueError('fields must be data, target or both')
+    return cursor, limit, fields
+
+
+def export_line(data, target, fields):
+    # Stored values are already JSON, so lines are assembled without
+    # decoding them.
+    parts = []
+    if 'data' in fields:
+        parts.append('"data": ' + data)
+    if 'target' in fields:
+        parts.append('"target": ' + target)
+    return '{' + ', '.join(parts) + '}\n'
 
 
 class ObservationApi(APIView):
     """
     GET
-        URL: /v1/observation/?token={token}
+        URL: /v1/observation/?token={token}[&cursor={id}][&limit={n}][&fields=data,target][&stream=1]
+        Pages of observations; `next` is the cursor of the following page.
+        With stream=1 every observation is streamed as NDJSON instead.
     POST
-        URL: /v1/observation/?token={token}
+        URL: /v1/observation/?token={token}[&sync=1][&incremental=1]
+        HEADERS: [Idempotency-Key: {key}]
         DATA: [{"data": {observation_json}, "target": {target_value}, ...]
+        Training runs as a background job unless sync is set. With
+        incremental only the new rows are sent to an online model. Rows
+        already stored are skipped, and nothing is trained when all of them
+        are, unless the last training request failed. A repeated
+        Idempotency-Key replays the first response, or trains the rows when
+        training failed.
     DELETE
         URL: /v1/observation/?token={token}
     """
 
-    parser_classes = (parsers.JSONParser,)
-    renderer_classes = (renderers.JSONRenderer,)
+    parser_classes = (parsers.JSONParser, MsgPackParser)
+    renderer_classes = (NumpyJSONRenderer, MsgPackRenderer)
 
     def get_view_name(self):
         return 'Observation'
@@ -55,10 +117,28 @@ class ObservationApi(APIView):
         except Observation.DoesNotExist:
             raise Http404
 
+        try:
+            cursor, limit, fields = export_params(request)
+        except ValueError as e:
+            return Response({'error': 'Invalid input: {}'.format(e)}, status=400)
+
+        if request.GET.get('stream') in ('1', 'true'):
+            lines = (export_line(data, target, fields) for _, data, target in observation.iter_export(cursor))
+            return StreamingHttpResponse(lines, content_type='application/x-ndjson')
+
         observations = []
-        for data, target in zip(observation.data_object, observation.target_object):
-            observations.append({'data': data, 'target': target})
-        return Response(observations)
+        last = None
+        for last, data, target in observation.iter_export(cursor, limit):
+            record = {}
+            if 'data' in fields:
+                record['data'] = json.loads(data)
+            if 'target' in fields:
+                record['target'] = json.loads(target)
+            observations.append(record)
+        return Response({
+            'observations': observations,
+            'next': last if len(observations) == limit else None
+        })
 
     @validate_token
     def post(self, request, payload):
@@ -69,32 +149,57 @@ class ObservationApi(APIView):
             log.warning("Invalid input: list expected.")
             return Response({'error': 'Invalid input: list expected'}, status=400)
 
-        observation, created = Observation.objects.get_or_create(pk=payload['uuid'])
+        observation, created = Observation.for_payload(payload)
 
         if created:
             log.info("New observation with ID %s", observation.pk)
             observation.data_type = request.META['CONTENT_TYPE']
+            observation.save(update_fields=['data_type'])
         else:
             log.info("Found observation with ID %s", observation.pk)
 
+        key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if not key:
+            return self.ingest(request, observation)
+
+        digest = batch_digest(request.data)
+        batch, started = IngestBatch.start(observation, key[:255], digest)
+        if not started:
+            if batch.digest != digest:
+                return Response({'error': 'Idempotency-Key was used with a different body'}, status=422)
+            started = batch.resume()
+        if not started:
+            if batch.status is None:
+                return Response({'error': 'A request with this Idempotency-Key is in progress'}, status=409)
+            log.info("Replaying response to Idempotency-Key %s", key)
+            return Response(batch.response_object, status=batch.status, headers={'Idempotent-Replayed': 'true'})
         try:
-            observation.process(request.data)
-        except BadFormat:
-            return Response({'error': 'Invalid input: missing target'}, status=400)
+            response = self.ingest(request, observation)
+        except Exception:
+            batch.delete()
+            raise
+        batch.finish(response.status_code, response.data)
+        return response
+
+    def ingest(self, request, observation):
+        width = len(observation.vocabulary)
+        try:
+            records, skipped = observation.process(request.data)
+        except BadFormat as e:
+            return Response({'error': 'Invalid input: {}'.format(e)}, status=400)
 
-        observations = []
-        for data, target in zip(observation.data_object, observation.target_object):
-            observations.append({'data': data, 'target': target})
+        if not records and not observation.untrained:
+            return Response({'records': observation.records_count, 'new': 0, 'skipped': skipped})
 
-        accuracy = requests.post(
-            'http://localhost:8084/v1/training/?token={}'.format(request.GET['token']),
-            json={
-                'data': observation.data_normalized,
-                'target': observation.target_normalized
-            }
-        )
+        sync = request.GET.get('sync') in ('1', 'true')
+        incremental = request.GET.get('incremental') in ('1', 'true')
 
-        return Response({"records": len(observations), 'accuracy': accuracy.json()['accuracy']})
+        if incremental and (settings.SPARSE_FEATURES or len(observation.vocabulary) == width):
+            response = train(observation, request.GET['token'], sync=sync, records=records)
+        else:
+            response = train(observation, request.GET['token'], sync=sync)
+        response.data.update(new=len(records), skipped=skipped)
+        return response
 
     @validate_token
     def delete(self, request, payload):
@@ -105,12 +210,165 @@ class ObservationApi(APIView):
             raise Http404
 
         observation.delete()
+        filters.discard(observation)
         return Response({})
 
 
+class ObservationUploadApi(APIView):
+    """
+    POST
+        URL: /v1/observation/upload/?token={token}&target={column}[&input=csv|tsv|ndjson][&sync=1]
+        DATA: CSV or TSV with a header line, or one JSON object per line.
+        The body is parsed as it is read and committed in batches of
+        INGEST_BATCH_SIZE rows; rows already stored are skipped and training
+        starts once the upload is done if any row was new.
+    """
+
+    parser_classes = ()
+    renderer_classes = (NumpyJSONRenderer, MsgPackRenderer)
+
+    def get_view_name(self):
+        return 'Observation upload'
+
+    @validate_token
+    def post(self, request, payload):
+        content_type = request.META.get('CONTENT_TYPE', '').split(';')[0].strip()
+        format = FORMATS.get(request.GET.get('input') or content_type)
+        if format is None:
+            return Response({'error': 'Invalid input: csv, tsv or ndjson expected'}, status=400)
+        target = request.GET.get('target')
+        if not target:
+            return Response({'error': 'Invalid input: missing target column'}, status=400)
+        if request.stream is None:
+            return Response({'error': 'Invalid input: no rows'}, status=400)
+
+        observation, created = Observation.for_payload(payload)
+        if created:
+            observation.data_type = content_type
+            observation.save(update_fields=['data_type'])
+
+        source = DataSource.objects.create(observation=observation, format=format)
+        new = skipped = 0
+        try:
+            for batch, schema in iter_batches(request.stream, format, target, settings.INGEST_BATCH_SIZE):
+                records, duplicates = observation.process(batch)
+                new += len(records)
+                skipped += duplicates
+                source.rows += len(batch)
+                source.columns = json.dumps(schema.columns)
+                source.save(update_fields=['rows', 'columns'])
+                log.debug("Committed %s rows from %s upload", source.rows, format)
+        except (BadRow, BadFormat) as e:
+            source.error = str(e)
+            source.save(update_fields=['error'])
+            return Response({'error': 'Invalid input: {}'.format(e), 'records': source.rows}, status=400)
+
+        if not source.rows:
+            return Response({'error': 'Invalid input: no rows'}, status=400)
+        if not new and not observation.untrained:
+            return Response({'records': observation.records_count, 'new': 0, 'skipped': skipped})
+
+        response = train(observation, request.GET['token'], sync=request.GET.get('sync') in ('1', 'true'))
+        response.data.update(new=new, skipped=skipped)
+        return response
+
+
+class SchemaApi(APIView):
+    """
+    GET
+        URL: /v1/observation/schema/?token={token}
+    PUT
+        URL: /v1/observation/schema/?token={token}
+        DATA: {"field": "passthrough"|"number"|{"type": "datetime", "parts": ["hour", ...]}|
+               {"type": "bucket", "bounds": [...]}, ...}
+        Feature extraction applied before vectorization. It can only be
+        changed while the observation has no records.
+    """
+
+    parser_classes = (parsers.JSONParser, MsgPackParser)
+    renderer_classes = (NumpyJSONRenderer, MsgPackRenderer)
+
+    def get_view_name(self):
+        return 'Observation schema'
+
+    @validate_token
+    def get(self, request, payload):
+        try:
+            observation = Observation.objects.get(pk=payload['uuid'])
+        except Observation.DoesNotExist:
+            raise Http404
+        return Response({'schema': json.loads(observation.schema) if observation.schema else None})
+
+    @validate_token
+    def put(self, request, payload):
+        try:
+            Schema.from_dict(request.data)
+        except SchemaError as e:
+            return Response({'error': 'Invalid input: {}'.format(e)}, status=400)
+
+        observation, created = Observation.for_payload(payload)
+        if observation.records.exists():
+            return Response({'error': 'Schema cannot change once records exist'}, status=409)
+
+        observation.schema = json.dumps(request.data, sort_keys=True)
+        observation.save(update_fields=['schema'])
+        return Response({'schema': request.data})
+
+
+class TrainingJobApi(APIView):
+    """
+    GET
+        URL: /v1/observation/jobs/{job_id}/?token={token}
+    """
+
+    renderer_classes = (NumpyJSONRenderer, MsgPackRenderer)
+
+    def get_view_name(self):
+        return 'Training job'
+
+    @validate_token
+    def get(self, request, payload, job_id):
+        try:
+            status, job = intuity.get('/v1/training/jobs/{}/'.format(job_id), request.GET['token'])
+        except ServiceUnavailable as e:
+            log.warning("Job request failed: %s", e)
+            return Response({'error': 'Training unavailable'}, status=503)
+        return Response(job, status=status)
+
+
+def stream_answers(job, cursor):
+    """
+    Yields NDJSON answers as chunks finish, then a last line with the state
+    of the job once it ends or after QUESTION_STREAM_TIMEOUT seconds, with
+    the cursor to resume from.
+    """
+    deadline = time.time() + settings.QUESTION_STREAM_TIMEOUT
+    while True:
+        job.refresh_from_db(fields=['state', 'error'])
+        answers, cursor = job.answers(cursor)
+        if answers:
+            yield ''.join(json.dumps({'answer': answer}) + '\n' for answer in answers)
+        finished = job.state == QuestionJob.FAILED or (job.state == QuestionJob.DONE and cursor >= job.chunks)
+        if finished or time.time() >= deadline:
+            yield json.dumps({'job': job.pk, 'state': job.state, 'error': job.error, 'next': cursor}) + '\n'
+            return
+        time.sleep(settings.QUESTION_STREAM_INTERVAL)
+
+
 class QuestionApi(APIView):
-    parser_classes = (parsers.JSONParser,)
-    renderer_classes = (renderers.JSONRenderer,)
+    """
+    POST
+        URL: /v1/question/?token={token}[&async=1]
+        DATA: {question_json} or [{question_json}, ...]
+        With async the questions are queued and answered in chunks by the
+        question worker; answers are read from /v1/question/jobs/{job_id}/.
+    """
+
+    parser_classes = (parsers.JSONParser, MsgPackParser)
+    renderer_classes = (NumpyJSONRenderer, MsgPackRenderer)
+
+    def get_view_name(self):
+        return 'Question'
 
     @validate_token
     def post(self, request, payload):
@@ -118,20 +376,91 @@ class QuestionApi(APIView):
             return Response({'error': 'Invalid input: dict or list are expected'}, status=400)
 
         observation = Observation.objects.get(pk=payload['uuid'])
+
+        if request.GET.get('async') in ('1', 'true'):
+            rows = [request.data] if type(request.data) is dict else request.data
+            if not rows:
+                return Response({'error': 'Invalid input: no questions'}, status=400)
+            job = QuestionJob.enqueue(observation, payload, rows)
+            return Response({'job': job.pk, 'state': job.state, 'rows': job.rows, 'chunks': job.chunks}, status=202)
+
         question = Question(request.data, observation)
+        try:
+            answers = question.answer(request.GET['token'])
+        except ServiceUnavailable as e:
+            log.warning("Prediction request failed: %s", e)
+            return Response({'error': 'Prediction unavailable'}, status=503)
+        except QuestionError as e:
+            return Response({'error': e.body}, status=e.status)
+
+        return Response({'answer': answers})
 
-        answer = requests.post(
-            'http://localhost:8084/v1/prediction/?token={}'.format(request.GET['token']),
-            json={
-                'data': question.data_normalized,
-            }
-        )
 
-        answer_object = answer.json()
+class QuestionJobApi(APIView):
+    """
+    GET
+        URL: /v1/question/jobs/{job_id}/?token={token}[&cursor={chunk}][&stream=1]
+        Answers of the chunks finished so far, in order, from `cursor` on;
+        `next` is the cursor of the following poll. With stream=1 answers
+        are streamed as NDJSON as they become ready, until the job ends or
+        QUESTION_STREAM_TIMEOUT passes; the last line has the cursor to
+        resume from.
+    """
 
-        predictions = answer_object['prediction']
-        answers = []
-        for prediction in predictions:
-            answers.append(observation.target_map[prediction])
+    renderer_classes = (NumpyJSONRenderer, MsgPackRenderer)
 
-        return Response({'answer': answers})
+    def get_view_name(self):
+        return 'Question job'
+
+    @validate_token
+    def get(self, request, payload, job_id):
+        try:
+            job = QuestionJob.objects.get(pk=job_id, observation_id=payload['uuid'])
+        except QuestionJob.DoesNotExist:
+            raise Http404
+
+        try:
+            cursor = int(request.GET.get('cursor', 0))
+            if cursor < 0:
+                raise ValueError
+        except ValueError:
+            return Response({'error': 'Invalid input: bad cursor'}, status=400)
+
+        if request.GET.get('stream') in ('1', 'true'):
+            return StreamingHttpResponse(stream_answers(job, cursor), content_type='application/x-ndjson')
+
+        answers, next_cursor = job.answers(cursor, limit=settings.QUESTION_PAGE_CHUNKS)
+        return Response({
+            'job': job.pk,
+            'state': job.state,
+            'rows': job.rows,
+            'chunks': job.chunks,
+            'finished_chunks': job.finished_chunks,
+            'date_created': job.date_created,
+            'date_started': job.date_started,
+            'date_finished': job.date_finished,
+            'timings': job.timings,
+            'error': job.error,
+            'answers': answers,
+            'next': next_cursor if next_cursor < job.chunks else None,
+        })
+
+
+class ServiceStatsApi(APIView):
+    """
+    GET
+        URL: /v1/service/intuity/?token={token}
+        Request counters, retries, circuit breaker state and latency of
+        this process' calls to intuity.
+    """
+
+    renderer_classes = (NumpyJSONRenderer, MsgPackRenderer)
+
+    def get_view_name(self):
+        return 'Intuity service'
+
+    @validate_token
+    def get(self, request, payload):
+        stats = intuity.stats.as_dict()
+        stats['circuit'] = intuity.breaker.state
+        return Response(stats)
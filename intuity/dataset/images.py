@@ -0,0 +1,140 @@
+import io
+import multiprocessing
+import os
+import tarfile
+import tempfile
+import zipfile
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from django.conf import settings
+from PIL import Image
+
+import logging
+
+log = logging.getLogger('intuity.dataset.images')
+
+ARCHIVE_TYPES = {
+    'application/zip': 'zip',
+    'application/x-zip-compressed': 'zip',
+    'application/x-tar': 'tar',
+    'application/gzip': 'tar',
+    'application/x-gzip': 'tar',
+    'application/x-gtar': 'tar',
+}
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp')
+
+CHANNELS = {'L': 1, 'RGB': 3, 'RGBA': 4}
+
+# Raised by Pillow 5+ for images far above Image.MAX_IMAGE_PIXELS.
+BOMB_ERRORS = tuple(e for e in (getattr(Image, 'DecompressionBombError', None),) if e is not None)
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+_pools = {}
+
+
+def get_pool(kind=None, workers=None):
+    """
+    Decoding pools are created once per process and reused by every upload.
+    PIL releases the GIL while decoding and resizing, so threads scale well;
+    processes avoid the remaining Python overhead at the cost of pickling.
+    """
+    kind = kind or settings.IMAGE_POOL
+    workers = workers or settings.IMAGE_WORKERS
+    key = (kind, workers)
+    if key not in _pools:
+        if kind == 'process':
+            _pools[key] = multiprocessing.Pool(workers)
+        else:
+            _pools[key] = ThreadPool(workers)
+    return _pools[key]
+
+
+def decode_image(args):
+    """
+    Decodes an encoded image into a (height, width, channels) uint8 array,
+    or returns None if it cannot be read. Raises ImageTooLarge for images
+    Pillow refuses to decompress.
+    """
+    content, size, mode = args
+    try:
+        image = Image.open(io.BytesIO(content))
+        # JPEG can decode directly at a reduced scale, which is much cheaper
+        # than decoding at full size and resizing.
+        image.draft(mode, size)
+        image = image.convert(mode)
+        if image.size != size:
+            image = image.resize(size, Image.BILINEAR)
+        array = np.asarray(image, dtype=np.uint8)
+    except BOMB_ERRORS as e:
+        raise ImageTooLarge(str(e))
+    except (IOError, ValueError, SyntaxError) as e:
+        log.debug("Cannot decode image: %s", e)
+        return None
+    return array.reshape(size[1], size[0], CHANNELS[mode])
+
+
+def decode_batch(contents, size, mode, pool=None):
+    """
+    Decodes a batch in parallel. Returns the stacked pixels and a boolean
+    mask of the inputs that could be decoded.
+    """
+    pool = pool or get_pool()
+    arrays = pool.map(decode_image, [(content, size, mode) for content in contents])
+    decoded = np.array([a is not None for a in arrays], dtype=bool)
+    pixels = np.empty((int(decoded.sum()), size[1], size[0], CHANNELS[mode]), dtype=np.uint8)
+    for i, array in enumerate(a for a in arrays if a is not None):
+        pixels[i] = array
+    return pixels, decoded
+
+
+def is_image(name):
+    return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS and not os.path.basename(name).startswith('.')
+
+
+def member_label(name):
+    # Archives are laid out as <label>/<image>, like most image datasets.
+    directory = os.path.dirname(name.strip('/'))
+    return os.path.basename(directory) or None
+
+
+def iter_archive(stream, kind):
+    """
+    Yields (name, content) for every image in a zip or tar archive. Tar
+    archives are read as a stream; zip needs random access so the body is
+    spooled to a temporary file first.
+    """
+    if kind == 'tar':
+        with tarfile.open(fileobj=stream, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile() and is_image(member.name):
+                    yield member.name, archive.extractfile(member).read()
+        return
+
+    with tempfile.SpooledTemporaryFile(max_size=settings.IMAGE_SPOOL_SIZE) as f:
+        while True:
+            chunk = stream.read(64 * 1024)
+            if not chunk:
+                break
+            f.write(chunk)
+        f.seek(0)
+        with zipfile.ZipFile(f) as archive:
+            for info in archive.infolist():
+                if not info.filename.endswith('/') and is_image(info.filename):
+                    yield info.filename, archive.read(info)
+
+
+def iter_batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,83 @@
+import io
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from PIL import Image
+
+from dataset.images import decode_batch, get_pool, iter_batches
+from storage.backends import ArrayStorage
+
+
+def sample_images(count, width, height, quality=90):
+    """
+    Encodes `count` distinct JPEGs of the given size: smooth gradients with
+    some noise, which compress like photos rather than like pure noise.
+    """
+    random = np.random.RandomState(0)
+    y, x = np.mgrid[0:height, 0:width]
+    images = []
+    for i in range(count):
+        base = (x * (i % 7 + 1) + y * (i % 5 + 1)) % 256
+        pixels = np.dstack([base, (base + 85 * i) % 256, 255 - base]).astype(np.int16)
+        pixels += random.randint(-16, 16, pixels.shape)
+        f = io.BytesIO()
+        Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(f, 'JPEG', quality=quality)
+        images.append(f.getvalue())
+    return images
+
+
+class Command(BaseCommand):
+    help = 'Measures image decoding and storage throughput in images per second.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1000)
+        parser.add_argument('--source', type=int, nargs=2, default=(640, 480), metavar=('WIDTH', 'HEIGHT'))
+        parser.add_argument('--size', type=int, nargs=2, default=None, metavar=('WIDTH', 'HEIGHT'))
+        parser.add_argument('--mode', default=None)
+        parser.add_argument('--pool', choices=('thread', 'process'), default=None)
+        parser.add_argument('--workers', type=int, nargs='+', default=None)
+        parser.add_argument('--batch-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        size = tuple(options['size'] or settings.IMAGE_SIZE)
+        mode = options['mode'] or settings.IMAGE_MODE
+        kind = options['pool'] or settings.IMAGE_POOL
+        batch_size = options['batch_size'] or settings.IMAGE_BATCH_SIZE
+        workers = options['workers'] or [1, settings.IMAGE_WORKERS]
+
+        images = sample_images(options['count'], *options['source'])
+        megabytes = sum(len(image) for image in images) / 1024. / 1024.
+        self.stdout.write('{} JPEGs of {}x{} ({:.1f} MB) to {}x{} {}, {} pool, batches of {}'.format(
+            len(images), options['source'][0], options['source'][1], megabytes, size[0], size[1], mode,
+            kind, batch_size
+        ))
+
+        for n in workers:
+            pool = get_pool(kind, n)
+            root = tempfile.mkdtemp()
+            try:
+                storage = ArrayStorage('benchmark', root=root)
+                decoding = 0.
+                started = time.time()
+                for batch in iter_batches(images, batch_size):
+                    decode_started = time.time()
+                    pixels, decoded = decode_batch(batch, size, mode, pool=pool)
+                    decoding += time.time() - decode_started
+                    storage.append('pixels', pixels)
+                total = time.time() - started
+                stored = storage.load('pixels')
+                read_started = time.time()
+                checksum = int(stored.reshape(stored.shape[0], -1).sum(dtype=np.uint64))
+                reading = time.time() - read_started
+            finally:
+                shutil.rmtree(root, ignore_errors=True)
+            self.stdout.write(
+                '{:>3} workers: decode {:8.1f} img/s, decode+store {:8.1f} img/s, '
+                'read back {:10.1f} img/s ({})'.format(
+                    n, len(images) / decoding, len(images) / total, stored.shape[0] / max(reading, 1e-9), checksum
+                )
+            )
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageSet',
+            fields=[
+                ('uuid', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('width', models.IntegerField()),
+                ('height', models.IntegerField()),
+                ('mode', models.CharField(max_length=8)),
+                ('labels', models.TextField(default='[]')),
+                ('date_created', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -1,5 +1,87 @@
 from __future__ import unicode_literals
 
-from django.db import models
+import json
+import os
 
-# Create your models here.
+from django.db import models, transaction
+from django.utils import timezone
+import numpy as np
+
+from dataset.images import CHANNELS
+from storage.backends import ArrayStorage
+
+import logging
+
+log = logging.getLogger('intuity.dataset.models')
+
+
+class ImageSet(models.Model):
+    """
+    Decoded images of one training, kept as a single (n, height, width,
+    channels) uint8 array on disk. Labels are coded by insertion order.
+    """
+    uuid = models.CharField(max_length=64, null=False, blank=False, primary_key=True)
+    width = models.IntegerField()
+    height = models.IntegerField()
+    mode = models.CharField(max_length=8)
+    labels = models.TextField(default='[]')
+    date_created = models.DateTimeField(default=timezone.now)
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    @property
+    def shape(self):
+        return self.height, self.width, CHANNELS[self.mode]
+
+    @property
+    def storage(self):
+        if not hasattr(self, '_storage'):
+            self._storage = ArrayStorage(os.path.join('images', self.uuid))
+        return self._storage
+
+    @property
+    def pixels(self):
+        pixels = self.storage.load('pixels')
+        if pixels.ndim != 4:
+            return np.empty((0,) + self.shape, dtype=np.uint8)
+        return pixels
+
+    @property
+    def data_array(self):
+        # A reshape of the memory map, so estimators read the pages directly.
+        pixels = self.pixels
+        return pixels.reshape(pixels.shape[0], -1)
+
+    @property
+    def target_array(self):
+        return self.storage.load('target')
+
+    @property
+    def labels_list(self):
+        return json.loads(self.labels)
+
+    def append(self, pixels, labels):
+        """
+        Appends decoded images and their labels. Appends to the same set are
+        serialized on the storage lock, as select_for_update does nothing on
+        SQLite, so the labels and both arrays stay aligned.
+        """
+        with self.storage.lock(), transaction.atomic():
+            locked = ImageSet.objects.select_for_update().get(pk=self.pk)
+            known = locked.labels_list
+            codes = dict((label, code) for code, label in enumerate(known))
+            for label in labels:
+                if label not in codes:
+                    codes[label] = len(known)
+                    known.append(label)
+            if len(known) != len(locked.labels_list):
+                locked.labels = json.dumps(known)
+                locked.save(update_fields=['labels'])
+            self.labels = locked.labels
+            # The target is appended last and commits a batch.
+            self.storage.truncate('pixels', self.storage.load_array('target').shape[0])
+            self.storage.append('pixels', pixels)
+            self.storage.append('target', np.array([codes[label] for label in labels], dtype=np.int64))
+        log.debug("Appended %s images to %s", pixels.shape[0], self.uuid)
@@ -1,3 +1,36 @@
-from django.test import TestCase
+import io
 
-# Create your tests here.
+import numpy as np
+from django.test import SimpleTestCase
+from PIL import Image
+
+from dataset.images import ImageTooLarge, decode_image
+
+
+def encode(size, format='PNG'):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (255, 0, 0)).save(buffer, format=format)
+    return buffer.getvalue()
+
+
+class DecodeImageTest(SimpleTestCase):
+
+    def test_decodes_and_resizes(self):
+        array = decode_image((encode((40, 20)), (8, 4), 'L'))
+        self.assertEqual(array.shape, (4, 8, 1))
+        self.assertEqual(array.dtype, np.uint8)
+
+    def test_unreadable_images_are_skipped(self):
+        self.assertIsNone(decode_image((b'not an image', (8, 8), 'RGB')))
+
+    def test_rejects_decompression_bombs(self):
+        if not hasattr(Image, 'DecompressionBombError'):
+            self.skipTest('Pillow without DecompressionBombError')
+        content = encode((64, 64))
+        limit = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = 1000
+        try:
+            with self.assertRaises(ImageTooLarge):
+                decode_image((content, (8, 8), 'RGB'))
+        finally:
+            Image.MAX_IMAGE_PIXELS = limit
@@ -1,3 +1,105 @@
-from django.shortcuts import render
+import tarfile
+import time
+import zipfile
 
-# Create your views here.
+from django.conf import settings
+from django.shortcuts import Http404
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from intuity_common.auth import validate_token
+from intuity_common.renderers import MsgPackRenderer, NumpyJSONRenderer
+
+from dataset.images import (
+    ARCHIVE_TYPES, CHANNELS, ImageTooLarge, decode_batch, iter_archive, iter_batches, member_label
+)
+from dataset.models import ImageSet
+
+import logging
+
+log = logging.getLogger('intuity.dataset.views')
+
+
+def image_set_params(request):
+    width, height = settings.IMAGE_SIZE
+    width = int(request.GET.get('width', width))
+    height = int(request.GET.get('height', height))
+    mode = request.GET.get('mode', settings.IMAGE_MODE)
+    if not 0 < width <= 1024 or not 0 < height <= 1024:
+        raise ValueError('width and height must be between 1 and 1024')
+    if mode not in CHANNELS:
+        raise ValueError('mode must be one of {}'.format(', '.join(sorted(CHANNELS))))
+    return {'width': width, 'height': height, 'mode': mode}
+
+
+class ImageApi(APIView):
+    """
+    GET
+        URL: /v1/dataset/images/?token={token}
+    POST
+        URL: /v1/dataset/images/?token={token}[&target={label}][&width={px}&height={px}&mode=RGB|L|RGBA]
+        DATA: a single image (image/*, target required) or a zip or tar
+        archive laid out as <label>/<image>. Images are decoded in parallel
+        and appended to the set; its shape is fixed by the first upload.
+    """
+
+    parser_classes = ()
+    renderer_classes = (NumpyJSONRenderer, MsgPackRenderer)
+
+    def get_view_name(self):
+        return 'Images'
+
+    @validate_token
+    def get(self, request, payload):
+        try:
+            image_set = ImageSet.objects.get(pk=payload['uuid'])
+        except ImageSet.DoesNotExist:
+            raise Http404
+        return Response({
+            'images': image_set.pixels.shape[0],
+            'shape': image_set.shape,
+            'labels': image_set.labels_list,
+        })
+
+    @validate_token
+    def post(self, request, payload):
+        content_type = request.META.get('CONTENT_TYPE', '').split(';')[0].strip()
+        target = request.GET.get('target')
+        if request.stream is None:
+            return Response({'error': 'Invalid input: no images'}, status=400)
+        if content_type.startswith('image/'):
+            if not target:
+                return Response({'error': 'Invalid input: missing target'}, status=400)
+            items = [('image', request.stream.read())]
+        elif content_type in ARCHIVE_TYPES:
+            items = iter_archive(request.stream, ARCHIVE_TYPES[content_type])
+        else:
+            return Response({'error': 'Invalid input: image, zip or tar expected'}, status=400)
+
+        try:
+            params = image_set_params(request)
+        except ValueError as e:
+            return Response({'error': 'Invalid input: {}'.format(e)}, status=400)
+        image_set, created = ImageSet.objects.get_or_create(pk=payload['uuid'], defaults=params)
+
+        added = failed = 0
+        started = time.time()
+        try:
+            for batch in iter_batches(items, settings.IMAGE_BATCH_SIZE):
+                labels = [target or member_label(name) for name, content in batch]
+                failed += sum(1 for label in labels if label is None)
+                batch = [(label, content) for label, (name, content) in zip(labels, batch) if label is not None]
+                pixels, decoded = decode_batch([content for label, content in batch], image_set.size, image_set.mode)
+                image_set.append(pixels, [label for (label, content), ok in zip(batch, decoded) if ok])
+                added += pixels.shape[0]
+                failed += len(batch) - pixels.shape[0]
+        except (tarfile.TarError, zipfile.BadZipfile, EOFError, ImageTooLarge) as e:
+            return Response({'error': 'Invalid input: {}'.format(e), 'images': added, 'failed': failed}, status=400)
+
+        elapsed = time.time() - started
+        log.info("Stored %s images (%s failed) in %.2fs", added, failed, elapsed)
+        return Response({
+            'images': added,
+            'failed': failed,
+            'total': image_set.pixels.shape[0],
+            'shape': image_set.shape,
+        })
@@ -40,6 +40,9 @@ INSTALLED_APPS = (
     'django.contrib.staticfiles',
     'rest_framework',
     'intuity',
+    'dataset',
+    'model',
+    'storage',
     'training'
 )
 
@@ -52,6 +55,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'intuity_common.auth.TokenMiddleware',
 )
 
 ROOT_URLCONF = 'intuity.urls'
@@ -105,6 +109,118 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# Fitted estimators kept in memory per process, bounded in number and in
+# pickled bytes; the least recently used are evicted first.
+MODEL_CACHE_SIZE = 64
+MODEL_CACHE_BYTES = 512 * 1024 * 1024
+
+# Inactive model versions kept in the registry per training, how often (in
+# seconds) a process records that a model is in use, and whether serving
+# processes preload the most recently used models when they start.
+MODEL_HISTORY = 3
+MODEL_TOUCH_INTERVAL = 60
+MODEL_PRELOAD = True
+
+# Training arrays are kept as memory mapped .npy files under this directory.
+STORAGE_ROOT = os.path.join(BASE_DIR, 'var', 'storage')
+
+# Store feature matrices as float32 instead of float64, halving their size.
+STORAGE_FLOAT32 = False
+
+# Rows per chunk when streaming stored data through incremental estimators.
+TRAINING_CHUNK_SIZE = 10000
+
+# Worker processes used by `manage.py trainingworker` and how often (in
+# seconds) it polls the job table for queued trainings.
+TRAINING_WORKERS = 2
+TRAINING_POLL_INTERVAL = 1.0
+# Seconds a running job keeps its lease without a heartbeat before another
+# worker takes it back, and how many times a job is started before a lost
+# one is failed instead of requeued.
+TRAINING_JOB_LEASE = 60
+TRAINING_JOB_ATTEMPTS = 3
+
+# Fraction of rows held out when scoring a classifier, and how many cores
+# k-fold cross-validation may use (-1 means all of them).
+EVALUATION_TEST_SIZE = 0.2
+EVALUATION_JOBS = -1
+
+# Cluster counts tried by process_clustering when the request does not set
+# `clusters`, the cores used to fit them and the silhouette sample size.
+CLUSTERING_SWEEP = (2, 3, 5)
+CLUSTERING_JOBS = -1
+CLUSTERING_SAMPLE_SIZE = 10000
+
+# Clustering sweeps switch from KMeans to MiniBatchKMeans above this many rows.
+CLUSTERING_MINIBATCH_ROWS = 100000
+
+# Job type of trainings whose token does not name one.
+TRAINING_DEFAULT_JOB_TYPE = 'clustering'
+
+# Estimator tiers picked by training.engine: kernel SVM up to
+# ENGINE_KERNEL_MAX_ROWS rows and ENGINE_KERNEL_MAX_FEATURES features, a
+# Nystroem approximation with ENGINE_NYSTROEM_COMPONENTS components up to
+# ENGINE_APPROXIMATE_MAX_ROWS, a linear model up to ENGINE_LINEAR_MAX_ROWS and
+# SGD streamed over the stored chunks above that.
+ENGINE_KERNEL_MAX_ROWS = 10000
+ENGINE_KERNEL_MAX_FEATURES = 1000
+ENGINE_NYSTROEM_COMPONENTS = 300
+ENGINE_APPROXIMATE_MAX_ROWS = 200000
+ENGINE_LINEAR_MAX_ROWS = 2000000
+
+# Widest data fitted by the least squares regressor, whose sufficient
+# statistics hold (features + 1)^2 floats; wider regressions use SGD.
+REGRESSION_MAX_FEATURES = 4096
+
+# Classifications with more than ENGINE_KERNEL_MAX_ROWS rows and at most
+# ENGINE_NEIGHBORS_MAX_FEATURES features (0 disables it) are served by a
+# persisted NEIGHBORS_K nearest neighbour index: a KD-tree up to
+# NEIGHBORS_TREE_MAX_FEATURES features, random projection buckets above.
+ENGINE_NEIGHBORS_MAX_FEATURES = 128
+NEIGHBORS_K = 5
+NEIGHBORS_TREE_MAX_FEATURES = 16
+
+# Random projection index: hash tables and signature bits per table, fixed
+# when it is built, and bits flipped when probing and candidates reranked
+# per query. More of any of them raise recall and latency.
+NEIGHBORS_LSH_TABLES = 8
+NEIGHBORS_LSH_BITS = 16
+NEIGHBORS_LSH_PROBES = 2
+NEIGHBORS_LSH_CANDIDATES = 200
+
+# Default and maximum page sizes of training exports.
+EXPORT_PAGE_SIZE = 1000
+EXPORT_MAX_PAGE_SIZE = 10000
+
+# Uploaded images are resized to IMAGE_SIZE (width, height) in IMAGE_MODE
+# unless the first upload of a set asks otherwise.
+IMAGE_SIZE = (64, 64)
+IMAGE_MODE = 'RGB'
+
+# Images are decoded IMAGE_BATCH_SIZE at a time by a pool of IMAGE_WORKERS
+# threads, or processes when IMAGE_POOL is 'process'.
+IMAGE_BATCH_SIZE = 256
+IMAGE_WORKERS = 4
+IMAGE_POOL = 'thread'
+
+# Zip uploads larger than this are spooled to disk instead of memory.
+IMAGE_SPOOL_SIZE = 64 * 1024 * 1024
+
+# Coalesce concurrent predictions for the same training into one predict
+# call, waiting at most PREDICTION_BATCH_WINDOW seconds for up to
+# PREDICTION_BATCH_MAX_ROWS rows. Needs a threaded server.
+PREDICTION_BATCHING = False
+PREDICTION_BATCH_WINDOW = 0.002
+PREDICTION_BATCH_MAX_ROWS = 256
+
+# Token verification, documented in intuity_common.auth.
+AUTH_AUDIENCE = 'curiosity'
+AUTH_ISSUER = 'authority'
+AUTH_CACHE_SIZE = 10000
+AUTH_CACHE_TTL = 300
+AUTH_INTERNAL_KEY = SECRET_KEY
+AUTH_INTERNAL_MAX_AGE = 60
+
 
 LOGGING = {
     'version': 1,
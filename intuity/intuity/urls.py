@@ -15,10 +15,15 @@ Including another URLconf
 """
 from django.conf.urls import include, url
 from django.contrib import admin
-from training.views import TrainingApi, PredictionApi
+from dataset.views import ImageApi
+from prediction.views import BatchingStatsApi
+from training.views import TrainingApi, PredictionApi, JobApi
 
 urlpatterns = [
     url(r'^admin/', include(admin.site.urls)),
     url(r'^v1/training/$', TrainingApi.as_view()),
+    url(r'^v1/training/jobs/(?P<job_id>[0-9a-f]+)/$', JobApi.as_view()),
     url(r'^v1/prediction/$', PredictionApi.as_view()),
+    url(r'^v1/prediction/batching/$', BatchingStatsApi.as_view()),
+    url(r'^v1/dataset/images/$', ImageApi.as_view()),
 ]
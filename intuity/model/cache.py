@@ -0,0 +1,64 @@
+from collections import OrderedDict
+import threading
+
+from django.conf import settings
+
+import logging
+
+log = logging.getLogger('intuity.model.cache')
+
+
+class LRUCache(object):
+    """
+    Least recently used cache bounded both by a number of items and by the
+    sum of their declared sizes in bytes.
+    """
+
+    def __init__(self, size, max_bytes=None):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value, nbytes = self.items.pop(key)
+            except KeyError:
+                return None
+            self.items[key] = (value, nbytes)
+            return value
+
+    def set(self, key, value, nbytes=0):
+        with self.lock:
+            self.discard(key)
+            self.items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while len(self.items) > 1 and (
+                    len(self.items) > self.size or (self.max_bytes and self.nbytes > self.max_bytes)):
+                evicted, (_, evicted_bytes) = self.items.popitem(last=False)
+                self.nbytes -= evicted_bytes
+                log.debug("Evicted %s from cache (%s bytes)", evicted, evicted_bytes)
+
+    def discard(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.nbytes -= item[1]
+
+    def invalidate(self, uuid, keep=None):
+        """
+        Drops every cached version of the given training except `keep`.
+        """
+        with self.lock:
+            for key in [k for k in self.items if k[0] == uuid and k != keep]:
+                self.discard(key)
+
+    def full(self, nbytes=0):
+        return len(self.items) >= self.size or bool(self.max_bytes and self.nbytes + nbytes > self.max_bytes)
+
+    def __len__(self):
+        return len(self.items)
+
+
+estimators = LRUCache(getattr(settings, 'MODEL_CACHE_SIZE', 64), getattr(settings, 'MODEL_CACHE_BYTES', None))
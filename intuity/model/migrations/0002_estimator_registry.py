@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def activate_stored(apps, schema_editor):
+    # Until now only the latest version of each training was kept.
+    Estimator = apps.get_model('model', 'Estimator')
+    for estimator in Estimator.objects.all():
+        estimator.active = True
+        estimator.size = len(estimator.blob)
+        estimator.save(update_fields=['active', 'size'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('model', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='estimator',
+            name='kind',
+            field=models.CharField(default='', max_length=128),
+        ),
+        migrations.AddField(
+            model_name='estimator',
+            name='params',
+            field=models.TextField(default='{}'),
+        ),
+        migrations.AddField(
+            model_name='estimator',
+            name='fingerprint',
+            field=models.CharField(default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='estimator',
+            name='metrics',
+            field=models.TextField(default='null'),
+        ),
+        migrations.AddField(
+            model_name='estimator',
+            name='size',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='estimator',
+            name='active',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='estimator',
+            name='date_used',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(activate_stored, migrations.RunPython.noop),
+    ]
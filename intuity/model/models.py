@@ -1,5 +1,93 @@
 from __future__ import unicode_literals
 
-from django.db import models
+import json
 
-# Create your models here.
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+
+import logging
+
+log = logging.getLogger('intuity.model.models')
+
+
+def estimator_params(estimator):
+    try:
+        params = estimator.get_params(deep=False)
+    except AttributeError:
+        return {}
+    return json.loads(json.dumps(params, default=repr))
+
+
+class Estimator(models.Model):
+    """
+    One fitted model version of a training. At most one version per
+    training is active: the one predictions are served from.
+    """
+    training = models.CharField(max_length=64, null=False, blank=False, db_index=True)
+    version = models.IntegerField(default=0)
+    blob = models.BinaryField()
+    kind = models.CharField(max_length=128, default='')
+    params = models.TextField(default='{}')
+    fingerprint = models.CharField(max_length=64, default='')
+    metrics = models.TextField(default='null')
+    size = models.IntegerField(default=0)
+    active = models.BooleanField(default=False, db_index=True)
+    date_created = models.DateTimeField(default=timezone.now)
+    date_used = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        unique_together = ('training', 'version')
+
+    @classmethod
+    def register(cls, training, version, estimator, fingerprint='', metrics=None):
+        blob = pickle.dumps(estimator, pickle.HIGHEST_PROTOCOL)
+        log.debug("Registering estimator %s for training %s version %s (%s bytes)",
+                  type(estimator).__name__, training, version, len(blob))
+        obj, created = cls.objects.update_or_create(training=training, version=version, defaults={
+            'blob': blob,
+            'kind': type(estimator).__name__,
+            'params': json.dumps(estimator_params(estimator), sort_keys=True),
+            'fingerprint': fingerprint,
+            'metrics': json.dumps(metrics),
+            'size': len(blob),
+            'date_created': timezone.now(),
+        })
+        return obj
+
+    @classmethod
+    def activate(cls, training, version):
+        """
+        Makes `version` the active model of the training in one transaction,
+        unless a newer version is already active, and prunes old versions
+        beyond MODEL_HISTORY. Returns whether the version was activated.
+        """
+        with transaction.atomic():
+            versions = cls.objects.select_for_update().filter(training=training)
+            if versions.filter(active=True, version__gt=version).exists():
+                return False
+            versions.filter(active=True).exclude(version=version).update(active=False)
+            versions.filter(version=version).update(active=True, date_used=timezone.now())
+            stale = list(versions.filter(active=False).order_by('-version')
+                         .values_list('pk', flat=True)[settings.MODEL_HISTORY:])
+            if stale:
+                cls.objects.filter(pk__in=stale).delete()
+        log.debug("Activated version %s of training %s", version, training)
+        return True
+
+    @property
+    def estimator(self):
+        return pickle.loads(bytes(self.blob))
+
+    @property
+    def metrics_object(self):
+        return json.loads(self.metrics)
+
+    @property
+    def params_object(self):
+        return json.loads(self.params)
@@ -0,0 +1,97 @@
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+
+from model.cache import estimators
+from model.models import Estimator
+
+import logging
+
+log = logging.getLogger('intuity.model.registry')
+
+
+class ModelRegistry(object):
+    """
+    Serves fitted estimators by (training, version) from a per-process cache
+    bounded by MODEL_CACHE_SIZE models and MODEL_CACHE_BYTES bytes, loading
+    them from the Estimator table on a miss.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.touched = {}
+        self.lock = threading.Lock()
+
+    def publish(self, training, version, estimator, fingerprint='', metrics=None):
+        """
+        Records a new version and makes it the active one. The estimator is
+        cached first, so the swap never causes a miss in this process.
+        """
+        with transaction.atomic():
+            record = Estimator.register(training, version, estimator, fingerprint=fingerprint, metrics=metrics)
+            self.cache.set((training, version), estimator, record.size)
+            activated = Estimator.activate(training, version)
+        if activated:
+            self.cache.invalidate(training, keep=(training, version))
+        return record, activated
+
+    def get(self, training, version):
+        key = (training, version)
+        estimator = self.cache.get(key)
+        if estimator is not None:
+            self.touch(training, version)
+            return estimator
+        try:
+            record = Estimator.objects.get(training=training, version=version)
+        except Estimator.DoesNotExist:
+            return None
+        estimator = record.estimator
+        log.debug("Estimator for %s version %s loaded from store", training, version)
+        self.cache.set(key, estimator, record.size)
+        self.touch(training, version)
+        return estimator
+
+    def touch(self, training, version):
+        # date_used orders preloading; it is written at most once per
+        # MODEL_TOUCH_INTERVAL per model and process.
+        now = time.time()
+        with self.lock:
+            if now - self.touched.get(training, 0) < settings.MODEL_TOUCH_INTERVAL:
+                return
+            self.touched[training] = now
+        Estimator.objects.filter(training=training, version=version).update(date_used=timezone.now())
+
+    def preload(self, limit=None):
+        """
+        Loads the most recently used active models until the cache budget is
+        reached. Returns the number of models loaded.
+        """
+        limit = limit or self.cache.size
+        active = Estimator.objects.filter(active=True).order_by('-date_used')
+        loaded = 0
+        for pk, training, version, size in active.values_list('pk', 'training', 'version', 'size')[:limit]:
+            if self.cache.full(size):
+                break
+            if self.cache.get((training, version)) is None:
+                self.cache.set((training, version), Estimator.objects.get(pk=pk).estimator, size)
+                loaded += 1
+        log.info("Preloaded %s models (%s bytes)", loaded, self.cache.nbytes)
+        return loaded
+
+    def preload_async(self):
+        def run():
+            try:
+                self.preload()
+            except DatabaseError:
+                log.exception("Preloading models failed")
+
+        thread = threading.Thread(target=run, name='model-preload')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+registry = ModelRegistry(estimators)
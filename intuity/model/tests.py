@@ -1,3 +1,39 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from model.cache import LRUCache
+
+
+class LRUCacheTest(SimpleTestCase):
+
+    def test_evicts_least_recently_used_items(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+
+    def test_evicts_to_stay_within_bytes(self):
+        cache = LRUCache(10, max_bytes=100)
+        cache.set('a', 1, 60)
+        cache.set('b', 2, 30)
+        self.assertFalse(cache.full(10))
+        self.assertTrue(cache.full(11))
+        cache.set('c', 3, 50)
+        self.assertEqual((cache.get('a'), len(cache), cache.nbytes), (None, 2, 80))
+        cache.set('b', 2, 10)
+        self.assertEqual(cache.nbytes, 60)
+
+    def test_keeps_a_single_item_larger_than_the_budget(self):
+        cache = LRUCache(10, max_bytes=100)
+        cache.set('a', 1, 10)
+        cache.set('b', 2, 500)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.nbytes), (None, 2, 500))
+
+    def test_invalidates_other_versions_of_a_training(self):
+        cache = LRUCache(10)
+        for key in (('t', 1), ('t', 2), ('u', 1)):
+            cache.set(key, key, 1)
+        cache.invalidate('t', keep=('t', 2))
+        self.assertEqual(list(cache.items), [('t', 2), ('u', 1)])
+        self.assertEqual(cache.nbytes, 2)
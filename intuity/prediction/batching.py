@@ -0,0 +1,146 @@
+import collections
+import threading
+import time
+
+import numpy as np
+import scipy.sparse as sp
+from django.conf import settings
+
+import logging
+
+log = logging.getLogger('intuity.prediction.batching')
+
+
+class Batch(object):
+
+    def __init__(self):
+        self.parts = []
+        self.rows = 0
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def add(self, rows):
+        offset = self.rows
+        self.parts.append(rows)
+        self.rows += rows.shape[0]
+        return offset
+
+    def matrix(self):
+        if len(self.parts) == 1:
+            return self.parts[0]
+        if any(sp.issparse(part) for part in self.parts):
+            return sp.vstack(self.parts, format='csr')
+        return np.vstack(self.parts)
+
+
+class BatchStats(object):
+    """
+    Counters and a histogram of batch sizes, bucketed by powers of two.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.histogram = collections.Counter()
+
+    def observe(self, batch, waited, elapsed):
+        bucket = batch.rows.bit_length() - 1 if batch.rows else 0
+        with self.lock:
+            self.counters['batches'] += 1
+            self.counters['requests'] += len(batch.parts)
+            self.counters['rows'] += batch.rows
+            self.counters['wait'] += waited
+            self.counters['predict'] += elapsed
+            self.histogram[bucket] += 1
+
+    def incr(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def as_dict(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histogram = dict(self.histogram)
+        batches = counters.get('batches', 0)
+        stats = {
+            'batches': batches,
+            'requests': counters.get('requests', 0),
+            'rows': counters.get('rows', 0),
+            'bypassed': counters.get('bypassed', 0),
+            'mean_rows': float(counters.get('rows', 0)) / batches if batches else None,
+            'mean_requests': float(counters.get('requests', 0)) / batches if batches else None,
+            'mean_wait_ms': counters.get('wait', 0) * 1000 / batches if batches else None,
+            'mean_predict_ms': counters.get('predict', 0) * 1000 / batches if batches else None,
+        }
+        stats['histogram'] = collections.OrderedDict(
+            ('{}-{}'.format(2 ** b, 2 ** (b + 1) - 1) if b else '1', histogram[b]) for b in sorted(histogram)
+        )
+        return stats
+
+
+class MicroBatcher(object):
+    """
+    Coalesces concurrent predictions for the same key. The first request to
+    arrive leads a batch: it waits up to `window` seconds, or until
+    `max_rows` rows have joined, runs a single predict over all of them and
+    hands every request its slice of the result.
+    """
+
+    def __init__(self, window, max_rows):
+        self.window = window
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.stats = BatchStats()
+
+    def predict(self, key, rows, predict):
+        if rows.shape[0] >= self.max_rows:
+            self.stats.incr('bypassed')
+            return predict(rows)
+
+        with self.lock:
+            batch = self.pending.get(key)
+            leader = batch is None or batch.rows + rows.shape[0] > self.max_rows
+            if leader:
+                if batch is not None:
+                    batch.full.set()
+                batch = self.pending[key] = Batch()
+            offset = batch.add(rows)
+            if batch.rows >= self.max_rows:
+                batch.full.set()
+
+        if leader:
+            self.run(key, batch, predict)
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return batch.result[offset:offset + rows.shape[0]]
+
+    def run(self, key, batch, predict):
+        started = time.time()
+        batch.full.wait(self.window)
+        with self.lock:
+            if self.pending.get(key) is batch:
+                del self.pending[key]
+        waited = time.time() - started
+        try:
+            batch.result = predict(batch.matrix())
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+        self.stats.observe(batch, waited, time.time() - started - waited)
+        log.debug("Predicted %s rows for %s requests", batch.rows, len(batch.parts))
+
+    def as_dict(self):
+        stats = self.stats.as_dict()
+        stats['window_ms'] = self.window * 1000
+        stats['max_rows'] = self.max_rows
+        return stats
+
+
+batcher = MicroBatcher(settings.PREDICTION_BATCH_WINDOW, settings.PREDICTION_BATCH_MAX_ROWS)
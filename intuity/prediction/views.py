@@ -1,3 +1,27 @@
-from django.shortcuts import render
+from django.conf import settings
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from intuity_common.auth import validate_token
+from intuity_common.renderers import MsgPackRenderer, NumpyJSONRenderer
 
-# Create your views here.
+from prediction.batching import batcher
+
+
+class BatchingStatsApi(APIView):
+    """
+    GET
+        URL: /v1/prediction/batching/?token={token}
+        Window, batch limit, counters and a histogram of the batch sizes
+        (in rows) achieved by this process' prediction micro-batching.
+    """
+
+    renderer_classes = (NumpyJSONRenderer, MsgPackRenderer)
+
+    def get_view_name(self):
+        return 'Prediction batching'
+
+    @validate_token
+    def get(self, request, payload):
+        stats = batcher.as_dict()
+        stats['enabled'] = settings.PREDICTION_BATCHING
+        return Response(stats)
@@ -0,0 +1,276 @@
+import contextlib
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+import scipy.sparse as sp
+from django.conf import settings
+
+import logging
+
+log = logging.getLogger('intuity.storage.backends')
+
+MAGIC = b'\x93NUMPY\x01\x00'
+
+# Headers are padded to a fixed size so that appending rows only needs to
+# rewrite the shape in place instead of the whole file.
+HEADER_SIZE = 256
+
+
+def write_header(f, dtype, shape):
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%s), }" % (
+        str(np.lib.format.dtype_to_descr(dtype)),
+        ''.join('%d,' % d for d in shape)
+    )
+    header = header.ljust(HEADER_SIZE - len(MAGIC) - 3) + '\n'
+    f.seek(0)
+    f.write(MAGIC)
+    f.write(np.array(len(header), dtype='<u2').tobytes())
+    f.write(header.encode('latin1'))
+
+
+def read_header(f):
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    return shape, fortran_order, dtype, f.tell()
+
+
+class ArrayStorage(object):
+    """
+    Keeps named NumPy arrays as .npy files under STORAGE_ROOT/<name>/.
+
+    Arrays are written atomically and read back lazily through a read-only
+    memory map, so only the pages that are actually touched end up in memory.
+    """
+
+    def __init__(self, name, root=None):
+        self.name = name
+        self.root = root or settings.STORAGE_ROOT
+        self.path = os.path.join(self.root, name)
+        self.arrays = {}
+        self.held = threading.local()
+
+    @contextlib.contextmanager
+    def lock(self):
+        """
+        Exclusive lock on the storage, shared with every process on the host.
+        Appends take it around their read-modify-write of the headers; hold
+        it around several appends to keep their arrays aligned. Reentrant
+        within a thread.
+        """
+        depth = getattr(self.held, 'depth', 0)
+        if depth:
+            self.held.depth = depth + 1
+            try:
+                yield
+            finally:
+                self.held.depth = depth
+            return
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        with open(os.path.join(self.path, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            self.held.depth = 1
+            try:
+                yield
+            finally:
+                self.held.depth = 0
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def filename(self, key):
+        return os.path.join(self.path, '{}.npy'.format(key))
+
+    def exists(self, key):
+        return os.path.exists(self.filename(key))
+
+    def save(self, key, array, dtype=None):
+        if sp.issparse(array):
+            return self.save_sparse(key, array, dtype=dtype)
+        return self.save_array(key, array, dtype=dtype)
+
+    def append(self, key, array, dtype=None):
+        """
+        Appends rows to a stored array, writing only the new rows to disk.
+        """
+        with self.lock():
+            if sp.issparse(array) or self.is_sparse(key):
+                return self.append_sparse(key, array, dtype=dtype)
+            return self.append_array(key, array, dtype=dtype)
+
+    def truncate(self, key, rows):
+        """
+        Drops the rows past `rows`, such as those an interrupted append left
+        in one array of a group whose last appended array is the commit
+        point. Call it under the lock.
+        """
+        if self.is_sparse(key):
+            self.truncate_sparse(key, rows)
+        elif self.exists(key):
+            self.truncate_array(key, rows)
+
+    def load(self, key):
+        try:
+            return self.arrays[key]
+        except KeyError:
+            pass
+        if self.is_sparse(key):
+            array = self.load_sparse(key)
+        else:
+            array = self.load_array(key)
+        self.arrays[key] = array
+        return array
+
+    def is_sparse(self, key):
+        return self.exists('{}.shape'.format(key))
+
+    def save_array(self, key, array, dtype=None):
+        array = np.ascontiguousarray(array, dtype=dtype)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write_header(f, array.dtype, array.shape)
+                array.tofile(f)
+            os.rename(tmp, self.filename(key))
+        except Exception:
+            os.unlink(tmp)
+            raise
+        self.arrays.pop(key, None)
+        log.debug("Saved %s/%s with shape %s and dtype %s", self.name, key, array.shape, array.dtype)
+        return array
+
+    def append_array(self, key, array, dtype=None):
+        filename = self.filename(key)
+        if not os.path.exists(filename):
+            return self.save_array(key, array, dtype=dtype)
+
+        with open(filename, 'r+b') as f:
+            shape, fortran_order, stored_dtype, offset = read_header(f)
+            array = np.ascontiguousarray(array, dtype=stored_dtype)
+            if array.shape[1:] != tuple(shape[1:]):
+                raise ValueError('Cannot append rows of shape {} to {}'.format(array.shape[1:], shape[1:]))
+            if offset != HEADER_SIZE or fortran_order:
+                # Written by something other than save(): rewrite it once.
+                f.close()
+                return self.save_array(key, np.concatenate([self.load_array(key), array]))
+            # Rows are written before the header, so an interrupted append
+            # leaves only unreferenced bytes behind which the next one
+            # overwrites.
+            f.seek(offset + int(np.prod(shape)) * stored_dtype.itemsize)
+            array.tofile(f)
+            f.truncate()
+            f.flush()
+            shape = (shape[0] + array.shape[0],) + tuple(shape[1:])
+            write_header(f, stored_dtype, shape)
+
+        self.arrays.pop(key, None)
+        log.debug("Appended %s rows to %s/%s, new shape %s", array.shape[0], self.name, key, shape)
+        return array
+
+    def truncate_array(self, key, rows):
+        """
+        Shrinks a stored array to at most `rows` rows, header first.
+        """
+        with open(self.filename(key), 'r+b') as f:
+            shape, fortran_order, dtype, offset = read_header(f)
+            if offset == HEADER_SIZE and not fortran_order:
+                if shape[0] > rows:
+                    shape = (rows,) + tuple(shape[1:])
+                    write_header(f, dtype, shape)
+                    log.warning("Truncated %s/%s to %s rows", self.name, key, rows)
+                # Also drops bytes past the header's shape.
+                f.truncate(offset + int(np.prod(shape)) * dtype.itemsize)
+                self.arrays.pop(key, None)
+                return
+        if shape[0] > rows:
+            self.save_array(key, np.array(self.load_array(key)[:rows]))
+
+    def load_array(self, key):
+        filename = self.filename(key)
+        if not os.path.exists(filename):
+            return np.empty((0,))
+        try:
+            return np.load(filename, mmap_mode='r')
+        except ValueError:
+            # Zero sized arrays cannot be memory mapped.
+            return np.load(filename)
+
+    def save_sparse(self, key, matrix, dtype=None):
+        """
+        CSR matrices are kept as their data, indices and indptr arrays plus a
+        small shape array, each of them memory mapped on load.
+        """
+        matrix = sp.csr_matrix(matrix, dtype=dtype)
+        matrix.sort_indices()
+        self.save_array('{}.data'.format(key), matrix.data)
+        self.save_array('{}.indices'.format(key), matrix.indices, dtype=np.int64)
+        self.save_array('{}.indptr'.format(key), matrix.indptr, dtype=np.int64)
+        self.save_array('{}.shape'.format(key), matrix.shape, dtype=np.int64)
+        if self.exists(key):
+            os.unlink(self.filename(key))
+        self.arrays.pop(key, None)
+        return matrix
+
+    def append_sparse(self, key, matrix, dtype=None):
+        if not self.exists(key) and not self.is_sparse(key):
+            return self.save_sparse(key, matrix, dtype=dtype)
+        if not self.is_sparse(key):
+            # Dense rows on disk: convert them once.
+            self.save_sparse(key, self.load_array(key))
+        matrix = sp.csr_matrix(matrix, dtype=dtype)
+        matrix.sort_indices()
+        shape = self.load_array('{}.shape'.format(key))
+        # Drop whatever an interrupted append wrote past the shape, or the
+        # new offsets would point at it.
+        nnz = self.truncate_sparse(key, int(shape[0]))
+        self.append_array('{}.data'.format(key), matrix.data)
+        self.append_array('{}.indices'.format(key), matrix.indices)
+        self.append_array('{}.indptr'.format(key), matrix.indptr[1:] + nnz)
+        # The shape is written last and bounds every read, so readers never
+        # see a partially appended batch.
+        width = max(int(shape[1]), matrix.shape[1])
+        self.save_array('{}.shape'.format(key), (int(shape[0]) + matrix.shape[0], width), dtype=np.int64)
+        self.arrays.pop(key, None)
+        return matrix
+
+    def truncate_sparse(self, key, rows):
+        """
+        Shrinks a stored CSR matrix to at most `rows` rows, shape first, and
+        cuts its arrays to what the shape references. Returns its nnz.
+        """
+        shape = self.load_array('{}.shape'.format(key))
+        if shape[0] > rows:
+            self.save_array('{}.shape'.format(key), (rows, int(shape[1])), dtype=np.int64)
+            log.warning("Truncated %s/%s to %s rows", self.name, key, rows)
+        rows = min(rows, int(shape[0]))
+        nnz = int(self.load_array('{}.indptr'.format(key))[rows])
+        self.truncate_array('{}.indptr'.format(key), rows + 1)
+        self.truncate_array('{}.data'.format(key), nnz)
+        self.truncate_array('{}.indices'.format(key), nnz)
+        self.arrays.pop(key, None)
+        return nnz
+
+    def load_sparse(self, key):
+        rows, cols = self.load_array('{}.shape'.format(key))
+        indptr = self.load_array('{}.indptr'.format(key))[:rows + 1]
+        nnz = indptr[-1]
+        return sp.csr_matrix(
+            (self.load_array('{}.data'.format(key))[:nnz], self.load_array('{}.indices'.format(key))[:nnz], indptr),
+            shape=(int(rows), int(cols))
+        )
+
+    def chunks(self, key, size):
+        array = self.load(key)
+        for start in range(0, array.shape[0], size):
+            yield array[start:start + size]
+
+    def delete(self):
+        self.arrays = {}
+        shutil.rmtree(self.path, ignore_errors=True)
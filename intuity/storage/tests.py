@@ -1,3 +1,79 @@
-from django.test import TestCase
+import multiprocessing
+import shutil
+import tempfile
 
-# Create your tests here.
+import numpy as np
+import scipy.sparse as sp
+from django.test import SimpleTestCase
+
+from storage.backends import ArrayStorage
+
+
+def append_rows(root, worker, batches):
+    storage = ArrayStorage('t', root=root)
+    for n in range(batches):
+        rows = np.full((3, 4), worker * 1000 + n, dtype=np.int64)
+        with storage.lock():
+            storage.append('data', rows)
+            storage.append('target', rows[:, 0])
+
+
+class ArrayStorageTest(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = ArrayStorage('t', root=self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_appends_dense_rows(self):
+        self.storage.save('data', np.zeros((2, 3)))
+        self.storage.append('data', np.ones((1, 3)))
+        np.testing.assert_array_equal(self.storage.load('data'), [[0, 0, 0], [0, 0, 0], [1, 1, 1]])
+        with self.assertRaises(ValueError):
+            self.storage.append('data', np.ones((1, 2)))
+
+    def test_appends_sparse_rows_with_new_columns(self):
+        self.storage.save('data', sp.csr_matrix(np.eye(2)))
+        self.storage.append('data', sp.csr_matrix(np.array([[0., 0., 3.]])))
+        np.testing.assert_array_equal(self.storage.load('data').toarray(), [[1, 0, 0], [0, 1, 0], [0, 0, 3]])
+
+    def test_lock_is_reentrant(self):
+        with self.storage.lock():
+            with self.storage.lock():
+                self.storage.append('data', np.ones((1, 2)))
+            self.storage.append('data', np.ones((1, 2)))
+        self.assertEqual(self.storage.load('data').shape, (2, 2))
+
+    def test_concurrent_appends_stay_aligned(self):
+        workers = [multiprocessing.Process(target=append_rows, args=(self.root, worker, 20)) for worker in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        data, target = self.storage.load('data'), self.storage.load('target')
+        self.assertEqual(data.shape, (240, 4))
+        np.testing.assert_array_equal(data[:, 0], target)
+        self.assertEqual(sorted(set(target.tolist())), sorted(w * 1000 + n for w in range(4) for n in range(20)))
+
+    def test_sparse_appends_drop_what_an_interrupted_append_left(self):
+        self.storage.save('data', sp.csr_matrix(np.eye(2)))
+        # Arrays written, shape never updated.
+        self.storage.append_array('data.data', np.array([7., 7.]))
+        self.storage.append_array('data.indices', np.array([0, 1]))
+        self.storage.append_array('data.indptr', np.array([4]))
+        self.assertEqual(self.storage.load('data').shape, (2, 2))
+        self.storage.append('data', sp.csr_matrix(np.array([[0., 3.]])))
+        np.testing.assert_array_equal(self.storage.load('data').toarray(), [[1, 0], [0, 1], [0, 3]])
+        self.assertEqual(self.storage.load_array('data.data').shape, (3,))
+
+    def test_truncates_rows_past_the_commit_point(self):
+        self.storage.save('data', np.arange(6.).reshape(3, 2))
+        self.storage.save('sparse', sp.csr_matrix(np.eye(3)))
+        self.storage.truncate('data', 2)
+        self.storage.truncate('sparse', 1)
+        self.storage.truncate('missing', 1)
+        np.testing.assert_array_equal(self.storage.load('data'), [[0, 1], [2, 3]])
+        np.testing.assert_array_equal(self.storage.load('sparse').toarray(), [[1, 0, 0]])
+        self.assertEqual(self.storage.load_array('sparse.indptr').shape, (2,))
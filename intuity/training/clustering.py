@@ -0,0 +1,78 @@
+import time
+
+import numpy as np
+from joblib import Parallel, delayed
+from django.conf import settings
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
+
+import logging
+
+log = logging.getLogger('intuity.training.clustering')
+
+
+class Sweep(object):
+
+    def __init__(self, results):
+        self.results = sorted(results, key=lambda r: r['n_clusters'])
+        scored = [r for r in self.results if r['score'] is not None]
+        self.best = max(scored, key=lambda r: r['score'])['n_clusters'] if scored else None
+
+    @property
+    def frequency(self):
+        return dict((str(r['n_clusters']), r['frequency']) for r in self.results)
+
+    def as_dict(self):
+        return {
+            'best': self.best,
+            'scores': dict((str(r['n_clusters']), r['score']) for r in self.results),
+            'inertia': dict((str(r['n_clusters']), r['inertia']) for r in self.results),
+            'fit_time': dict((str(r['n_clusters']), r['fit_time']) for r in self.results),
+            'algorithm': self.results[0]['algorithm'] if self.results else None,
+        }
+
+
+def fit_kmeans(X, n_clusters, sample_size, minibatch_rows):
+    start = time.time()
+    if X.shape[0] > minibatch_rows:
+        model = MiniBatchKMeans(n_clusters=n_clusters, random_state=0)
+    else:
+        model = KMeans(n_clusters=n_clusters, random_state=0)
+    model.fit(X)
+    fit_time = time.time() - start
+
+    counts = np.bincount(model.labels_, minlength=n_clusters)
+    score = None
+    if len(np.unique(model.labels_)) > 1:
+        # Silhouette is quadratic in rows, so it is estimated on a sample.
+        score = float(silhouette_score(
+            X, model.labels_, sample_size=min(sample_size, X.shape[0]), random_state=0
+        ))
+    log.debug("%s with %s clusters: score %s, fitted in %.3fs", type(model).__name__, n_clusters, score, fit_time)
+    return {
+        'n_clusters': n_clusters,
+        'algorithm': type(model).__name__,
+        'frequency': dict((str(label), int(count)) for label, count in enumerate(counts) if count),
+        'score': score,
+        'inertia': float(model.inertia_),
+        'fit_time': fit_time,
+    }
+
+
+def sweep(X, clusters=None, n_jobs=None, sample_size=None):
+    """
+    Fits KMeans for every cluster count concurrently, MiniBatchKMeans above
+    CLUSTERING_MINIBATCH_ROWS rows, and picks the count with the best sampled
+    silhouette score.
+    """
+    # The default sweep skips counts small datasets cannot be scored for.
+    clusters = clusters or [n for n in settings.CLUSTERING_SWEEP if n < X.shape[0]]
+    n_jobs = n_jobs or settings.CLUSTERING_JOBS
+    sample_size = sample_size or settings.CLUSTERING_SAMPLE_SIZE
+
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(fit_kmeans)(X, n_clusters, sample_size, settings.CLUSTERING_MINIBATCH_ROWS) for n_clusters in clusters
+    )
+    result = Sweep(results)
+    log.debug("Best number of clusters %s", result.best)
+    return result
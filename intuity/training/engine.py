@@ -0,0 +1,141 @@
+from django.conf import settings
+from sklearn.kernel_approximation import Nystroem
+from sklearn.linear_model import Ridge, SGDClassifier, SGDRegressor
+from sklearn.pipeline import Pipeline, make_pipeline
+from sklearn.svm import SVC, SVR, LinearSVC
+from intuity_common.auth import JOB_TYPES
+
+from training.neighbors import NeighborsClassifier
+from training.regression import LeastSquares
+
+import logging
+
+log = logging.getLogger('intuity.training.engine')
+
+# From slowest and most accurate to cheapest. Kernel SVM fits grow between
+# quadratically and cubically with rows, so large trainings are moved to a
+# Nystroem approximation of the same kernel, then to linear models and
+# finally to SGD streamed over the stored chunks. Large low dimensional
+# classifications use a persisted neighbour index instead.
+TIERS = ('kernel', 'approximate', 'linear', 'online', 'neighbors')
+
+
+def nystroem(rows):
+    return Nystroem(gamma=0.001, n_components=min(settings.ENGINE_NYSTROEM_COMPONENTS, rows), random_state=0)
+
+
+def neighbors(rows, features):
+    return NeighborsClassifier(
+        n_neighbors=settings.NEIGHBORS_K,
+        algorithm='kd_tree' if features <= settings.NEIGHBORS_TREE_MAX_FEATURES else 'lsh',
+        tables=settings.NEIGHBORS_LSH_TABLES,
+        bits=settings.NEIGHBORS_LSH_BITS,
+        probes=settings.NEIGHBORS_LSH_PROBES,
+        candidates=settings.NEIGHBORS_LSH_CANDIDATES,
+    )
+
+
+CLASSIFIERS = {
+    'kernel': lambda rows, features: SVC(gamma=0.001, C=100.),
+    'approximate': lambda rows, features: make_pipeline(nystroem(rows), LinearSVC(C=100., dual=False)),
+    'linear': lambda rows, features: LinearSVC(dual=rows <= features),
+    'online': lambda rows, features: SGDClassifier(random_state=0),
+    'neighbors': neighbors,
+}
+
+
+def least_squares(rows, features):
+    # The statistics take (features + 1)^2 floats; wider data goes to SGD.
+    if features > settings.REGRESSION_MAX_FEATURES:
+        return SGDRegressor(random_state=0)
+    return LeastSquares()
+
+
+REGRESSORS = {
+    'kernel': lambda rows, features: SVR(gamma=0.001, C=100.),
+    'approximate': lambda rows, features: make_pipeline(nystroem(rows), Ridge(alpha=0.01)),
+    'linear': least_squares,
+    'online': least_squares,
+}
+
+# Clustering trainings still serve predictions from a classifier fitted on
+# the posted targets; the clusters themselves are only reported.
+ESTIMATORS = {
+    'classification': CLASSIFIERS,
+    'clustering': CLASSIFIERS,
+    'regression': REGRESSORS,
+}
+
+
+def estimator_name(estimator):
+    if isinstance(estimator, Pipeline):
+        return '+'.join(type(step).__name__ for name, step in estimator.steps)
+    return type(estimator).__name__
+
+
+class Choice(object):
+
+    def __init__(self, job_type, tier, rows, features, reason, params=None):
+        self.job_type = job_type
+        self.tier = tier
+        self.rows = rows
+        self.features = features
+        self.reason = reason
+        self.params = params or {}
+        self.name = estimator_name(self.build())
+        self.fit_time = None
+
+    @property
+    def online(self):
+        return self.tier == 'online'
+
+    def build(self):
+        estimator = ESTIMATORS[self.job_type][self.tier](self.rows, self.features)
+        if self.params:
+            estimator.set_params(**self.params)
+        return estimator
+
+    def as_dict(self):
+        return {
+            'job_type': self.job_type,
+            'tier': self.tier,
+            'estimator': self.name,
+            'rows': self.rows,
+            'features': self.features,
+            'reason': self.reason,
+            'params': self.params,
+            'fit_time': self.fit_time,
+        }
+
+
+def choose(job_type, rows, features, tier=None, params=None):
+    """
+    Picks the estimator tier for a training of `rows` by `features` from the
+    ENGINE_* thresholds, unless the request asked for a tier. `params`
+    override the parameters of the chosen estimator.
+    """
+    if job_type not in ESTIMATORS:
+        raise ValueError('job_type must be one of {}'.format(', '.join(JOB_TYPES)))
+    tiers = [t for t in TIERS if t in ESTIMATORS[job_type]]
+    if tier is not None:
+        if tier not in tiers:
+            raise ValueError('tier must be one of {}'.format(', '.join(tiers)))
+        reason = 'requested'
+    elif rows > settings.ENGINE_LINEAR_MAX_ROWS:
+        tier, reason = 'online', '{} rows above {}'.format(rows, settings.ENGINE_LINEAR_MAX_ROWS)
+    elif ('neighbors' in tiers and rows > settings.ENGINE_KERNEL_MAX_ROWS and
+            features <= settings.ENGINE_NEIGHBORS_MAX_FEATURES):
+        tier, reason = 'neighbors', '{} rows of {} features'.format(rows, features)
+    elif features > settings.ENGINE_KERNEL_MAX_FEATURES:
+        tier, reason = 'linear', '{} features above {}'.format(features, settings.ENGINE_KERNEL_MAX_FEATURES)
+    elif rows > settings.ENGINE_APPROXIMATE_MAX_ROWS:
+        tier, reason = 'linear', '{} rows above {}'.format(rows, settings.ENGINE_APPROXIMATE_MAX_ROWS)
+    elif rows > settings.ENGINE_KERNEL_MAX_ROWS:
+        tier, reason = 'approximate', '{} rows above {}'.format(rows, settings.ENGINE_KERNEL_MAX_ROWS)
+    else:
+        tier, reason = 'kernel', '{} rows within {}'.format(rows, settings.ENGINE_KERNEL_MAX_ROWS)
+    if params is not None and not isinstance(params, dict):
+        raise ValueError('params must be an object')
+    choice = Choice(job_type, tier, rows, features, reason, params=params)
+    log.debug("Chose %s for %s: %s", choice.name, job_type, reason)
+    return choice
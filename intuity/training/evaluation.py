@@ -0,0 +1,192 @@
+import numbers
+import time
+
+import numpy as np
+from joblib import Parallel, delayed
+from django.conf import settings
+from sklearn.base import clone, is_classifier, is_regressor
+from sklearn.metrics import (confusion_matrix, mean_absolute_error, mean_squared_error,
+                             precision_recall_fscore_support, r2_score)
+from sklearn.model_selection import KFold, ShuffleSplit, StratifiedKFold, StratifiedShuffleSplit
+
+import logging
+
+log = logging.getLogger('intuity.training.evaluation')
+
+
+class Metrics(object):
+
+    def __init__(self, labels, y_true, y_pred, fit_time, predict_time, folds=1):
+        self.labels = labels
+        self.folds = folds
+        self.samples = len(y_true)
+        self.fit_time = fit_time
+        self.predict_time = predict_time
+        self.accuracy = float(np.mean(y_true == y_pred)) if len(y_true) else 0.0
+        self.precision, self.recall, _, self.support = precision_recall_fscore_support(
+            y_true, y_pred, labels=labels, average=None
+        )
+        self.confusion = confusion_matrix(y_true, y_pred, labels=labels)
+
+    def as_dict(self):
+        labels = [str(label) for label in self.labels.tolist()]
+        return {
+            'accuracy': self.accuracy,
+            'samples': self.samples,
+            'folds': self.folds,
+            'precision': dict(zip(labels, self.precision.tolist())),
+            'recall': dict(zip(labels, self.recall.tolist())),
+            'support': dict(zip(labels, self.support.tolist())),
+            'labels': labels,
+            'confusion_matrix': self.confusion.tolist(),
+            'fit_time': self.fit_time,
+            'predict_time': self.predict_time,
+        }
+
+
+class RegressionMetrics(object):
+
+    def __init__(self, y_true, y_pred, fit_time, predict_time, folds=1):
+        self.folds = folds
+        self.samples = len(y_true)
+        self.fit_time = fit_time
+        self.predict_time = predict_time
+        self.r2 = float(r2_score(y_true, y_pred)) if len(y_true) > 1 else 0.0
+        self.mae = float(mean_absolute_error(y_true, y_pred)) if len(y_true) else 0.0
+        self.rmse = float(np.sqrt(mean_squared_error(y_true, y_pred))) if len(y_true) else 0.0
+
+    def as_dict(self):
+        return {
+            'r2': self.r2,
+            'mae': self.mae,
+            'rmse': self.rmse,
+            'samples': self.samples,
+            'folds': self.folds,
+            'fit_time': self.fit_time,
+            'predict_time': self.predict_time,
+        }
+
+
+def fit_and_score(estimator, X, y, train, test):
+    start = time.time()
+    estimator.fit(X[train], y[train])
+    fit_time = time.time() - start
+    start = time.time()
+    predicted = estimator.predict(X[test])
+    predict_time = time.time() - start
+    return y[test], predicted, fit_time, predict_time
+
+
+def stream_fit_and_score(estimator, X, y, train, test, chunk_size):
+    """
+    fit_and_score for online estimators: the training rows are streamed
+    through partial_fit and the test rows predicted chunk by chunk, so only
+    one chunk of X is ever copied.
+    """
+    trained = np.zeros(len(y), dtype=bool)
+    trained[train] = True
+    held_out = np.zeros(len(y), dtype=bool)
+    held_out[test] = True
+    chunks = [slice(offset, offset + chunk_size) for offset in range(0, len(y), chunk_size)]
+    kwargs = {'classes': np.unique(y)} if is_classifier(estimator) else {}
+    start = time.time()
+    for chunk in chunks:
+        rows = trained[chunk]
+        if rows.any():
+            estimator.partial_fit(X[chunk][rows], y[chunk][rows], **kwargs)
+    fit_time = time.time() - start
+    start = time.time()
+    predicted = [estimator.predict(X[chunk][held_out[chunk]]) for chunk in chunks if held_out[chunk].any()]
+    predict_time = time.time() - start
+    return y[held_out], np.concatenate(predicted), fit_time, predict_time
+
+
+def check_splits(rows, folds=None, test_size=None):
+    """
+    Raises ValueError unless `rows` rows can be split into `folds` folds,
+    or into a holdout of `test_size` and at least one training row.
+    """
+    if folds is not None:
+        if isinstance(folds, bool) or not isinstance(folds, numbers.Integral):
+            raise ValueError('folds must be an integer')
+        if folds > rows:
+            raise ValueError('folds must be at most the number of rows ({})'.format(rows))
+        if folds > 1:
+            return
+    test_size = test_size or settings.EVALUATION_TEST_SIZE
+    if isinstance(test_size, bool) or not isinstance(test_size, numbers.Real) or test_size <= 0:
+        raise ValueError('test_size must be a fraction or a number of rows')
+    if isinstance(test_size, numbers.Integral):
+        tested = test_size
+    elif test_size < 1:
+        tested = int(np.ceil(test_size * rows))
+    else:
+        raise ValueError('test_size must be a fraction below 1 or a number of rows')
+    if tested >= rows:
+        raise ValueError('test_size leaves no rows to train on out of {}'.format(rows))
+
+
+def splits(y, folds, test_size, stratify=True):
+    if folds and folds > 1:
+        stratified = StratifiedKFold(n_splits=folds, shuffle=True, random_state=0)
+        plain = KFold(n_splits=folds, shuffle=True, random_state=0)
+    else:
+        stratified = StratifiedShuffleSplit(n_splits=1, test_size=test_size, random_state=0)
+        plain = ShuffleSplit(n_splits=1, test_size=test_size, random_state=0)
+    if not stratify:
+        return list(plain.split(np.zeros(len(y))))
+    try:
+        return list(stratified.split(np.zeros(len(y)), y))
+    except ValueError:
+        # Some class has too few members to be stratified.
+        log.debug("Falling back to unstratified splits")
+        return list(plain.split(np.zeros(len(y))))
+
+
+def evaluate(estimator, X, y, folds=None, test_size=None, n_jobs=None, chunk_size=None):
+    """
+    Scores `estimator` on a stratified holdout, or on k stratified folds run
+    in parallel when `folds` is given. Each test set is predicted in one call.
+    Regressors are scored on plain splits. With `chunk_size`, online
+    estimators are fitted and scored in chunks, one split after the other.
+    """
+    test_size = test_size or settings.EVALUATION_TEST_SIZE
+    n_jobs = n_jobs or settings.EVALUATION_JOBS
+    y = np.asarray(y)
+    regression = is_regressor(estimator)
+
+    folds_ = splits(y, folds, test_size, stratify=not regression)
+    log.debug("Evaluating %s on %s split(s)", type(estimator).__name__, len(folds_))
+
+    if chunk_size:
+        results = [stream_fit_and_score(clone(estimator), X, y, train, test, chunk_size) for train, test in folds_]
+    elif len(folds_) > 1:
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(fit_and_score)(clone(estimator), X, y, train, test) for train, test in folds_
+        )
+    else:
+        train, test = folds_[0]
+        results = [fit_and_score(clone(estimator), X, y, train, test)]
+
+    y_true = np.concatenate([r[0] for r in results])
+    y_pred = np.concatenate([r[1] for r in results])
+    if regression:
+        metrics = RegressionMetrics(
+            y_true,
+            y_pred,
+            fit_time=sum(r[2] for r in results),
+            predict_time=sum(r[3] for r in results),
+            folds=len(folds_)
+        )
+        log.debug("R2 %s on %s samples", metrics.r2, metrics.samples)
+        return metrics
+    metrics = Metrics(
+        np.unique(y),
+        y_true,
+        y_pred,
+        fit_time=sum(r[2] for r in results),
+        predict_time=sum(r[3] for r in results),
+        folds=len(folds_)
+    )
+    log.debug("Accuracy %s on %s samples", metrics.accuracy, metrics.samples)
+    return metrics
@@ -0,0 +1,52 @@
+from django.conf import settings
+from django.utils import timezone
+from intuity_common import jobs
+
+from training.models import Job
+
+import logging
+
+log = logging.getLogger('intuity.training.jobs')
+
+
+class JobQueue(jobs.Queue):
+    model = Job
+
+    def queued(self):
+        return Job.objects.filter(state=Job.QUEUED).order_by('date_created')
+
+    def next(self, limit):
+        """
+        Claims up to `limit` queued jobs, oldest first, skipping trainings that
+        already have a running job so versions are never updated concurrently.
+        """
+        busy = set(Job.objects.filter(state=Job.RUNNING).values_list('training_id', flat=True))
+        claimed = []
+        for job in self.queued()[:limit * 4]:
+            if len(claimed) >= limit:
+                break
+            if job.training_id in busy:
+                continue
+            if self.claim(job, date_started=timezone.now()):
+                busy.add(job.training_id)
+                claimed.append(job.pk)
+        return claimed
+
+    def execute(self, job_id):
+        job = Job.objects.select_related('training').get(pk=job_id)
+        log.info("Running job %s for training %s", job.pk, job.training_id)
+        state = job.execute()
+        log.info("Job %s finished: %s", job.pk, state)
+        return state
+
+    def retryable(self, job):
+        return not job.incremental and super(JobQueue, self).retryable(job)
+
+    def failed(self, job, error):
+        Job.objects.filter(pk=job.pk).update(error=error, date_finished=timezone.now())
+        job.storage.delete()
+
+
+def work(processes=None, interval=None):
+    queue = JobQueue(settings.TRAINING_JOB_LEASE, settings.TRAINING_JOB_ATTEMPTS)
+    jobs.work(queue, processes or settings.TRAINING_WORKERS, interval or settings.TRAINING_POLL_INTERVAL)
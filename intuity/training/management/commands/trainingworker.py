@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from training.jobs import work
+
+
+class Command(BaseCommand):
+    help = 'Runs queued training jobs in a pool of worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=None)
+        parser.add_argument('--interval', type=float, default=None)
+
+    def handle(self, *args, **options):
+        work(processes=options['processes'], interval=options['interval'])
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.conf import settings
+from django.db import migrations
+
+from storage.backends import ArrayStorage
+
+
+def export_arrays(apps, schema_editor):
+    Training = apps.get_model('training', 'Training')
+    dtype = 'float32' if settings.STORAGE_FLOAT32 else 'float64'
+    for training in Training.objects.all():
+        storage = ArrayStorage(training.uuid)
+        storage.save('data', json.loads(training.data), dtype=dtype)
+        storage.save('target', json.loads(training.target))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('training', '0002_training_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(export_arrays, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='training',
+            name='data',
+        ),
+        migrations.RemoveField(
+            model_name='training',
+            name='target',
+        ),
+    ]
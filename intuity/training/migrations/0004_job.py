@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import training.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('training', '0003_training_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.CharField(default=training.models.job_id, max_length=64, primary_key=True, serialize=False)),
+                ('state', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='queued', max_length=16)),
+                ('params', models.TextField(default='{}')),
+                ('result', models.TextField(default='null')),
+                ('error', models.TextField(blank=True, default='')),
+                ('date_created', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('date_started', models.DateTimeField(blank=True, null=True)),
+                ('date_finished', models.DateTimeField(blank=True, null=True)),
+                ('training', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='training.Training')),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def set_model_version(apps, schema_editor):
+    Training = apps.get_model('training', 'Training')
+    Estimator = apps.get_model('model', 'Estimator')
+    for training, version in Estimator.objects.filter(active=True).values_list('training', 'version'):
+        Training.objects.filter(pk=training).update(model_version=version)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('training', '0004_job'),
+        ('model', '0002_estimator_registry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='training',
+            name='model_version',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_model_version, migrations.RunPython.noop),
+    ]
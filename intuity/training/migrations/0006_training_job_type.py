@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('training', '0005_training_model_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='training',
+            name='job_type',
+            field=models.CharField(choices=[('classification', 'Classification'), ('clustering', 'Clustering'), ('regression', 'Regression')], default='clustering', max_length=32),
+        ),
+    ]
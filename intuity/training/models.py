@@ -1,106 +1,512 @@
 from __future__ import unicode_literals
 
-from django.db import models
+import copy
 import json
+import os
+import shutil
+import time
+import uuid
 
-from sklearn.svm import SVC, LinearSVC
-from sklearn.neighbors import KNeighborsClassifier
-from sklearn.cluster import AgglomerativeClustering, KMeans
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from sklearn.base import is_classifier
+from sklearn.metrics import r2_score
+from sklearn.linear_model import SGDClassifier, SGDRegressor, Perceptron
+from sklearn.naive_bayes import MultinomialNB
 import numpy as np
+import scipy.sparse as sp
+from intuity_common.auth import JOB_TYPES, job_type
+from intuity_common.wire import decode_matrix
+
+from model.models import Estimator
+from model.registry import registry
+from storage.backends import ArrayStorage
+from training.clustering import sweep
+from training.engine import choose
+from training.evaluation import Metrics, check_splits, evaluate
+from training.neighbors import NeighborsClassifier
+from training.regression import LeastSquares
+from utils.arrays import extend_fingerprint, fingerprint, resize_columns
 
 import logging
 
 log = logging.getLogger('intuity.training.models')
 
+ONLINE_ESTIMATORS = {
+    'sgd': SGDClassifier,
+    'perceptron': Perceptron,
+    'naive_bayes': MultinomialNB,
+}
+
+ONLINE_REGRESSORS = {
+    'least_squares': LeastSquares,
+    'sgd': SGDRegressor,
+}
+
+
+class BadFormat(Exception):
+    pass
+
+
+def parse_clusters(clusters, rows):
+    """
+    The sorted cluster counts to sweep, or None for the default sweep.
+    """
+    if clusters is None:
+        return None
+    try:
+        clusters = sorted(set(int(n) for n in clusters))
+    except (TypeError, ValueError):
+        raise BadFormat('clusters must be a list of integers')
+    # Silhouette scores need at least one more row than clusters.
+    if not clusters or clusters[0] < 2 or clusters[-1] >= rows:
+        raise BadFormat('clusters must be between 2 and the number of rows minus one')
+    return clusters
+
 
 class Training(models.Model):
     uuid = models.CharField(max_length=64, null=False, blank=False, primary_key=True)
-    data = models.TextField(default='[]')
-    target = models.TextField(default='[]')
+    version = models.IntegerField(default=0)
+    model_version = models.IntegerField(null=True, blank=True)
+    job_type = models.CharField(max_length=32, choices=[(t, t.title()) for t in JOB_TYPES], default='clustering')
+
+    @classmethod
+    def for_payload(cls, payload):
+        """
+        Gets or creates the training of a token, taking its job type from the
+        token when authority put one there.
+        """
+        kind = job_type(payload)
+        training, created = cls.objects.get_or_create(
+            pk=payload['uuid'], defaults={'job_type': kind or settings.TRAINING_DEFAULT_JOB_TYPE}
+        )
+        if kind and training.job_type != kind:
+            training.job_type = kind
+            training.save(update_fields=['job_type'])
+        return training, created
 
     @property
-    def data_object(self):
-        return json.loads(self.data)
+    def storage(self):
+        if not hasattr(self, '_storage'):
+            self._storage = ArrayStorage(self.uuid)
+        return self._storage
 
     @property
-    def target_object(self):
-        return json.loads(self.target)
+    def data_array(self):
+        return self.storage.load('data')
 
-    def process_clustering(self, data):
-        log.debug("Saving data with shape %s x %s", len(data['data']), len(data['data'][0]))
-        self.data = json.dumps(data['data'])
-        log.debug("Saving target with shape %s", len(data['target']))
-        self.target = json.dumps(data['target'])
+    @property
+    def target_array(self):
+        return self.storage.load('target')
+
+    @property
+    def width(self):
+        data = self.data_array
+        return data.shape[1] if data.ndim == 2 else 0
+
+    @property
+    def classes_array(self):
+        return self.storage.load('classes')
+
+    @property
+    def regression(self):
+        return self.job_type == 'regression'
+
+    @property
+    def online_estimators(self):
+        return ONLINE_REGRESSORS if self.regression else ONLINE_ESTIMATORS
+
+    def save_data(self, data):
+        dtype = np.float32 if settings.STORAGE_FLOAT32 else np.float64
+        array = self.storage.save('data', decode_matrix(data['data'], dtype=dtype))
+        log.debug("Saved data with shape %s", array.shape)
+        array = self.storage.save('target', np.asarray(data['target'], dtype=np.float64 if self.regression else None))
+        log.debug("Saved target with shape %s", array.shape)
+        if not self.regression:
+            self.storage.save('classes', np.unique(array))
+        self.bump_version()
+
+    def append_data(self, data):
+        dtype = np.float32 if settings.STORAGE_FLOAT32 else np.float64
+        new_data = decode_matrix(data['data'], dtype=dtype)
+        new_target = np.asarray(data['target'], dtype=np.float64 if self.regression else None)
+        if new_data.ndim != 2:
+            raise BadFormat('Expected a 2d matrix of rows, got shape {}'.format(new_data.shape))
+        if new_target.shape != (new_data.shape[0],):
+            raise BadFormat('Expected {} targets, got shape {}'.format(new_data.shape[0], new_target.shape))
+        stored = self.data_array
+        sparse = sp.issparse(new_data) or sp.issparse(stored)
+        if stored.shape[0] and not sparse and new_data.shape[1:] != stored.shape[1:]:
+            # Sparse matrices may gain columns, dense ones cannot.
+            raise BadFormat('Expected {} features, got {}'.format(stored.shape[1], new_data.shape))
+        with self.storage.lock():
+            # The target is appended last and commits a batch: drop data rows
+            # an interrupted append left without targets.
+            self.storage.truncate('data', self.storage.load_array('target').shape[0])
+            self.storage.append('data', new_data)
+            self.storage.append('target', new_target)
+            log.debug("Appended %s rows, data shape is now %s", new_data.shape[0], self.data_array.shape)
+            if not self.regression:
+                if self.storage.exists('classes'):
+                    self.storage.save('classes', np.union1d(self.classes_array, new_target))
+                else:
+                    self.storage.save('classes', np.unique(new_target))
+        self.bump_version()
+        return new_data, new_target
+
+    def bump_version(self):
         self.save()
+        Training.objects.filter(pk=self.pk).update(version=F('version') + 1)
+        self.refresh_from_db(fields=['version'])
+        log.debug("Training %s is now at version %s", self.uuid, self.version)
 
-        frequency = {}
+    def choose_estimator(self, data=None):
+        data = data or {}
+        try:
+            return choose(self.job_type, self.target_array.shape[0], self.width,
+                          tier=data.get('tier'), params=data.get('params'))
+        except (TypeError, ValueError) as e:
+            raise BadFormat(str(e))
 
-        for n_clusters in (2, 3, 5):
-            model = KMeans(n_clusters=n_clusters)
+    def index_storage(self, version):
+        return ArrayStorage(os.path.join(self.uuid, 'neighbors', str(version)))
 
-            model.fit(self.data_object)
+    def prune_indexes(self):
+        """
+        Removes neighbour indexes of versions the registry no longer keeps.
+        Newer versions may still be fitting and are left alone.
+        """
+        root = os.path.join(self.storage.path, 'neighbors')
+        if not os.path.isdir(root):
+            return
+        kept = set(Estimator.objects.filter(training=self.uuid).values_list('version', flat=True))
+        for name in os.listdir(root):
+            if name.isdigit() and int(name) not in kept and int(name) < self.version:
+                shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+                log.debug("Removed neighbour index of %s version %s", self.uuid, name)
 
-            unique = set(model.labels_)
+    def fit_estimator(self, metrics=None, choice=None):
+        choice = choice or self.choose_estimator()
+        classifier = choice.build()
+        log.debug("Training data with shape %s", self.data_array.shape)
+        log.debug("Training target with shape %s", self.target_array.shape)
+        started = time.time()
+        if choice.online:
+            self.stream_fit(classifier)
+        else:
+            classifier.fit(self.data_array, self.target_array)
+        if isinstance(classifier, NeighborsClassifier):
+            classifier.save(self.index_storage(self.version))
+        choice.fit_time = time.time() - started
+        log.debug("Fitted %s in %.3fs", choice.name, choice.fit_time)
+        self.publish(classifier, dict(metrics or {}, engine=choice.as_dict()))
+        return classifier
 
-            log.debug('Cluster %s', model.labels_)
+    def publish(self, classifier, metrics=None, data_fingerprint=None):
+        """
+        Registers the estimator fitted on the current data version and swaps
+        it in as the one predictions are served from. The stored data is
+        hashed unless its fingerprint is given; incremental training chains
+        it from the previous one, so it identifies the data's history rather
+        than its content alone.
+        """
+        data_fingerprint = data_fingerprint or fingerprint(self.data_array, self.target_array)
+        with transaction.atomic():
+            record, activated = registry.publish(
+                self.uuid, self.version, classifier, fingerprint=data_fingerprint, metrics=metrics
+            )
+            if activated:
+                Training.objects.filter(pk=self.pk).update(model_version=self.version)
+                self.model_version = self.version
+        self.prune_indexes()
+        return record
 
-            clusters = {}
-            for u in unique:
-                clusters[str(u)] = list(model.labels_).count(u)
-                log.debug("Frequency of %s - %s", u, clusters[str(u)])
+    def load_estimator(self):
+        """
+        The active estimator, which may lag behind the data version while a
+        new one is being fitted.
+        """
+        if self.model_version is None:
+            return None
+        return registry.get(self.uuid, self.model_version)
 
-            frequency[str(n_clusters)] = clusters
+    @property
+    def estimator(self):
+        classifier = self.load_estimator()
+        if classifier is None:
+            log.debug("No stored estimator for %s, fitting version %s", self.uuid, self.version)
+            classifier = self.fit_estimator()
+        return classifier
 
-        return frequency
+    def fit_online(self, kind='sgd', chunk_size=None):
+        """
+        Streams the stored dataset through a partial_fit estimator in fixed
+        size chunks, so memory is bounded by the chunk size.
+        """
+        return self.stream_fit(self.online_estimators[kind](), chunk_size)
 
-    def process_classification(self, data):
-        log.debug("Saving data with shape %s x %s", len(data['data']), len(data['data'][0]))
-        self.data = json.dumps(data['data'])
-        log.debug("Saving target with shape %s", len(data['target']))
-        self.target = json.dumps(data['target'])
-        self.save()
+    def stream_fit(self, estimator, chunk_size=None):
+        chunk_size = chunk_size or settings.TRAINING_CHUNK_SIZE
+        kwargs = {'classes': np.asarray(self.classes_array)} if is_classifier(estimator) else {}
+        targets = self.storage.chunks('target', chunk_size)
+        for n, chunk in enumerate(self.storage.chunks('data', chunk_size)):
+            estimator.partial_fit(chunk, next(targets), **kwargs)
+            log.debug("Fitted chunk %s of %s rows", n, chunk.shape[0])
+        return estimator
+
+    def process_incremental(self, data):
+        """
+        Appends the posted rows and updates the online model with them alone.
+        Least squares regressions keep sufficient statistics, so they absorb
+        new rows and new sparse columns without revisiting stored data, up to
+        REGRESSION_MAX_FEATURES columns; wider data goes to SGD.
+        """
+        kind = data.get('estimator', 'least_squares' if self.regression else 'sgd')
+        if kind not in self.online_estimators:
+            raise BadFormat('Unknown estimator {}'.format(kind))
+
+        previous = self.load_estimator()
+        previous_version = self.version if self.model_version == self.version else None
+        previous_classes = None if self.regression else self.classes_array
+        previous_width = self.width
+
+        new_data, new_target = self.append_data(data)
+        if kind == 'least_squares' and self.width > settings.REGRESSION_MAX_FEATURES:
+            # The statistics take (features + 1)^2 floats, as in engine.least_squares.
+            log.debug("%s features are too many for least squares, using SGD", self.width)
+            kind = 'sgd'
+
+        data_fingerprint = None
+        if previous_version is not None and self.version == previous_version + 1:
+            # Nothing else was appended meanwhile: chain from the fingerprint
+            # of the published version instead of hashing every stored row.
+            previous_fingerprint = Estimator.objects.filter(
+                training=self.uuid, version=previous_version
+            ).values_list('fingerprint', flat=True).first()
+            if previous_fingerprint:
+                data_fingerprint = extend_fingerprint(previous_fingerprint, new_data, new_target)
+
+        accuracy = None
+        if previous is not None and new_data.shape[0]:
+            # Progressive validation: score the delta before learning from it.
+            predicted = previous.predict(resize_columns(new_data, previous_width))
+            if not self.regression:
+                accuracy = float(np.mean(predicted == new_target)) * 100
+            elif new_data.shape[0] > 1:
+                accuracy = float(r2_score(new_target, predicted)) * 100
+            log.debug("Progressive accuracy %s", accuracy)
+
+        if self.regression:
+            changed = self.width != previous_width and not isinstance(previous, LeastSquares)
+        else:
+            changed = len(self.classes_array) != len(previous_classes) or self.width != previous_width
+        if previous is None or type(previous) is not self.online_estimators[kind] or data.get('rebuild') or changed:
+            log.debug("Rebuilding %s estimator from stored data", kind)
+            classifier = self.fit_online(kind, data.get('chunk_size'))
+        else:
+            # The cached model keeps serving predictions until the updated
+            # copy is published.
+            classifier = copy.deepcopy(previous)
+            classifier.partial_fit(resize_columns(new_data, self.width), new_target)
+            log.debug("Updated estimator with %s rows", new_data.shape[0])
 
-        split = int(round((len(self.target_object) / 100.0) * 10))
-
-        log.debug("Split value %s", split)
-
-        classifier = KNeighborsClassifier(n_neighbors=2)
-        # log.debug("Train data %s", np.array(self.data_object[:split]))
-        # log.debug("Train target %s", np.array(self.target_object[:split]))
-        classifier.fit(np.array(self.data_object[:split]), np.array(self.target_object[:split]))
-
-        passed = 0
-        failed = 0
-        for test, result in zip(np.array(self.data_object[split:]), np.array(self.target_object[:split])):
-            # log.debug("Test data %s", test)
-            # log.debug("Test result %s", result)
-            prediction = classifier.predict([test])
-            if prediction[0] == result:
-                passed += 1
-            else:
-                failed += 1
-            log.debug("Test result %s, expected %s", prediction[0], result)
-        log.debug("Passed %s, failed %s", passed, failed)
-        accuracy = float(passed)/(float(passed) + float(failed)) * 100
-        log.debug("Prediction accuracy %s", accuracy)
+        metrics = {'progressive_accuracy': accuracy}
+        if isinstance(classifier, LeastSquares):
+            metrics['fit'] = classifier.scores()
+        self.publish(classifier, metrics, data_fingerprint)
         return accuracy
 
-    process = process_clustering
+    def process_clustering(self, data):
+        clusters = parse_clusters(data.get('clusters'), len(data['target']))
+
+        self.save_data(data)
+
+        result = sweep(self.data_array, clusters=clusters)
+
+        choice = self.choose_estimator(data)
+        self.fit_estimator(metrics=result.as_dict(), choice=choice)
+        return {'records': len(self.target_array), 'accuracy': result.frequency,
+                'clusters': result.as_dict(), 'engine': choice.as_dict()}
+
+    def process_classification(self, data):
+        try:
+            check_splits(len(data['target']), folds=data.get('folds'), test_size=data.get('test_size'))
+        except ValueError as e:
+            raise BadFormat(str(e))
+
+        self.save_data(data)
+
+        choice = self.choose_estimator(data)
+        metrics = evaluate(
+            choice.build(),
+            self.data_array,
+            self.target_array,
+            folds=data.get('folds'),
+            test_size=data.get('test_size'),
+            # The online tier is for data too large to copy for each split.
+            chunk_size=(data.get('chunk_size') or settings.TRAINING_CHUNK_SIZE) if choice.online else None
+        )
+        self.fit_estimator(metrics=metrics.as_dict(), choice=choice)
+        if isinstance(metrics, Metrics):
+            log.debug("Prediction accuracy %s", metrics.accuracy)
+            accuracy = metrics.accuracy * 100
+        else:
+            log.debug("Prediction R2 %s", metrics.r2)
+            accuracy = metrics.r2 * 100
+        return {'records': len(self.target_array), 'accuracy': accuracy,
+                'metrics': metrics.as_dict(), 'engine': choice.as_dict()}
+
+    # Regressors are scored the same way, with R2 standing in for accuracy.
+    process_regression = process_classification
+
+    def check_request(self, data):
+        """
+        Raises BadFormat unless `data` is a training request this training can
+        run, so a queued job cannot fail on its input alone. Returns the
+        decoded rows and targets.
+        """
+        try:
+            rows = decode_matrix(data['data'])
+            target = np.asarray(data['target'], dtype=np.float64 if self.regression else None)
+        except KeyError as e:
+            raise BadFormat('missing {}'.format(e.args[0]))
+        except (TypeError, ValueError) as e:
+            raise BadFormat(str(e))
+        if rows.ndim != 2:
+            raise BadFormat('Expected a 2d matrix of rows, got shape {}'.format(rows.shape))
+        if target.shape != (rows.shape[0],):
+            raise BadFormat('Expected {} targets, got shape {}'.format(rows.shape[0], target.shape))
+        if data.get('mode') == 'incremental':
+            if data.get('estimator', 'sgd') not in self.online_estimators:
+                raise BadFormat('Unknown estimator {}'.format(data['estimator']))
+            return rows, target
+        if self.job_type == 'clustering':
+            parse_clusters(data.get('clusters'), rows.shape[0])
+        try:
+            if self.job_type != 'clustering':
+                check_splits(rows.shape[0], folds=data.get('folds'), test_size=data.get('test_size'))
+            # Building the estimator checks the tier and its params.
+            choose(self.job_type, rows.shape[0], rows.shape[1], tier=data.get('tier'),
+                   params=data.get('params')).build()
+        except (TypeError, ValueError) as e:
+            raise BadFormat(str(e))
+        return rows, target
+
+    def process(self, data):
+        return getattr(self, 'process_{}'.format(self.job_type))(data)
+
+    def run(self, data):
+        if data.get('mode') == 'incremental':
+            accuracy = self.process_incremental(data)
+            return {'records': len(self.target_array), 'accuracy': accuracy}
+        return self.process(data)
+
+    def sample(self, data, estimator):
+        """
+        Shapes questions for `estimator`, which may have been fitted on fewer
+        columns than are stored when sparse rows were appended since.
+        """
+        data = decode_matrix(data)
+        log.debug("Sample shape %s", data.shape)
+        if data.ndim == 1:
+            data = data.reshape(1, -1)
+        return resize_columns(data, getattr(estimator, 'n_features_in_', None) or self.width)
 
     def predict(self, data):
 
         log.debug("Starting prediction.")
-        log.debug("Received sample %s", data)
-        log.debug("Sample shape %s", len(data))
-        classifier = SVC(gamma=0.001, C=100.)
-        # log.debug("Data object %s", self.data_object)
-        # log.debug("Target object %s", self.target_object)
-        log.debug("Training data with shape %s x %s", len(self.data_object), len(self.data_object[0]))
-        log.debug("Training target with shape %s", len(self.target_object))
-        log.debug("Training array dimension %s", np.array(self.data_object).ndim)
-        classifier.fit(np.array(self.data_object), np.array(self.target_object))
-        data = np.array(data)
-        log.debug("Sample array dimension %s", data.ndim)
-        if data.ndim == 1:
-            data = [data]
-        return classifier.predict(data)
+        classifier = self.estimator
+        return classifier.predict(self.sample(data, classifier))
+
+
+def job_id():
+    return uuid.uuid4().hex
+
+
+class Job(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    id = models.CharField(max_length=64, primary_key=True, default=job_id)
+    training = models.ForeignKey(Training, related_name='jobs', on_delete=models.CASCADE)
+    state = models.CharField(max_length=16, choices=STATES, default=QUEUED, db_index=True)
+    params = models.TextField(default='{}')
+    result = models.TextField(default='null')
+    error = models.TextField(blank=True, default='')
+    date_created = models.DateTimeField(default=timezone.now, db_index=True)
+    date_started = models.DateTimeField(null=True, blank=True)
+    date_finished = models.DateTimeField(null=True, blank=True)
+    worker = models.CharField(max_length=128, blank=True, default='')
+    heartbeat = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+
+    @property
+    def storage(self):
+        if not hasattr(self, '_storage'):
+            self._storage = ArrayStorage(os.path.join('jobs', self.id))
+        return self._storage
+
+    @classmethod
+    def enqueue(cls, training, data):
+        """
+        Checks the payload, writes its arrays next to the other stored arrays
+        and queues the job; the heavy lifting is done later by the training
+        worker. Raises BadFormat.
+        """
+        rows, target = training.check_request(data)
+        params = dict((k, v) for k, v in data.items() if k not in ('data', 'target'))
+        job = cls(training=training, params=json.dumps(params))
+        job.storage.save('data', rows)
+        job.storage.save('target', target)
+        job.save()
+        log.debug("Queued job %s for training %s", job.pk, training.pk)
+        return job
+
+    @property
+    def incremental(self):
+        # Incremental jobs append their rows, so they must never run twice.
+        return json.loads(self.params).get('mode') == 'incremental'
+
+    def execute(self):
+        data = json.loads(self.params)
+        data['data'] = self.storage.load('data')
+        data['target'] = self.storage.load('target')
+        try:
+            result = self.training.run(data)
+        except Exception as e:
+            log.exception("Job %s failed", self.pk)
+            self.state = Job.FAILED
+            self.error = str(e)
+        else:
+            self.state = Job.DONE
+            self.result = json.dumps(result)
+        self.date_finished = timezone.now()
+        self.heartbeat = None
+        self.save(update_fields=['state', 'result', 'error', 'date_finished', 'heartbeat'])
+        self.storage.delete()
+        return self.state
+
+    @property
+    def result_object(self):
+        return json.loads(self.result)
+
+    @property
+    def timings(self):
+        timings = {}
+        if self.date_started:
+            timings['queued'] = (self.date_started - self.date_created).total_seconds()
+            if self.date_finished:
+                timings['running'] = (self.date_finished - self.date_started).total_seconds()
+        return timings
@@ -0,0 +1,277 @@
+"""
+Nearest neighbour classification over an index that is built once after
+training and read back from disk through memory maps.
+
+TreeIndex wraps scikit-learn's KD and ball trees, which are exact and fast
+on low dimensional data. ProjectionIndex is approximate and meant for wide,
+sparse data such as one-hot features: rows are bucketed by random hyperplane
+signatures in several tables, queries probe their own bucket plus the
+buckets across their least certain bits, and the candidates found in most
+tables are reranked by exact distance. More tables, probes and candidates
+raise recall at the cost of latency.
+"""
+import os
+
+import joblib
+import numpy as np
+import scipy.sparse as sp
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.neighbors import BallTree, KDTree
+from sklearn.utils.extmath import safe_sparse_dot
+
+from storage.backends import ArrayStorage
+
+import logging
+
+log = logging.getLogger('intuity.training.neighbors')
+
+TREES = {
+    'kd_tree': KDTree,
+    'ball_tree': BallTree,
+}
+
+# Above this many dimensions projections use a sparse +-1 matrix.
+DENSE_PROJECTION_MAX_FEATURES = 1024
+
+
+def dense(X):
+    return X.toarray() if sp.issparse(X) else np.asarray(X, dtype=np.float64)
+
+
+def row_norms(X):
+    if sp.issparse(X):
+        return np.asarray(X.multiply(X).sum(axis=1)).ravel()
+    return np.einsum('ij,ij->i', X, X)
+
+
+def group_ranks(groups):
+    """
+    Position of each element of sorted `groups` among its equal neighbours.
+    """
+    positions = np.arange(groups.shape[0])
+    starts = np.r_[True, groups[1:] != groups[:-1]] if groups.shape[0] else np.empty(0, dtype=bool)
+    return positions - np.maximum.accumulate(np.where(starts, positions, 0))
+
+
+class TreeIndex(object):
+
+    def __init__(self, kind='kd_tree', leaf_size=40):
+        self.kind = kind
+        self.leaf_size = leaf_size
+        self.tree = None
+
+    def build(self, X):
+        self.tree = TREES[self.kind](dense(X), leaf_size=self.leaf_size)
+        return self
+
+    def query(self, X, k):
+        k = min(k, self.tree.data.shape[0])
+        return self.tree.query(dense(X), k=k)
+
+    def save(self, storage):
+        if not os.path.isdir(storage.path):
+            os.makedirs(storage.path)
+        joblib.dump(self.tree, os.path.join(storage.path, 'tree.joblib'))
+
+    def load(self, storage):
+        self.tree = joblib.load(os.path.join(storage.path, 'tree.joblib'), mmap_mode='r')
+        return self
+
+
+class ProjectionIndex(object):
+
+    ARRAYS = ('planes', 'offset', 'keys', 'order', 'data', 'norms')
+
+    def __init__(self, tables=8, bits=16, probes=2, candidates=200, seed=0):
+        self.tables = tables
+        self.bits = bits
+        self.probes = probes
+        self.candidates = candidates
+        self.seed = seed
+
+    def project(self, X):
+        return np.asarray(dense(safe_sparse_dot(X, self.planes)) - self.offset)
+
+    def signatures(self, projected):
+        signs = projected.reshape(projected.shape[0], self.tables, self.bits) > 0
+        return signs.dot(np.left_shift(1, np.arange(self.bits, dtype=np.int64)))
+
+    def build(self, X, chunk_size=65536):
+        rows, features = X.shape
+        rng = np.random.RandomState(self.seed)
+        width = self.tables * self.bits
+        if features <= DENSE_PROJECTION_MAX_FEATURES:
+            planes = rng.randn(features, width)
+        else:
+            planes = sp.random(features, width, density=1 / np.sqrt(features), format='csr', random_state=rng,
+                               data_rvs=lambda n: rng.choice([-1.0, 1.0], n))
+        # Hyperplanes through the mean split the data more evenly.
+        center = np.asarray(X.mean(axis=0)).reshape(1, -1)
+        self.planes = planes
+        self.offset = np.asarray(safe_sparse_dot(center, planes)).ravel()
+
+        keys = np.vstack([
+            self.signatures(self.project(X[start:start + chunk_size])) for start in range(0, rows, chunk_size)
+        ]).T
+        order = np.argsort(keys, axis=1, kind='mergesort')
+        self.keys = np.take_along_axis(keys, order, axis=1)
+        self.order = order.astype(np.int32 if rows < 2 ** 31 else np.int64)
+        self.data = X.tocsr() if sp.issparse(X) else np.asarray(X)
+        self.norms = row_norms(self.data)
+        return self
+
+    def candidates_of(self, projected):
+        """
+        Row ids colliding with each query in any table, within one bit flip
+        of its signature on its `probes` least certain bits, at most
+        `candidates` of them per query, preferring the most frequent ones.
+        Returns (query, row) pairs sorted by query.
+        """
+        queries = projected.shape[0]
+        keys = self.signatures(projected)[:, :, None]
+        if self.probes:
+            margins = np.abs(projected).reshape(queries, self.tables, self.bits)
+            flips = np.argsort(margins, axis=2)[:, :, :self.probes]
+            keys = np.concatenate([keys, keys ^ np.left_shift(1, flips)], axis=2)
+        owners = np.repeat(np.arange(queries), keys.shape[2])
+        found_queries, found_rows = [], []
+        for t in range(self.tables):
+            probed = keys[:, t].ravel()
+            lo = np.searchsorted(self.keys[t], probed, 'left')
+            sizes = np.searchsorted(self.keys[t], probed, 'right') - lo
+            # Every bucket hit by every query, gathered as one run of positions.
+            positions = np.arange(sizes.sum()) + np.repeat(lo - (np.cumsum(sizes) - sizes), sizes)
+            found_queries.append(np.repeat(owners, sizes))
+            found_rows.append(self.order[t][positions])
+        rows = self.keys.shape[1]
+        pairs = np.concatenate(found_queries) * rows + np.concatenate(found_rows)
+        pairs.sort()
+        starts = np.flatnonzero(np.r_[True, pairs[1:] != pairs[:-1]]) if pairs.shape[0] else np.empty(0, np.int64)
+        counts = np.diff(np.r_[starts, pairs.shape[0]])
+        found_queries, found_rows = np.divmod(pairs[starts], rows)
+        best = np.lexsort((-counts, found_queries))
+        kept = best[group_ranks(found_queries[best]) < self.candidates]
+        kept.sort()
+        return found_queries[kept], found_rows[kept]
+
+    def products(self, X, queries, ids, chunk_size=2 ** 20):
+        """
+        Dot products of the stored rows `ids` with the rows `queries` of X,
+        computed a bounded number of values at a time.
+        """
+        sparse = sp.issparse(self.data) or sp.issparse(X)
+        # Sparse rows only hold their nonzero values.
+        step = chunk_size if sparse else max(1, chunk_size // max(1, X.shape[1]))
+        products = np.empty(ids.shape[0])
+        for start in range(0, ids.shape[0], step):
+            data, questions = self.data[ids[start:start + step]], X[queries[start:start + step]]
+            if sparse:
+                product = sp.csr_matrix(data).multiply(sp.csr_matrix(questions)).sum(axis=1)
+            else:
+                product = np.einsum('ij,ij->i', data, questions)
+            products[start:start + step] = np.asarray(product).ravel()
+        return products
+
+    def query(self, X, k):
+        distances = np.full((X.shape[0], k), np.inf)
+        indices = np.full((X.shape[0], k), -1, dtype=np.int64)
+        queries, ids = self.candidates_of(self.project(X))
+        if not ids.shape[0]:
+            return distances, indices
+        squared = np.maximum(self.norms[ids] - 2 * self.products(X, queries, ids) + row_norms(X)[queries], 0)
+        nearest = np.lexsort((squared, queries))
+        ranks = group_ranks(queries[nearest])
+        nearest, ranks = nearest[ranks < k], ranks[ranks < k]
+        distances[queries[nearest], ranks] = np.sqrt(squared[nearest])
+        indices[queries[nearest], ranks] = ids[nearest]
+        return distances, indices
+
+    def save(self, storage):
+        for key in self.ARRAYS:
+            storage.save(key, getattr(self, key))
+
+    def load(self, storage):
+        for key in self.ARRAYS:
+            setattr(self, key, storage.load(key))
+        return self
+
+
+class NeighborsClassifier(ClassifierMixin, BaseEstimator):
+    """
+    Majority vote of the nearest stored rows. Once saved, the index and the
+    labels live on disk and only the parameters and the storage location
+    are pickled; the index is memory mapped again on first use.
+    """
+
+    def __init__(self, n_neighbors=5, algorithm='kd_tree', leaf_size=40, tables=8, bits=16, probes=2,
+                 candidates=200, batch_size=1024):
+        self.n_neighbors = n_neighbors
+        self.algorithm = algorithm
+        self.leaf_size = leaf_size
+        self.tables = tables
+        self.bits = bits
+        self.probes = probes
+        self.candidates = candidates
+        self.batch_size = batch_size
+
+    def make_index(self):
+        if self.algorithm in TREES:
+            return TreeIndex(self.algorithm, leaf_size=self.leaf_size)
+        if self.algorithm == 'lsh':
+            return ProjectionIndex(self.tables, self.bits, probes=self.probes, candidates=self.candidates)
+        raise ValueError('algorithm must be one of {}'.format(', '.join(sorted(TREES) + ['lsh'])))
+
+    def fit(self, X, y):
+        self.classes_, labels = np.unique(np.asarray(y), return_inverse=True)
+        self.index_ = self.make_index().build(X)
+        self.n_features_in_ = X.shape[1]
+        self.labels_ = labels
+        self.prior_ = int(np.bincount(labels).argmax())
+        self.location_ = None
+        log.debug("Built %s index over %s rows", self.algorithm, X.shape[0])
+        return self
+
+    def save(self, storage):
+        """
+        Writes the index and labels under `storage` and swaps them for their
+        memory mapped copies.
+        """
+        self.index_.save(storage)
+        storage.save('labels', self.labels_)
+        self.location_ = storage.name
+        self.__dict__.pop('index_')
+        self.__dict__.pop('labels_')
+        return self
+
+    @property
+    def index(self):
+        if 'index_' not in self.__dict__:
+            storage = ArrayStorage(self.location_)
+            self.index_ = self.make_index().load(storage)
+            self.labels_ = storage.load('labels')
+            log.debug("Loaded %s index from %s", self.algorithm, self.location_)
+        return self.index_
+
+    def kneighbors(self, X):
+        index = self.index
+        results = [index.query(X[start:start + self.batch_size], self.n_neighbors)
+                   for start in range(0, X.shape[0], self.batch_size)]
+        return np.vstack([r[0] for r in results]), np.vstack([r[1] for r in results])
+
+    def predict(self, X):
+        distances, indices = self.kneighbors(X)
+        found = indices >= 0
+        votes = np.zeros((X.shape[0], len(self.classes_)))
+        rows = np.repeat(np.arange(X.shape[0]), indices.shape[1])
+        np.add.at(votes, (rows[found.ravel()], self.labels_[indices[found]]), 1)
+        predicted = votes.argmax(axis=1)
+        # Approximate queries may find nothing at all.
+        predicted[~found.any(axis=1)] = self.prior_
+        return self.classes_[predicted]
+
+    def __getstate__(self):
+        state = super(NeighborsClassifier, self).__getstate__()
+        if state.get('location_'):
+            state.pop('index_', None)
+            state.pop('labels_', None)
+        return state
@@ -0,0 +1,118 @@
+import numpy as np
+import scipy.linalg
+import scipy.sparse as sp
+from sklearn.base import BaseEstimator, RegressorMixin
+from sklearn.utils.extmath import safe_sparse_dot
+
+from utils.arrays import resize_columns
+
+import logging
+
+log = logging.getLogger('intuity.training.regression')
+
+
+class LeastSquares(RegressorMixin, BaseEstimator):
+    """
+    Ridge regression kept as sufficient statistics: X'X, X'y, y'y and the row
+    count, with the intercept as an extra, unpenalized column. partial_fit
+    folds a batch in with O(batch * d^2) work and never revisits earlier
+    rows; the coefficients are solved again, in O(d^3), only when they are
+    next needed. Sparse batches may add columns.
+    """
+
+    def __init__(self, alpha=1.0):
+        self.alpha = alpha
+
+    def fit(self, X, y):
+        for name in ('xtx_', 'xty_', 'yty_', 'n_samples_'):
+            self.__dict__.pop(name, None)
+        return self.partial_fit(X, y)
+
+    def partial_fit(self, X, y):
+        y = np.asarray(y, dtype=np.float64).ravel()
+        width = X.shape[1]
+        if not hasattr(self, 'xtx_'):
+            self.xtx_ = np.zeros((width + 1, width + 1))
+            self.xty_ = np.zeros(width + 1)
+            self.yty_ = 0.0
+            self.n_samples_ = 0
+        elif width > self.n_features_in_:
+            self.grow(width)
+        elif width < self.n_features_in_:
+            X = resize_columns(X, self.n_features_in_)
+
+        if sp.issparse(X):
+            xtx = X.T.dot(X).toarray()
+            sums = np.asarray(X.sum(axis=0)).ravel()
+        else:
+            X = np.asarray(X, dtype=np.float64)
+            xtx = X.T.dot(X)
+            sums = X.sum(axis=0)
+        self.xtx_[0, 0] += X.shape[0]
+        self.xtx_[0, 1:] += sums
+        self.xtx_[1:, 0] += sums
+        self.xtx_[1:, 1:] += xtx
+        self.xty_[0] += y.sum()
+        self.xty_[1:] += safe_sparse_dot(X.T, y)
+        self.yty_ += float(y.dot(y))
+        self.n_samples_ += X.shape[0]
+        self.__dict__.pop('weights_', None)
+        return self
+
+    def grow(self, width):
+        size = self.xtx_.shape[0]
+        xtx = np.zeros((width + 1, width + 1))
+        xtx[:size, :size] = self.xtx_
+        self.xtx_ = xtx
+        self.xty_ = np.concatenate([self.xty_, np.zeros(width + 1 - size)])
+        log.debug("Grew statistics from %s to %s features", size - 1, width)
+
+    @property
+    def n_features_in_(self):
+        return self.xtx_.shape[0] - 1
+
+    @property
+    def weights(self):
+        if 'weights_' not in self.__dict__:
+            penalty = np.full(self.xtx_.shape[0], float(self.alpha))
+            penalty[0] = 0.0
+            lhs = self.xtx_ + np.diag(penalty)
+            try:
+                self.weights_ = scipy.linalg.solve(lhs, self.xty_, assume_a='pos')
+            except (np.linalg.LinAlgError, ValueError):
+                # Singular without regularization, e.g. constant columns.
+                self.weights_ = scipy.linalg.lstsq(lhs, self.xty_)[0]
+        return self.weights_
+
+    @property
+    def coef_(self):
+        return self.weights[1:]
+
+    @property
+    def intercept_(self):
+        return self.weights[0]
+
+    def predict(self, X):
+        X = resize_columns(X, self.n_features_in_)
+        return np.asarray(safe_sparse_dot(X, self.coef_)).ravel() + self.intercept_
+
+    def scores(self):
+        """
+        R2 and RMSE on every row seen so far, from the statistics alone.
+        """
+        weights = self.weights
+        if not self.n_samples_:
+            return {'samples': 0, 'r2': None, 'rmse': None}
+        sse = max(self.yty_ - 2 * weights.dot(self.xty_) + weights.dot(self.xtx_).dot(weights), 0.0)
+        sst = self.yty_ - self.xty_[0] ** 2 / self.n_samples_
+        return {
+            'samples': self.n_samples_,
+            'r2': float(1 - sse / sst) if sst > 0 else None,
+            'rmse': float(np.sqrt(sse / self.n_samples_)),
+        }
+
+    def __getstate__(self):
+        # Solve before pickling so loaded models predict straight away.
+        if hasattr(self, 'xtx_'):
+            self.weights
+        return super(LeastSquares, self).__getstate__()
@@ -1,3 +1,328 @@
-from django.test import TestCase
+import shutil
+import socket
+import tempfile
+from datetime import timedelta
 
-# Create your tests here.
+import numpy as np
+import scipy.sparse as sp
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from sklearn.linear_model import Ridge, SGDClassifier, SGDRegressor
+from sklearn.neighbors import KNeighborsClassifier
+
+from model.models import Estimator
+from storage.backends import ArrayStorage
+from training.engine import choose
+from training.evaluation import check_splits, evaluate
+from training.jobs import JobQueue
+from training.models import BadFormat, Job, Training
+from training.neighbors import NeighborsClassifier, ProjectionIndex
+from training.regression import LeastSquares
+from utils.arrays import extend_fingerprint, fingerprint
+
+
+class StorageTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage_settings = override_settings(STORAGE_ROOT=self.root)
+        self.storage_settings.enable()
+
+    def tearDown(self):
+        self.storage_settings.disable()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+class AppendDataTest(StorageTestCase):
+
+    def setUp(self):
+        super(AppendDataTest, self).setUp()
+        self.training = Training.objects.create(uuid='t', job_type='classification')
+        self.training.save_data({'data': [[0., 1.], [1., 0.]], 'target': [0, 1]})
+
+    def test_appends_rows(self):
+        self.training.append_data({'data': [[1., 1.]], 'target': [1]})
+        self.assertEqual(self.training.data_array.shape, (3, 2))
+        self.assertEqual(list(self.training.target_array), [0, 1, 1])
+
+    def test_rejects_rows_that_are_not_a_matrix(self):
+        for data in ([], [1., 2.], [[[1., 2.]]]):
+            with self.assertRaises(BadFormat):
+                self.training.append_data({'data': data, 'target': [1]})
+        self.assertEqual(self.training.data_array.shape, (2, 2))
+
+    def test_rejects_a_different_width(self):
+        with self.assertRaises(BadFormat):
+            self.training.append_data({'data': [[1., 1., 1.]], 'target': [1]})
+
+    def test_drops_rows_an_interrupted_append_left_without_targets(self):
+        self.training.storage.append('data', np.array([[5., 5.]]))
+        self.training.append_data({'data': [[1., 1.]], 'target': [1]})
+        np.testing.assert_array_equal(self.training.data_array, [[0., 1.], [1., 0.], [1., 1.]])
+        self.assertEqual(list(self.training.target_array), [0, 1, 1])
+
+    def test_rejects_misaligned_targets(self):
+        with self.assertRaises(BadFormat):
+            self.training.append_data({'data': [[1., 1.]], 'target': [1, 0]})
+
+
+class JobQueueTest(StorageTestCase):
+
+    def setUp(self):
+        super(JobQueueTest, self).setUp()
+        self.training = Training.objects.create(uuid='t', job_type='classification')
+        self.queue = JobQueue(lease=60, attempts=2)
+
+    def enqueue(self, **params):
+        data = [[float(i % 2), float(i)] for i in range(20)]
+        return Job.enqueue(self.training, dict(params, data=data, target=[i % 2 for i in range(20)]))
+
+    def expire(self, job):
+        Job.objects.filter(pk=job.pk).update(heartbeat=timezone.now() - timedelta(seconds=120))
+
+    def test_claims_one_job_per_training(self):
+        first, second = self.enqueue(), self.enqueue()
+        self.assertEqual(self.queue.next(2), [first.pk])
+        job = Job.objects.get(pk=first.pk)
+        self.assertEqual((job.state, job.worker, job.attempts), (Job.RUNNING, self.queue.name, 1))
+        self.assertEqual(Job.objects.get(pk=second.pk).state, Job.QUEUED)
+
+    def test_requeues_jobs_whose_lease_expired(self):
+        job = self.enqueue()
+        self.queue.next(1)
+        self.queue.reclaim()
+        self.assertEqual(Job.objects.get(pk=job.pk).state, Job.RUNNING)
+        self.expire(job)
+        self.queue.reclaim()
+        self.assertEqual(Job.objects.get(pk=job.pk).state, Job.QUEUED)
+        self.assertEqual(self.queue.leased([job.pk]), set())
+
+    def test_fails_jobs_out_of_attempts(self):
+        job = self.enqueue()
+        for attempt in range(2):
+            self.queue.next(1)
+            self.expire(job)
+            self.queue.reclaim()
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual((job.state, job.error), (Job.FAILED, 'Worker lost'))
+        self.assertFalse(job.storage.exists('data'))
+
+    def test_never_retries_incremental_jobs(self):
+        job = self.enqueue(mode='incremental')
+        self.queue.next(1)
+        self.expire(job)
+        self.queue.reclaim()
+        self.assertEqual(Job.objects.get(pk=job.pk).state, Job.FAILED)
+
+    def test_takes_back_jobs_of_dead_workers_on_start(self):
+        job = self.enqueue()
+        JobQueue(lease=60, attempts=2, name='{}:{}'.format(socket.gethostname(), 2 ** 22 + 1)).next(1)
+        self.queue.reclaim()
+        self.assertEqual(Job.objects.get(pk=job.pk).state, Job.RUNNING)
+        self.queue.reclaim(starting=True)
+        self.assertEqual(Job.objects.get(pk=job.pk).state, Job.QUEUED)
+
+    def test_rejects_malformed_jobs_before_queueing(self):
+        rows, target = [[0., 1.], [1., 0.]] * 5, [0, 1] * 5
+        for data in ({'data': [1., 2.], 'target': [0, 1]}, {'target': target}, {'data': rows, 'target': [0]},
+                     {'data': rows, 'target': target, 'tier': 'quantum'},
+                     {'data': rows, 'target': target, 'params': {'unknown': 1}},
+                     {'data': rows, 'target': target, 'folds': 50},
+                     {'data': rows, 'target': target, 'test_size': 1.5},
+                     {'data': rows, 'target': target, 'mode': 'incremental', 'estimator': 'ridge'}):
+            with self.assertRaises(BadFormat):
+                Job.enqueue(self.training, data)
+        self.assertEqual(Job.objects.count(), 0)
+
+    def test_runs_claimed_jobs(self):
+        job = self.enqueue()
+        self.queue.next(1)
+        self.assertEqual(self.queue.run(job.pk), Job.DONE)
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual(job.heartbeat, None)
+        self.assertEqual(job.result_object['records'], 20)
+
+
+class CheckSplitsTest(TestCase):
+
+    def test_accepts_possible_splits(self):
+        check_splits(10, folds=10)
+        check_splits(10, folds=1)
+        check_splits(10, test_size=0.5)
+        check_splits(10, test_size=9)
+        check_splits(2)
+
+    def test_rejects_impossible_splits(self):
+        for folds, test_size in ((11, None), ('3', None), (None, 10), (None, 1.5), (None, 0.999), (None, -1)):
+            with self.assertRaises(ValueError):
+                check_splits(10, folds=folds, test_size=test_size)
+        with self.assertRaises(ValueError):
+            check_splits(1)
+
+    def test_classification_answers_bad_format(self):
+        training = Training.objects.create(uuid='t', job_type='classification')
+        with self.assertRaises(BadFormat):
+            training.process({'data': [[0.], [1.], [2.]], 'target': [0, 1, 0], 'folds': 5})
+        self.assertEqual(training.version, 0)
+
+
+class ClusteringTest(StorageTestCase):
+
+    def test_rejects_as_many_clusters_as_rows(self):
+        training = Training.objects.create(uuid='t', job_type='clustering')
+        data = {'data': [[0., 0.], [0., 1.], [5., 5.], [5., 6.]], 'target': [0, 0, 1, 1]}
+        with self.assertRaises(BadFormat):
+            training.process(dict(data, clusters=[2, 4]))
+        result = training.process(dict(data, clusters=[2, 3]))
+        self.assertEqual(result['records'], 4)
+        self.assertEqual(result['clusters']['best'], 2)
+
+    def test_default_sweep_fits_small_datasets(self):
+        training = Training.objects.create(uuid='t', job_type='clustering')
+        result = training.process({'data': [[0., 0.], [0., 1.], [5., 5.], [5., 6.]], 'target': [0, 0, 1, 1]})
+        self.assertEqual(sorted(result['clusters']['scores']), ['2', '3'])
+
+
+class LeastSquaresTest(TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.X = rng.randn(200, 5)
+        self.y = self.X.dot([1., -2., 0., 3., .5]) + 4 + rng.randn(200) * .1
+
+    def test_matches_ridge(self):
+        ridge = Ridge(alpha=2.0).fit(self.X, self.y)
+        model = LeastSquares(alpha=2.0).fit(self.X, self.y)
+        np.testing.assert_allclose(model.coef_, ridge.coef_, rtol=1e-6)
+        np.testing.assert_allclose(model.intercept_, ridge.intercept_, rtol=1e-6)
+        np.testing.assert_allclose(model.scores()['r2'], ridge.score(self.X, self.y), rtol=1e-6)
+
+    def test_partial_fits_match_a_full_fit(self):
+        model = LeastSquares()
+        for start in range(0, 200, 64):
+            model.partial_fit(self.X[start:start + 64], self.y[start:start + 64])
+        np.testing.assert_allclose(model.predict(self.X), LeastSquares().fit(self.X, self.y).predict(self.X))
+
+    def test_sparse_batches_add_columns(self):
+        model = LeastSquares().partial_fit(sp.csr_matrix(self.X[:100, :3]), self.y[:100])
+        model.partial_fit(sp.csr_matrix(self.X[100:]), self.y[100:])
+        self.assertEqual(model.n_features_in_, 5)
+        self.assertEqual(model.predict(self.X[:2, :3]).shape, (2,))
+
+
+class NeighborsTest(StorageTestCase):
+
+    def setUp(self):
+        super(NeighborsTest, self).setUp()
+        rng = np.random.RandomState(0)
+        self.X = np.vstack([rng.randn(100, 4), rng.randn(100, 4) + 6])
+        self.y = np.array(['a'] * 100 + ['b'] * 100)
+
+    def test_trees_match_sklearn(self):
+        queries = np.random.RandomState(1).randn(50, 4) * 3 + 3
+        expected = KNeighborsClassifier(n_neighbors=5).fit(self.X, self.y).predict(queries)
+        for algorithm in ('kd_tree', 'ball_tree'):
+            model = NeighborsClassifier(algorithm=algorithm).fit(self.X, self.y)
+            np.testing.assert_array_equal(model.predict(queries), expected)
+
+    def test_lsh_finds_stored_rows(self):
+        model = NeighborsClassifier(n_neighbors=1, algorithm='lsh').fit(sp.csr_matrix(self.X), self.y)
+        distances, indices = model.kneighbors(sp.csr_matrix(self.X[::10]))
+        np.testing.assert_array_equal(indices.ravel(), np.arange(0, 200, 10))
+        np.testing.assert_allclose(distances.ravel(), 0, atol=1e-6)
+
+    def test_lsh_pads_queries_with_fewer_candidates_than_neighbours(self):
+        index = ProjectionIndex(candidates=2).build(self.X)
+        distances, indices = index.query(self.X[:3], 5)
+        np.testing.assert_array_equal(indices[:, 0], [0, 1, 2])
+        self.assertTrue((indices[:, 2:] == -1).all() and np.isinf(distances[:, 2:]).all())
+        self.assertTrue((np.diff(distances[:, :2], axis=1) >= 0).all())
+
+    def test_saved_index_is_loaded_back(self):
+        model = NeighborsClassifier(algorithm='lsh').fit(self.X, self.y)
+        expected = model.predict(self.X)
+        model.save(ArrayStorage('neighbors'))
+        self.assertNotIn('index_', model.__dict__)
+        np.testing.assert_array_equal(model.predict(self.X), expected)
+
+
+class IncrementalFingerprintTest(StorageTestCase):
+
+    def test_chains_fingerprints_of_appended_rows(self):
+        training = Training.objects.create(uuid='t', job_type='regression')
+        training.run({'mode': 'incremental', 'data': [[0., 1.], [1., 0.]], 'target': [1., 2.]})
+        first = Estimator.objects.get(training='t', version=training.version).fingerprint
+        self.assertEqual(first, fingerprint(training.data_array, training.target_array))
+        training.run({'mode': 'incremental', 'data': [[1., 1.]], 'target': [3.]})
+        second = Estimator.objects.get(training='t', version=training.version).fingerprint
+        self.assertEqual(second, extend_fingerprint(first, training.data_array[2:], training.target_array[2:]))
+        # Chained fingerprints identify the history: the same rows uploaded at once hash differently.
+        self.assertNotEqual(second, fingerprint(training.data_array, training.target_array))
+
+
+class StreamedEvaluationTest(StorageTestCase):
+
+    def setUp(self):
+        super(StreamedEvaluationTest, self).setUp()
+        rng = np.random.RandomState(0)
+        self.X = rng.randn(300, 3)
+        self.y = self.X.dot([1., 2., 3.]) + rng.randn(300) * .1
+
+    def test_chunked_least_squares_match_a_full_fit(self):
+        for folds in (None, 3):
+            expected = evaluate(LeastSquares(), self.X, self.y, folds=folds, n_jobs=1)
+            streamed = evaluate(LeastSquares(), self.X, self.y, folds=folds, chunk_size=32)
+            self.assertEqual(streamed.samples, expected.samples)
+            self.assertAlmostEqual(streamed.r2, expected.r2)
+
+    def test_scores_online_classifiers_in_chunks(self):
+        target = (self.y > 0).astype(int)
+        metrics = evaluate(SGDClassifier(random_state=0), sp.csr_matrix(self.X), target, test_size=0.2, chunk_size=50)
+        self.assertEqual((metrics.samples, metrics.folds), (60, 1))
+        self.assertGreater(metrics.accuracy, 0.8)
+
+    def test_online_tier_is_evaluated_from_storage(self):
+        training = Training.objects.create(uuid='t', job_type='regression')
+        result = training.process({'data': self.X.tolist(), 'target': self.y.tolist(), 'tier': 'online',
+                                   'chunk_size': 64})
+        self.assertEqual(result['engine']['tier'], 'online')
+        self.assertGreater(result['metrics']['r2'], 0.9)
+
+
+class IncrementalRegressionTest(StorageTestCase):
+
+    def test_wide_data_falls_back_to_sgd(self):
+        training = Training.objects.create(uuid='t', job_type='regression')
+        data = {'mode': 'incremental', 'data': sp.csr_matrix(np.eye(4)), 'target': [1., 2., 3., 4.]}
+        training.run(data)
+        self.assertIsInstance(training.load_estimator(), LeastSquares)
+        with override_settings(REGRESSION_MAX_FEATURES=4):
+            training.run(dict(data, data=sp.csr_matrix(np.eye(5))[:1], target=[5.]))
+        self.assertIsInstance(training.load_estimator(), SGDRegressor)
+        self.assertEqual(training.load_estimator().n_features_in_, 5)
+
+
+class EngineTest(TestCase):
+
+    def test_neighbors_use_trees_up_to_their_cap_and_lsh_above(self):
+        choice = choose('classification', 50000, 16)
+        self.assertEqual((choice.tier, choice.build().algorithm), ('neighbors', 'kd_tree'))
+        choice = choose('classification', 50000, 17)
+        self.assertEqual((choice.tier, choice.build().algorithm), ('neighbors', 'lsh'))
+        self.assertEqual(choose('classification', 50000, 129).tier, 'approximate')
+
+    def test_lsh_serves_wider_data_when_the_tier_is_requested(self):
+        self.assertEqual(choose('classification', 500, 1000, tier='neighbors').build().algorithm, 'lsh')
+
+
+class PredictionWidthTest(StorageTestCase):
+
+    def test_predicts_with_the_served_width_after_wider_rows_are_appended(self):
+        training = Training.objects.create(uuid='t', job_type='classification')
+        rows = sp.csr_matrix(np.array([[1., 0.], [0., 1.]] * 10))
+        training.run({'mode': 'incremental', 'data': rows, 'target': [0, 1] * 10})
+        training.append_data({'data': sp.csr_matrix(np.array([[0., 1., 1.]])), 'target': [1]})
+        self.assertEqual(training.width, 3)
+        self.assertLess(training.model_version, training.version)
+        question = sp.csr_matrix(np.array([[1., 0., 1.], [0., 1., 1.]]))
+        self.assertEqual(list(training.predict(question)), [0, 1])
@@ -1,32 +1,66 @@
-import jwt
+import json
+
+import scipy.sparse as sp
 from django.conf import settings
+from django.http import StreamingHttpResponse
 from django.shortcuts import Http404
 from rest_framework import parsers
-from rest_framework import renderers
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from intuity_common.auth import validate_token
+from intuity_common.parsers import MsgPackParser
+from intuity_common.renderers import MsgPackRenderer, NumpyJSONRenderer
+
+from prediction.batching import batcher
+from training.models import Training, BadFormat, Job
 
-from training.models import Training
 import logging
 
 log = logging.getLogger('intuity.training.views')
 
 
-def validate_token(func):
-    def _decorated(view, request, *args, **kwargs):
-        token = request.GET.get('token', '')
-        try:
-            payload = jwt.decode(token, key=settings.SECRET_KEY, audience='curiosity', issuer='authority')
-        except (jwt.DecodeError, AttributeError, jwt.InvalidAudience, jwt.InvalidIssuer) as e:
-            return Response({'error': e.message}, status=401)
-        return func(view, request, payload, *args, **kwargs)
-
-    return _decorated
+def export_lines(training, cursor, fields):
+    """
+    Yields one NDJSON line per stored row, reading the memory mapped arrays
+    EXPORT_PAGE_SIZE rows at a time. Sparse rows are written as their
+    column indices and values.
+    """
+    data = training.data_array
+    target = training.target_array
+    for start in range(cursor, target.shape[0], settings.EXPORT_PAGE_SIZE):
+        end = start + settings.EXPORT_PAGE_SIZE
+        targets = target[start:end].tolist()
+        if 'data' in fields:
+            chunk = data[start:end]
+            if sp.issparse(chunk):
+                rows = [
+                    {'indices': chunk.indices[chunk.indptr[i]:chunk.indptr[i + 1]].tolist(),
+                     'values': chunk.data[chunk.indptr[i]:chunk.indptr[i + 1]].tolist()}
+                    for i in range(chunk.shape[0])
+                ]
+            else:
+                rows = chunk.tolist()
+        lines = []
+        for i, value in enumerate(targets):
+            record = {}
+            if 'data' in fields:
+                record['data'] = rows[i]
+            if 'target' in fields:
+                record['target'] = value
+            lines.append(json.dumps(record))
+        yield '\n'.join(lines) + '\n'
 
 
 class TrainingApi(APIView):
-    parser_classes = (parsers.JSONParser,)
-    renderer_classes = (renderers.JSONRenderer,)
+    """
+    GET
+        URL: /v1/training/?token={token}[&cursor={row}][&limit={n}][&fields=data,target][&stream=1]
+        Pages of the stored arrays; `next` is the row the following page
+        starts at. With stream=1 all rows are streamed as NDJSON instead.
+    """
+
+    parser_classes = (parsers.JSONParser, MsgPackParser)
+    renderer_classes = (NumpyJSONRenderer, MsgPackRenderer)
 
     def get_view_name(self):
         return 'Training'
@@ -38,7 +72,26 @@ class TrainingApi(APIView):
         except Training.DoesNotExist:
             raise Http404
 
-        return Response({'data': training.data_object, 'target': training.target_object})
+        try:
+            cursor = int(request.GET.get('cursor', 0))
+            limit = min(int(request.GET.get('limit', settings.EXPORT_PAGE_SIZE)), settings.EXPORT_MAX_PAGE_SIZE)
+            fields = set(request.GET.get('fields', 'data,target').split(','))
+            if cursor < 0 or limit < 1 or not fields <= {'data', 'target'}:
+                raise ValueError
+        except ValueError:
+            return Response({'error': 'Invalid input: bad cursor, limit or fields'}, status=400)
+
+        if request.GET.get('stream') in ('1', 'true'):
+            return StreamingHttpResponse(export_lines(training, cursor, fields), content_type='application/x-ndjson')
+
+        rows = training.target_array.shape[0]
+        end = min(cursor + limit, rows)
+        page = {'next': end if end < rows else None}
+        if 'data' in fields:
+            page['data'] = training.data_array[cursor:end]
+        if 'target' in fields:
+            page['target'] = training.target_array[cursor:end]
+        return Response(page)
 
     @validate_token
     def post(self, request, payload):
@@ -46,15 +99,21 @@ class TrainingApi(APIView):
         if type(request.data) is not dict:
             return Response({'error': 'Invalid input: dict expected'}, status=400)
 
-        training, created = Training.objects.get_or_create(pk=payload['uuid'])
+        training, created = Training.for_payload(payload)
 
-        accuracy = training.process(request.data)
+        if request.data.get('async'):
+            try:
+                job = Job.enqueue(training, request.data)
+            except BadFormat as e:
+                return Response({'error': 'Invalid input: {}'.format(e)}, status=400)
+            return Response({'job': job.pk, 'state': job.state}, status=202)
 
-        trainings = []
-        for data, target in zip(training.data_object, training.target_object):
-            trainings.append({'data': data, 'target': target})
+        try:
+            result = training.run(request.data)
+        except BadFormat as e:
+            return Response({'error': 'Invalid input: {}'.format(e)}, status=400)
 
-        return Response({"records": len(trainings), 'accuracy': accuracy})
+        return Response(result)
 
     @validate_token
     def delete(self, request, payload):
@@ -62,8 +121,8 @@ class TrainingApi(APIView):
 
 
 class PredictionApi(APIView):
-    parser_classes = (parsers.JSONParser,)
-    renderer_classes = (renderers.JSONRenderer,)
+    parser_classes = (parsers.JSONParser, MsgPackParser)
+    renderer_classes = (NumpyJSONRenderer, MsgPackRenderer)
 
     @validate_token
     def post(self, request, payload):
@@ -78,7 +137,45 @@ class PredictionApi(APIView):
             log.warning('Training with ID %s not found', payload['uuid'])
             raise Http404
 
-        prediction = training.predict(request.data['data'])
+        if settings.PREDICTION_BATCHING:
+            estimator = training.estimator
+            prediction = batcher.predict(
+                (training.uuid, training.model_version),
+                training.sample(request.data['data'], estimator),
+                lambda rows: estimator.predict(rows)
+            )
+        else:
+            prediction = training.predict(request.data['data'])
 
         log.info('Prediction: %s', prediction)
         return Response({'prediction': prediction})
+
+
+class JobApi(APIView):
+    """
+    GET
+        URL: /v1/training/jobs/{job_id}/?token={token}
+    """
+
+    renderer_classes = (NumpyJSONRenderer, MsgPackRenderer)
+
+    def get_view_name(self):
+        return 'Training job'
+
+    @validate_token
+    def get(self, request, payload, job_id):
+        try:
+            job = Job.objects.get(pk=job_id, training_id=payload['uuid'])
+        except Job.DoesNotExist:
+            raise Http404
+
+        return Response({
+            'job': job.pk,
+            'state': job.state,
+            'date_created': job.date_created,
+            'date_started': job.date_started,
+            'date_finished': job.date_finished,
+            'timings': job.timings,
+            'result': job.result_object,
+            'error': job.error,
+        })
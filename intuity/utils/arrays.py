@@ -0,0 +1,49 @@
+import hashlib
+
+import numpy as np
+import scipy.sparse as sp
+
+
+def resize_columns(matrix, width):
+    """
+    Truncates or zero pads the columns of a 2d matrix. Feature columns only
+    ever grow at the end, so extra columns are features the model has not
+    seen yet and missing ones are features absent from the sample.
+    """
+    if matrix.shape[1] == width:
+        return matrix
+    if sp.issparse(matrix):
+        matrix = matrix.tocsr()
+        if matrix.shape[1] > width:
+            matrix = matrix[:, :width]
+        return sp.csr_matrix((matrix.data, matrix.indices, matrix.indptr), shape=(matrix.shape[0], width))
+    if matrix.shape[1] > width:
+        return matrix[:, :width]
+    return np.hstack([matrix, np.zeros((matrix.shape[0], width - matrix.shape[1]), dtype=matrix.dtype)])
+
+
+def fingerprint(*arrays):
+    """
+    SHA-1 of the shapes, dtypes and contents of dense or sparse arrays,
+    hashed in blocks so memory mapped arrays are never loaded whole.
+    """
+    digest = hashlib.sha1()
+    for array in arrays:
+        parts = [array.data, array.indices, array.indptr] if sp.issparse(array) else [array]
+        digest.update(','.join(str(int(d)) for d in array.shape).encode('ascii'))
+        for part in parts:
+            part = np.ascontiguousarray(part).reshape(-1)
+            digest.update(part.dtype.str.encode('ascii'))
+            for start in range(0, part.shape[0], 1 << 20):
+                digest.update(part[start:start + (1 << 20)].tobytes())
+    return digest.hexdigest()
+
+
+def extend_fingerprint(previous, *arrays):
+    """
+    Fingerprint of a dataset grown by `arrays`, chained from the fingerprint
+    of the rows stored before so appends never rehash them. The result
+    depends on how the dataset was built: the same rows appended in other
+    batches, or uploaded at once, fingerprint differently.
+    """
+    return hashlib.sha1('{}:{}'.format(previous, fingerprint(*arrays)).encode('ascii')).hexdigest()
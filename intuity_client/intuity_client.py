@@ -1,68 +1,191 @@
+from __future__ import print_function
+
+import hashlib
 import json
-from datetime import datetime
+import threading
+import time
+from decimal import Decimal
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+
+import ijson
+import requests
+from intuity_common.extraction import Schema
+
+import logging
+
+log = logging.getLogger('intuity_client')
+
 
+def json_default(value):
+    # ijson returns non-integer numbers as Decimal.
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+class UploadError(Exception):
+    pass
 
 
 class ElasticSearchLoader(object):
+    """
+    Reads an ElasticSearch search dump one hit at a time, so the file is
+    parsed once and never held in memory.
+    """
 
-    def __init__(self, json_file, target, features=None, size=None):
+    def __init__(self, json_file, target, features=None, size=None, schema=None):
         self.features = features or []
+        if isinstance(schema, dict):
+            schema = Schema.from_dict(schema)
+        elif schema is None:
+            # Listed features keep their value, timestamps become their hour.
+            schema = Schema.auto(self.features) if self.features else Schema([], passthrough=True)
+        self.schema = schema
         self.target_name = target
-        self.json_data = open(json_file).read()
+        self.json_file = json_file
         self.size = size
 
-    @property
-    def obj_data(self):
-        return json.loads(self.json_data)
-
     @property
     def hits(self):
-        if type(self.size) is int:
-            return self.obj_data['hits']['hits'][:self.size]
-        else:
-            return self.obj_data['hits']['hits']
+        with open(self.json_file, 'rb') as f:
+            hits = ijson.items(f, 'hits.hits.item')
+            if type(self.size) is int:
+                hits = islice(hits, self.size)
+            for hit in hits:
+                yield hit
 
     @property
     def records(self):
-        return [r['_source'] for r in self.hits]
+        return (r['_source'] for r in self.hits)
+
+    def iter_observations(self, chunk_size=1000):
+        """
+        Runs the extraction schema column-wise over chunks of records.
+        """
+        records = iter(self.records)
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                break
+            for r, data in zip(chunk, self.schema.extract(chunk)):
+                data.pop(self.target_name, None)
+                yield {'data': data, 'target': r[self.target_name]}
 
     @property
     def data(self):
-        d = []
-        for r in self.records:
-            if self.features:
-                o = {}
-                for f in self.features:
-                    o[f] = r[f]
-                    if type(r[f]) in (str, unicode):
-                        try:
-                            t = datetime.strptime(r[f], '%Y-%m-%dT%H:%M:%S.%f+00:00')
-                            o[f] = t.hour
-                        except Exception as e:
-                            pass
-            else:
-                o = r.copy()
-                del o[self.target_name]
-            d.append(o)
-        return d
+        return [o['data'] for o in self.iter_observations()]
 
     @property
     def target(self):
-        d = []
-        for r in self.records:
-            d.append(r[self.target_name])
-        return d
+        return [r[self.target_name] for r in self.records]
 
     @property
     def observations(self):
-        o = []
-        for data, target in zip(self.data, self.target):
-            o.append({'data': data, 'target': target})
-        return o
+        return list(self.iter_observations())
 
     @property
     def observations_json(self):
-        return json.dumps(self.observations)
+        return json.dumps(self.observations, default=json_default)
+
+    def batches(self, batch_size=1000, max_bytes=4 * 1024 * 1024):
+        """
+        Yields (count, body) pairs where body is a JSON array of at most
+        batch_size observations and roughly max_bytes long. Each observation
+        is serialized exactly once.
+        """
+        items = []
+        size = 2
+        for observation in self.iter_observations():
+            item = json.dumps(observation, default=json_default)
+            if items and (len(items) >= batch_size or size + len(item) + 1 > max_bytes):
+                yield len(items), '[' + ','.join(items) + ']'
+                items = []
+                size = 2
+            items.append(item)
+            size += len(item) + 1
+        if items:
+            yield len(items), '[' + ','.join(items) + ']'
+
+    def upload(self, url, token, workers=4, batch_size=1000, max_bytes=4 * 1024 * 1024, incremental=True,
+               retries=3, backoff=1.0):
+        """
+        Posts the observations to curiosity's /v1/observation/ in batches,
+        with at most `workers` requests in flight and as many batches waiting,
+        so memory stays flat whatever the size of the dump. Each batch is
+        sent with its hash as Idempotency-Key, so rerunning an upload does
+        not store or train on the same rows again.
+        A 503 means a batch was stored but could not be trained; it is sent
+        again with the same key, which retrains it, up to `retries` times.
+        Returns the number of uploaded observations, or raises UploadError
+        when some could not be uploaded or trained.
+        """
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        params = {'token': token}
+        if incremental:
+            params['incremental'] = 1
+
+        pool = ThreadPool(workers)
+        slots = threading.BoundedSemaphore(workers * 2)
+        lock = threading.Lock()
+        state = {'uploaded': 0, 'untrained': 0, 'errors': []}
+
+        def send(body):
+            headers = {
+                'Content-Type': 'application/json',
+                'Idempotency-Key': hashlib.sha1(body.encode('utf-8')).hexdigest(),
+            }
+            for attempt in range(retries + 1):
+                if attempt:
+                    time.sleep(backoff * 2 ** (attempt - 1))
+                response = session.post(url, params=params, data=body, headers=headers)
+                if response.status_code != 503:
+                    break
+            return response
+
+        def post(count, body):
+            try:
+                response = send(body)
+                if response.status_code == 503:
+                    log.warning("Batch of %s observations stored but not trained after %s retries", count, retries)
+                    with lock:
+                        state['untrained'] += count
+                elif response.status_code >= 400:
+                    raise UploadError('{}: {}'.format(response.status_code, response.text))
+                else:
+                    with lock:
+                        state['uploaded'] += count
+            except Exception as e:
+                log.error("Batch of %s observations failed: %s", count, e)
+                with lock:
+                    state['errors'].append(e)
+            finally:
+                slots.release()
+
+        try:
+            for count, body in self.batches(batch_size, max_bytes):
+                slots.acquire()
+                if state['errors']:
+                    break
+                pool.apply_async(post, (count, body))
+        finally:
+            pool.close()
+            pool.join()
+            session.close()
+
+        if state['errors']:
+            raise UploadError('Upload stopped after {} observations: {}'.format(
+                state['uploaded'], state['errors'][0]
+            ))
+        if state['untrained']:
+            raise UploadError('{} observations were stored but not trained, upload them again to train them'.format(
+                state['untrained']
+            ))
+        return state['uploaded']
+
 
 if __name__ == '__main__':
 
@@ -76,4 +199,4 @@ if __name__ == '__main__':
         size=2000
     )
 
-    print e.observations_json
+    print(e.observations_json)